@@ -7,7 +7,8 @@ from sqlalchemy import pool
 from alembic import context
 
 from arkia11nmodels import dbconfig
-from arkia11nmodels.models.base import db
+from arkia11nmodels.models import load_all
+from arkia11nmodels.models.tenants import DEFAULT_SCHEMA, validate_schema, version_table
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -24,7 +25,15 @@ if config.config_file_name is not None:
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
-target_metadata = db
+target_metadata = load_all()
+
+# The schema to migrate: "alembic -x schema=customer1 upgrade head", default DB_SCHEMA (see models.tenants),
+# the migrations read it from config.attributes
+SCHEMA = validate_schema(context.get_x_argument(as_dictionary=True).get("schema", dbconfig.SCHEMA))
+config.attributes["schema"] = SCHEMA
+# The initial revision creates the "a11n" tables, other schemas start from it without running it (the next revision
+# creates their tables). Offline: "alembic -x schema=NAME upgrade de8bb8c3fd6d:head --sql"
+INITIAL_REVISION = "de8bb8c3fd6d"
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -50,6 +59,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        version_table=version_table(SCHEMA),
     )
 
     with context.begin_transaction():
@@ -70,9 +80,12 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(connection=connection, target_metadata=target_metadata, version_table=version_table(SCHEMA))
 
         with context.begin_transaction():
+            migration_context = context.get_context()
+            if SCHEMA != DEFAULT_SCHEMA and migration_context.get_current_revision() is None:
+                migration_context.stamp(context.script, INITIAL_REVISION)
             context.run_migrations()
 
 
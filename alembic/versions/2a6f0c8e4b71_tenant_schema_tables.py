@@ -0,0 +1,104 @@
+"""Initial tables for schemas other than a11n
+
+Revision ID: 2a6f0c8e4b71
+Revises: de8bb8c3fd6d
+Create Date: 2026-10-19 08:05:12.604113+00:00
+
+The initial revision creates the tables in "a11n", alembic/env.py stamps the other schemas (tenants) at it without
+running it and this revision creates their tables.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from arkia11nmodels.models.tenants import DEFAULT_SCHEMA, migration_schema, version_table
+
+# revision identifiers, used by Alembic.
+revision = "2a6f0c8e4b71"
+down_revision = "de8bb8c3fd6d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    schema = migration_schema()
+    if schema == DEFAULT_SCHEMA:
+        return  # created by de8bb8c3fd6d
+    op.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+    op.create_table(
+        "roles",
+        sa.Column("displayname", sa.Unicode(), nullable=False),
+        sa.Column("acl", postgresql.JSONB(astext_type=sa.Text()), server_default="[]", nullable=False),
+        sa.Column("priority", sa.Integer(), nullable=False),
+        sa.Column("pk", postgresql.UUID(), nullable=False),
+        sa.Column("created", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("deleted", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("pk"),
+        schema=schema,
+    )
+    op.create_table(
+        "users",
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("sms", sa.String(), nullable=True),
+        sa.Column("displayname", sa.Unicode(), nullable=False),
+        sa.Column("profile", postgresql.JSONB(astext_type=sa.Text()), server_default="{}", nullable=False),
+        sa.Column("pk", postgresql.UUID(), nullable=False),
+        sa.Column("created", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("deleted", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("pk"),
+        schema=schema,
+    )
+    op.create_index(op.f("ix_a11n_users_email"), "users", ["email"], unique=True, schema=schema)
+    op.create_index(op.f("ix_a11n_users_sms"), "users", ["sms"], unique=True, schema=schema)
+    op.create_table(
+        "tokens",
+        sa.Column("user", postgresql.UUID(), nullable=True),
+        sa.Column("sent_to", sa.String(), nullable=False),
+        sa.Column("redirect", sa.String(), nullable=True),
+        sa.Column("expires", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("used", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("audit_meta", postgresql.JSONB(astext_type=sa.Text()), server_default="{}", nullable=False),
+        sa.Column("pk", postgresql.UUID(), nullable=False),
+        sa.Column("created", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("deleted", sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["user"],
+            [f"{schema}.users.pk"],
+        ),
+        sa.PrimaryKeyConstraint("pk"),
+        schema=schema,
+    )
+    op.create_table(
+        "userroles",
+        sa.Column("user", postgresql.UUID(), nullable=True),
+        sa.Column("role", postgresql.UUID(), nullable=True),
+        sa.Column("pk", postgresql.UUID(), nullable=False),
+        sa.Column("created", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("deleted", sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["role"],
+            [f"{schema}.roles.pk"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["user"],
+            [f"{schema}.users.pk"],
+        ),
+        sa.PrimaryKeyConstraint("pk"),
+        schema=schema,
+    )
+    op.create_index("user_role_unique", "userroles", ["user", "role"], unique=True, schema=schema)
+
+
+def downgrade() -> None:
+    schema = migration_schema()
+    if schema == DEFAULT_SCHEMA:
+        return
+    # below this the initial revision would drop the a11n tables
+    raise RuntimeError(
+        f"Schema {schema} can not be downgraded below {revision},"
+        f" drop the schema and the table public.{version_table(schema)} instead"
+    )
@@ -0,0 +1,57 @@
+"""Partial indexes for soft-deleted rows and live userroles
+
+Revision ID: 5c1e0f3a9b27
+Revises: 2a6f0c8e4b71
+Create Date: 2026-10-19 09:12:41.517203+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from arkia11nmodels.models.tenants import migration_schema
+
+
+# revision identifiers, used by Alembic.
+revision = "5c1e0f3a9b27"
+down_revision = "2a6f0c8e4b71"
+branch_labels = None
+depends_on = None
+
+TABLES = ("roles", "users", "tokens", "userroles")
+
+
+def upgrade() -> None:
+    schema = migration_schema()
+    for table in TABLES:
+        op.create_index(
+            f"ix_a11n_{table}_deleted",
+            table,
+            ["deleted"],
+            unique=False,
+            schema=schema,
+            postgresql_where=sa.text("deleted IS NOT NULL"),
+        )
+    op.create_index(
+        "ix_a11n_userroles_user_live",
+        "userroles",
+        ["user"],
+        unique=False,
+        schema=schema,
+        postgresql_where=sa.text("deleted IS NULL"),
+    )
+    op.create_index(
+        "ix_a11n_userroles_role_live",
+        "userroles",
+        ["role"],
+        unique=False,
+        schema=schema,
+        postgresql_where=sa.text("deleted IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    schema = migration_schema()
+    op.drop_index("ix_a11n_userroles_role_live", table_name="userroles", schema=schema)
+    op.drop_index("ix_a11n_userroles_user_live", table_name="userroles", schema=schema)
+    for table in reversed(TABLES):
+        op.drop_index(f"ix_a11n_{table}_deleted", table_name=table, schema=schema)
@@ -0,0 +1,41 @@
+"""Trigram indexes for user search
+
+Revision ID: 8d2f4b6a1c93
+Revises: 5c1e0f3a9b27
+Create Date: 2026-10-19 11:03:27.294410+00:00
+
+"""
+from alembic import op
+
+from arkia11nmodels.models.tenants import migration_schema
+
+
+# revision identifiers, used by Alembic.
+revision = "8d2f4b6a1c93"
+down_revision = "5c1e0f3a9b27"
+branch_labels = None
+depends_on = None
+
+COLUMNS = ("email", "displayname")
+
+
+def upgrade() -> None:
+    schema = migration_schema()
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public")
+    for column in COLUMNS:
+        op.create_index(
+            f"ix_a11n_users_{column}_trgm",
+            "users",
+            [column],
+            unique=False,
+            schema=schema,
+            postgresql_using="gin",
+            postgresql_ops={column: "gin_trgm_ops"},
+        )
+
+
+def downgrade() -> None:
+    schema = migration_schema()
+    for column in reversed(COLUMNS):
+        op.drop_index(f"ix_a11n_users_{column}_trgm", table_name="users", schema=schema)
+    # The extension is left in place, other things in the database may use it
@@ -0,0 +1,77 @@
+"""Role inheritance with role closure table
+
+Revision ID: b7e3c9d15a42
+Revises: 8d2f4b6a1c93
+Create Date: 2026-10-19 14:21:08.517302+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from arkia11nmodels.models.tenants import migration_schema
+
+
+# revision identifiers, used by Alembic.
+revision = "b7e3c9d15a42"
+down_revision = "8d2f4b6a1c93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    schema = migration_schema()
+    op.create_table(
+        "role_parents",
+        sa.Column("role", postgresql.UUID(), nullable=False),
+        sa.Column("parent", postgresql.UUID(), nullable=False),
+        sa.Column("pk", postgresql.UUID(), nullable=False),
+        sa.Column("created", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("deleted", sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["role"],
+            [f"{schema}.roles.pk"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["parent"],
+            [f"{schema}.roles.pk"],
+        ),
+        sa.PrimaryKeyConstraint("pk"),
+        schema=schema,
+    )
+    op.create_index("role_parent_unique", "role_parents", ["role", "parent"], unique=True, schema=schema)
+    op.create_index(
+        "ix_a11n_role_parents_deleted",
+        "role_parents",
+        ["deleted"],
+        unique=False,
+        schema=schema,
+        postgresql_where=sa.text("deleted IS NOT NULL"),
+    )
+    op.create_table(
+        "role_closure",
+        sa.Column("descendant", postgresql.UUID(), nullable=False),
+        sa.Column("ancestor", postgresql.UUID(), nullable=False),
+        sa.Column("depth", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["descendant"],
+            [f"{schema}.roles.pk"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["ancestor"],
+            [f"{schema}.roles.pk"],
+        ),
+        sa.PrimaryKeyConstraint("descendant", "ancestor"),
+        schema=schema,
+    )
+    op.create_index("ix_a11n_role_closure_ancestor", "role_closure", ["ancestor"], unique=False, schema=schema)
+
+
+def downgrade() -> None:
+    schema = migration_schema()
+    op.drop_index("ix_a11n_role_closure_ancestor", table_name="role_closure", schema=schema)
+    op.drop_table("role_closure", schema=schema)
+    op.drop_index("ix_a11n_role_parents_deleted", table_name="role_parents", schema=schema)
+    op.drop_index("role_parent_unique", table_name="role_parents", schema=schema)
+    op.drop_table("role_parents", schema=schema)
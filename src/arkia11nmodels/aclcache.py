@@ -0,0 +1,262 @@
+"""Cache for resolved user ACLs (see models.Role.resolve_user_acl) with pluggable backends
+
+Entries are versioned by a per-user generation counter (bumped by Role.assign_to/remove_from) and a global
+generation counter (bumped by Role updates changing acl or priority and by hierarchy changes), an entry is only valid
+if it was stored under the current generations so there's no need to find and delete stale entries. The counters
+must outlive the entries: a counter evicted and started again from 0 would make old entries valid again.
+MemoryBackend keeps them outside its LRU, with Redis use a volatile-* maxmemory-policy (or noeviction), the
+entries have a TTL and the counters do not.
+
+MergeMemo keeps merged ACLs in-process keyed by the fingerprint of the ordered (pk, priority, ACL digest) of the
+roles they were merged from, so users with identical role sets share one merged ACL object. It is enabled by
+default, the fingerprint is of what was merged so changes to the roles need no invalidation (User.default_acl does,
+see MergeMemo.clear).
+
+The Redis backend takes any client compatible with redis.asyncio.Redis (decode_responses must be False), so
+several gateway instances can share the cache::
+
+    import redis.asyncio
+    from arkia11nmodels import aclcache
+
+    aclcache.set_cache(aclcache.ACLCache(aclcache.RedisBackend(redis.asyncio.from_url("redis://localhost"))))
+"""
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
+import logging
+import sys
+import time
+import uuid
+
+from libadvian.binpackers import ensure_str, uuid_to_b64
+
+from .schemas.role import ACL
+from .schemas.aclcodec import encode_acl, decode_acl
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_TTL = 15 * 60.0
+DEFAULT_PREFIX = "arkia11n:acl:"
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MEMO_ENTRIES = 1000
+PKType = Union[uuid.UUID, str]
+
+
+class ACLCacheBackend(ABC):
+    """The operations ACLCache needs from the storage, semantics follow the Redis commands of the same name"""
+
+    @abstractmethod
+    async def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """Get values for keys, None for missing"""
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        """Set value, expire after ttl seconds if given"""
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        """Increment integer value (missing key is 0) and return the new value"""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """Delete key"""
+
+
+class MemoryBackend(ACLCacheBackend):
+    """In-process backend, bounded LRU for the values, the incr() counters are kept apart and never evicted"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[Optional[float], bytes]]" = OrderedDict()
+        self._counters: Dict[str, int] = {}
+
+    def _get(self, key: str) -> Optional[bytes]:
+        """Get value if not expired, marks it recently used"""
+        if key in self._counters:
+            return str(self._counters[key]).encode("ascii")
+        if key not in self._data:
+            return None
+        expires, value = self._data[key]
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        """Set value and evict least recently used over the limit"""
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        return [self._get(key) for key in keys]
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self._set(key, value, ttl)
+
+    async def incr(self, key: str) -> int:
+        value = self._counters.get(key, 0) + 1
+        self._counters[key] = value
+        return value
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+        self._counters.pop(key, None)
+
+
+class RedisBackend(ACLCacheBackend):
+    """Backend using redis.asyncio.Redis compatible client"""
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    async def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        return list(await self.client.mget(keys))
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if ttl is None:
+            await self.client.set(key, value)
+            return
+        await self.client.set(key, value, px=max(int(ttl * 1000), 1))
+
+    async def incr(self, key: str) -> int:
+        return int(await self.client.incr(key))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(key)
+
+
+class ACLCache:
+    """Resolved ACLs keyed by user pk and versioned by generation counters"""
+
+    def __init__(self, backend: ACLCacheBackend, ttl: Optional[float] = DEFAULT_TTL, prefix: str = DEFAULT_PREFIX):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self.global_generation_key = f"{prefix}generation"
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+    def user_key(self, user_pk: PKType) -> str:
+        """Key prefix for the user"""
+        if isinstance(user_pk, uuid.UUID):
+            user_pk = ensure_str(uuid_to_b64(user_pk))
+        return f"{self.prefix}user:{user_pk}"
+
+    async def get(self, user_pk: PKType) -> Tuple[Optional[ACL], bytes]:
+        """Get cached ACL for user (or None) and the current generation, pass that to set() when storing"""
+        user_key = self.user_key(user_pk)
+        global_gen, user_gen, entry = await self.backend.mget(
+            [self.global_generation_key, f"{user_key}:generation", user_key]
+        )
+        generation = b"%d.%d" % (int(global_gen or 0), int(user_gen or 0))
+        if entry is not None:
+            entry_generation, _, data = entry.partition(b":")
+            if entry_generation == generation:
+                self.stats["hits"] += 1
+                return decode_acl(data), generation
+        self.stats["misses"] += 1
+        return None, generation
+
+    async def set(self, user_pk: PKType, acl: ACL, generation: bytes) -> None:
+        """Store the ACL resolved under the given generation (from get())"""
+        await self.backend.set(self.user_key(user_pk), generation + b":" + encode_acl(acl), self.ttl)
+
+    async def bump(self, user_pk: PKType) -> int:
+        """Bump the users generation and delete the cached entry"""
+        user_key = self.user_key(user_pk)
+        generation = await self.backend.incr(f"{user_key}:generation")
+        await self.backend.delete(user_key)
+        return generation
+
+    async def invalidate_all(self) -> int:
+        """Bump the global generation, invalidating all entries (call after changing Role ACLs)"""
+        return await self.backend.incr(self.global_generation_key)
+
+
+def role_set_fingerprint(roles: Iterable[Mapping[str, Any]]) -> bytes:
+    """Digest of the pk, priority and acl_digest (md5 of the ACL JSON, see models.role) of role rows in merge order"""
+    digest = hashlib.blake2b(digest_size=16)
+    for role in roles:
+        digest.update(f"{role['pk']}@{role['priority']}:{role['acl_digest']};".encode("ascii"))
+    return digest.digest()
+
+
+def acl_size(acl: ACL) -> int:
+    """Approximate bytes held by the ACL object (strings are mostly interned so they are not counted)"""
+    items = acl.__root__
+    return (
+        sys.getsizeof(acl)
+        + sys.getsizeof(items)
+        + sum(sys.getsizeof(item) + sys.getsizeof(item.__dict__) for item in items)
+    )
+
+
+class MergeMemo:
+    """Bounded LRU of merged ACLs by role set fingerprint, the returned ACLs are shared and must not be modified"""
+
+    def __init__(self, max_entries: int = DEFAULT_MEMO_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._data: "OrderedDict[bytes, Tuple[ACL, int]]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "bytes_saved": 0}
+
+    def get(self, fingerprint: bytes) -> Optional[ACL]:
+        """Get the merged ACL, marks it recently used"""
+        entry = self._data.get(fingerprint)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self._data.move_to_end(fingerprint)
+        self.stats["hits"] += 1
+        self.stats["bytes_saved"] += entry[1]
+        return entry[0]
+
+    def set(self, fingerprint: bytes, acl: ACL) -> None:
+        """Store merged ACL and evict least recently used over the limit"""
+        self._data[fingerprint] = (acl, acl_size(acl))
+        self._data.move_to_end(fingerprint)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        """Drop all entries (call after changing User.default_acl), stats are kept"""
+        self._data.clear()
+
+    def get_stats(self) -> Dict[str, float]:
+        """Counters plus current entries and bytes, and the dedup ratio (lookups per merge actually done)"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._data),
+            "bytes": sum(size for _, size in self._data.values()),
+            "dedup_ratio": lookups / self.stats["misses"] if self.stats["misses"] else float(lookups),
+        }
+
+
+_CACHE: Optional[ACLCache] = None
+_MERGE_MEMO: Optional[MergeMemo] = MergeMemo()
+
+
+def set_cache(cache: Optional[ACLCache]) -> None:
+    """Set the cache Role.resolve_user_acl uses, None to disable"""
+    global _CACHE  # pylint: disable=W0603
+    _CACHE = cache
+
+
+def get_cache() -> Optional[ACLCache]:
+    """Get the cache (None if not configured)"""
+    return _CACHE
+
+
+def set_merge_memo(memo: Optional[MergeMemo]) -> None:
+    """Set the memo Role.merge_user_acl uses, None to disable"""
+    global _MERGE_MEMO  # pylint: disable=W0603
+    _MERGE_MEMO = memo
+
+
+def get_merge_memo() -> Optional[MergeMemo]:
+    """Get the merge memo (None if disabled)"""
+    return _MERGE_MEMO
@@ -0,0 +1,301 @@
+"""Offline ACL snapshot for resolving user ACLs without database access
+
+export_snapshot() writes every live role with its ACL and every active user-role link (expanded with the roles
+inherited via the role closure) into a single file,
+ACLSnapshot then resolves ACLs from a read-only mmap of that file with the same merge semantics as
+models.Role.merge_user_acl (see schemas.role.merge_acls). Opening only reads the header and the pages of the
+file that are actually used get loaded on demand, they are shared by all processes mapping the same file.
+
+Format (all integers little-endian, offsets are from the start of the file)::
+
+    header, see HEADER
+    default ACL (aclcodec encoded)
+    roles: ROLE records (pk, priority, ACL offset and length) in the order they are referred to by index
+    users: USER records (pk, first link index, link count) sorted by pk for binary search
+    links: LINK records (role index), per user in merge order (see models.Role.iter_effective_roles)
+    role ACLs (aclcodec encoded)
+
+Files are replaced atomically so mapping processes keep using the old inode until they reopen::
+
+    from arkia11nmodels.aclsnapshot import ACLSnapshot
+
+    with ACLSnapshot("/var/lib/arkia11n/acl.snapshot") as snapshot:
+        acl = snapshot.resolve_user_acl(user_pk)
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import uuid
+
+from .schemas.role import ACL, merge_acls
+from .schemas.aclcodec import encode_acl, decode_acl
+
+LOGGER = logging.getLogger(__name__)
+MAGIC = b"A11NSNAP"
+VERSION = 1
+# magic, version, reserved, created (unix time), role count, user count, link count,
+# default ACL offset and length, roles offset, users offset, links offset, total size
+HEADER = struct.Struct("<8sHHdIIIIIIIII")
+ROLE = struct.Struct("<16siII")
+USER = struct.Struct("<16sII")
+LINK = struct.Struct("<I")
+MAX_UINT32 = 0xFFFFFFFF
+PKType = Union[uuid.UUID, str]
+# role pk, priority, ACL
+RoleRow = Tuple[uuid.UUID, int, ACL]
+
+
+def _as_uuid(pk: PKType) -> uuid.UUID:
+    """Make sure we have UUID instance"""
+    if isinstance(pk, uuid.UUID):
+        return pk
+    return uuid.UUID(str(pk))
+
+
+def build_snapshot(
+    default_acl: ACL,
+    roles: Sequence[RoleRow],
+    user_pks: Sequence[PKType],
+    links: Sequence[Tuple[PKType, PKType]],
+    *,
+    created: Optional[float] = None,
+    closure: Sequence[Tuple[PKType, PKType, int]] = (),
+) -> bytes:
+    """Build snapshot file contents, links are (user pk, role pk) and ones to unknown users or roles are skipped
+    (with the roles inherited via them)
+
+    closure is (descendant pk, ancestor pk, depth) rows of the role hierarchy (see models.role.RoleClosure),
+    users get the inherited roles with the same precedence as models.Role.iter_effective_roles.
+    """
+    # pylint: disable=R0913,R0914
+    # Ties broken by pk so the result is deterministic
+    ordered_roles = sorted(roles, key=lambda role: (-role[1], role[0].bytes))
+    role_idx = {role[0]: idx for idx, role in enumerate(ordered_roles)}
+    ancestors: Dict[uuid.UUID, List[Tuple[uuid.UUID, int]]] = {}
+    for descendant_pk, ancestor_pk, depth in closure:
+        ancestors.setdefault(_as_uuid(descendant_pk), []).append((_as_uuid(ancestor_pk), depth))
+    # user pk -> role index -> depth
+    user_depths: Dict[uuid.UUID, Dict[int, int]] = {_as_uuid(pk): {} for pk in user_pks}
+    for user_pk, role_pk in links:
+        user_pk, role_pk = _as_uuid(user_pk), _as_uuid(role_pk)
+        if user_pk not in user_depths:
+            continue
+        if role_pk not in role_idx:  # not live, neither are its ancestors via it
+            continue
+        depths = user_depths[user_pk]
+        for path_pk, depth in [(role_pk, 0)] + ancestors.get(role_pk, []):
+            if path_pk in role_idx and depth < depths.get(role_idx[path_pk], depth + 1):
+                depths[role_idx[path_pk]] = depth
+    # on the same priority the nearer role must come later so it wins the merge
+    user_links = {
+        user_pk: [key[2] for key in sorted((-ordered_roles[idx][1], -depth, idx) for idx, depth in depths.items())]
+        for user_pk, depths in user_depths.items()
+    }
+
+    default_blob = encode_acl(default_acl)
+    acl_blobs = [encode_acl(role[2]) for role in ordered_roles]
+    link_count = sum(len(idxs) for idxs in user_links.values())
+    default_offset = HEADER.size
+    roles_offset = default_offset + len(default_blob)
+    users_offset = roles_offset + ROLE.size * len(ordered_roles)
+    links_offset = users_offset + USER.size * len(user_links)
+    blobs_offset = links_offset + LINK.size * link_count
+    size = blobs_offset + sum(len(blob) for blob in acl_blobs)
+    if size > MAX_UINT32:
+        raise ValueError(f"Snapshot too large ({size} bytes)")
+
+    ret = bytearray(
+        HEADER.pack(
+            MAGIC,
+            VERSION,
+            0,
+            time.time() if created is None else created,
+            len(ordered_roles),
+            len(user_links),
+            link_count,
+            default_offset,
+            len(default_blob),
+            roles_offset,
+            users_offset,
+            links_offset,
+            size,
+        )
+    )
+    ret += default_blob
+    acl_offset = blobs_offset
+    for (role_pk, priority, _), blob in zip(ordered_roles, acl_blobs):
+        ret += ROLE.pack(role_pk.bytes, priority, acl_offset, len(blob))
+        acl_offset += len(blob)
+    first_link = 0
+    ordered_users = sorted(user_links.items(), key=lambda user: user[0].bytes)
+    for user_pk, idxs in ordered_users:
+        ret += USER.pack(user_pk.bytes, first_link, len(idxs))
+        first_link += len(idxs)
+    for _, idxs in ordered_users:
+        for idx in idxs:
+            ret += LINK.pack(idx)
+    for blob in acl_blobs:
+        ret += blob
+    return bytes(ret)
+
+
+def write_snapshot(path: str, data: bytes) -> None:
+    """Write atomically, processes that have the old file mapped keep using it until they reopen"""
+    dirname = os.path.dirname(os.path.abspath(path))
+    fdesc, tmpname = tempfile.mkstemp(dir=dirname, prefix=".aclsnapshot.")
+    try:
+        with os.fdopen(fdesc, "wb") as fpntr:
+            fpntr.write(data)
+            fpntr.flush()
+            os.fsync(fpntr.fileno())
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+async def export_snapshot(path: str) -> Dict[str, int]:  # pylint: disable=R0914
+    """Export live roles, users and active links from the database to path, returns the counts
+
+    Reads within one repeatable read transaction so the roles and links are consistent. When sharded the users and
+    links are read from every shard (each consistent by itself) and the roles from the first one.
+    """
+    # pylint: disable=C0415,C0121 ; # resolving side must not need Gino, "is None" will create invalid query
+    import sqlalchemy as sa
+    from .models import Role, User, routing, sharding
+    from .models.role import UserRole, RoleClosure
+
+    descendants, ancestors = Role.__table__.alias("descendants"), Role.__table__.alias("ancestors")
+
+    async def read() -> Tuple[List[Any], List[Any], List[Any], List[Any]]:
+        async with routing.read_bind().acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                return (
+                    await conn.all(Role.live()),
+                    await conn.all(sa.select([User.pk]).where(User.deleted == None)),
+                    await conn.all(sa.select([UserRole.user, UserRole.role]).where(UserRole.deleted == None)),
+                    await conn.all(
+                        sa.select([RoleClosure.descendant, RoleClosure.ancestor, RoleClosure.depth])
+                        .select_from(
+                            RoleClosure.__table__.join(descendants, descendants.c.pk == RoleClosure.descendant).join(
+                                ancestors, ancestors.c.pk == RoleClosure.ancestor
+                            )
+                        )
+                        .where(sa.and_(descendants.c.deleted == None, ancestors.c.deleted == None))
+                    ),
+                )
+
+    results = await sharding.each_shard(read)
+    role_rows, _, _, closure_rows = results[0]
+    roles = [(role.pk, role.priority, ACL(role.acl)) for role in role_rows]
+    user_pks = [row[0] for result in results for row in result[1]]
+    links = [(row[0], row[1]) for result in results for row in result[2]]
+    closure = [(row[0], row[1], row[2]) for row in closure_rows]
+    data = build_snapshot(User.default_acl, roles, user_pks, links, closure=closure)
+    write_snapshot(path, data)
+    role_count, user_count, link_count = HEADER.unpack_from(data)[4:7]
+    counts = {"roles": role_count, "users": user_count, "links": link_count, "bytes": len(data)}
+    LOGGER.info("Exported ACL snapshot to {}: {}".format(path, counts))
+    return counts
+
+
+class ACLSnapshot:  # pylint: disable=R0902
+    """Read-only view to a snapshot file, raises ValueError if the file is not a valid snapshot"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as fpntr:
+            self._mmap = mmap.mmap(fpntr.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_header()
+        except (ValueError, struct.error) as exc:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a valid ACL snapshot: {exc}") from exc
+        self._role_acls: Dict[int, Tuple[int, ACL]] = {}
+
+    def _parse_header(self) -> None:
+        """Parse and sanity check the header"""
+        (
+            magic,
+            version,
+            _,
+            self.created,
+            self.role_count,
+            self.user_count,
+            self.link_count,
+            default_offset,
+            default_length,
+            self._roles_offset,
+            self._users_offset,
+            self._links_offset,
+            size,
+        ) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Bad magic or unsupported version")
+        if size != len(self._mmap):
+            raise ValueError(f"Size mismatch, expected {size} got {len(self._mmap)}")
+        if (
+            self._users_offset != self._roles_offset + ROLE.size * self.role_count
+            or self._links_offset != self._users_offset + USER.size * self.user_count
+            or self._links_offset + LINK.size * self.link_count > size
+        ):
+            raise ValueError("Inconsistent section offsets")
+        self.default_acl = decode_acl(self._mmap[default_offset : default_offset + default_length])
+
+    def close(self) -> None:
+        """Unmap the file"""
+        self._mmap.close()
+
+    def __enter__(self) -> "ACLSnapshot":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _find_user(self, user_pk: bytes) -> Optional[Tuple[int, int]]:
+        """Binary search the user, returns first link index and count"""
+        low, high = 0, self.user_count
+        while low < high:
+            mid = (low + high) // 2
+            offset = self._users_offset + mid * USER.size
+            found = self._mmap[offset : offset + 16]
+            if found < user_pk:
+                low = mid + 1
+            elif found > user_pk:
+                high = mid
+            else:
+                _, first_link, count = USER.unpack_from(self._mmap, offset)
+                return first_link, count
+        return None
+
+    def _role_acl(self, idx: int) -> Tuple[int, ACL]:
+        """Priority and decoded ACL of the role, decoded ACLs are kept for the lifetime of this object"""
+        if idx not in self._role_acls:
+            _, priority, acl_offset, acl_length = ROLE.unpack_from(self._mmap, self._roles_offset + idx * ROLE.size)
+            self._role_acls[idx] = (priority, decode_acl(self._mmap[acl_offset : acl_offset + acl_length]))
+        return self._role_acls[idx]
+
+    def user_role_pks(self, user_pk: PKType) -> List[uuid.UUID]:
+        """Pks of the users roles in merge order, raises KeyError for users not in the snapshot"""
+        return [
+            uuid.UUID(bytes=ROLE.unpack_from(self._mmap, self._roles_offset + idx * ROLE.size)[0])
+            for idx in self._user_role_idxs(user_pk)
+        ]
+
+    def _user_role_idxs(self, user_pk: PKType) -> List[int]:
+        """Role indexes of the user in merge order"""
+        found = self._find_user(_as_uuid(user_pk).bytes)
+        if found is None:
+            raise KeyError(user_pk)
+        first_link, count = found
+        offset = self._links_offset + first_link * LINK.size
+        return [idx for (idx,) in LINK.iter_unpack(self._mmap[offset : offset + count * LINK.size])]
+
+    def resolve_user_acl(self, user_pk: PKType) -> ACL:
+        """Merged ACL like Role.merge_user_acl, raises KeyError for users not in the snapshot (unknown or deleted)"""
+        return merge_acls(self.default_acl, (self._role_acl(idx) for idx in self._user_role_idxs(user_pk)))
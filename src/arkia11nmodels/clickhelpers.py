@@ -1,18 +1,27 @@
 """Helpers to use with click"""
-from typing import Any, List, Dict, Union, Type, cast
+from typing import Any, List, Dict, Union, Type, TYPE_CHECKING, Callable, Awaitable, Sequence, Optional, TextIO
+from typing import TypeVar, Iterable
+import asyncio
 import logging
 import uuid
 import json
 import datetime
+import time
 
 import click
 from libadvian.binpackers import b64_to_uuid, ensure_utf8, ensure_str, uuid_to_b64
 
-from . import dbconfig, models
-from .models.base import BaseModel
+from . import models
+
+if TYPE_CHECKING:
+    from .models.base import BaseModel
 
 
 LOGGER = logging.getLogger(__name__)
+DEFAULT_PARALLEL = 8
+ItemType = TypeVar("ItemType")  # pylint: disable=C0103
+ResultType = TypeVar("ResultType")  # pylint: disable=C0103
+
 
 # FIXME: move to libadvian.hashinghelpers
 class DateTimeEncoder(json.JSONEncoder):
@@ -37,39 +46,173 @@ class DBTypesEncoder(DateTimeEncoder, UUIDEncoder):
     """All the encoders we need"""
 
 
-async def bind_db() -> None:
-    """Bind the db"""
-    await models.db.set_bind(dbconfig.DSN)
+async def bind_db(max_size: Optional[int] = None) -> None:
+    """Bind the db, max_size overrides dbconfig.POOL_MAX_SIZE"""
+    from . import dbconfig  # pylint: disable=C0415 ; # deferred, reads .env and imports SQLAlchemy
+    from .models.tenants import connect_kwargs  # pylint: disable=C0415
+
+    if max_size is None:
+        max_size = dbconfig.POOL_MAX_SIZE
+    kwargs = {"min_size": min(dbconfig.POOL_MIN_SIZE, max_size), "max_size": max_size, **connect_kwargs()}
+    await models.db.set_bind(dbconfig.DSN, **kwargs)
+    if dbconfig.REPLICA_DSNS:
+        from .models import routing  # pylint: disable=C0415
+
+        await routing.bind_replicas(**kwargs)
+    if dbconfig.SHARD_DSNS:
+        from .models import sharding  # pylint: disable=C0415
+
+        await sharding.bind_shards(**kwargs)
+
+
+async def unbind_db() -> None:
+    """Close the pools bind_db() created"""
+    from .models import routing, sharding  # pylint: disable=C0415
+
+    await sharding.close_shards()
+    await routing.close_replicas()
+    await models.db.pop_bind().close()
+
+
+def run_with_db(coro_factory: Callable[[], Awaitable[ResultType]], parallel: int = 1) -> ResultType:
+    """Bind the db once with pool large enough for parallel operations, run the coroutine and close the pool"""
+
+    from .models.loader import loader_scope  # pylint: disable=C0415
+
+    async def runner() -> ResultType:
+        await bind_db(max_size=max(parallel, 1))
+        try:
+            with loader_scope():
+                return await coro_factory()
+        finally:
+            await unbind_db()
+
+    return asyncio.get_event_loop().run_until_complete(runner())
+
+
+def read_ids(ids: Iterable[str], infile: Optional[TextIO] = None) -> List[str]:
+    """Combine ids from arguments and file (one per line, empty lines and #-comments are skipped)"""
+    ret = list(ids)
+    if infile:
+        for line in infile:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            ret.append(line)
+    return ret
+
 
+def read_json_lines(infile: TextIO) -> List[Dict[str, Any]]:
+    """Read JSON objects from file, one per line, empty lines and #-comments are skipped"""
+    ret = []
+    for line in infile:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        ret.append(json.loads(line))
+    return ret
 
-async def get_by_uuid(klass: Type[BaseModel], pkin: Union[bytes, str]) -> BaseModel:
-    """Get a db object by its klass and UUID (base64 or hex str)"""
+
+async def run_batch(
+    func: Callable[[ItemType], Awaitable[ResultType]], items: Sequence[ItemType], parallel: int = DEFAULT_PARALLEL
+) -> List[Union[ResultType, BaseException]]:
+    """Run func for each item with at most parallel calls in flight, results (or exceptions) are in item order
+
+    The calls share a loader_scope() so their get_by_uuid() lookups are coalesced.
+    """
+    from .models.loader import loader_scope  # pylint: disable=C0415
+
+    semaphore = asyncio.Semaphore(max(parallel, 1))
+
+    async def limited(item: ItemType) -> ResultType:
+        async with semaphore:
+            return await func(item)
+
+    with loader_scope():
+        return list(await asyncio.gather(*(limited(item) for item in items), return_exceptions=True))
+
+
+def echo_batch_results(items: Sequence[Any], results: Sequence[Union[Any, BaseException]]) -> int:
+    """Print results as JSON lines and errors to stderr, returns number of errors"""
+    errors = 0
+    for item, result in zip(items, results):
+        if isinstance(result, BaseException):
+            errors += 1
+            click.echo(f"{item}: {result!r}", err=True)
+            continue
+        if result is None:
+            continue
+        click.echo(json.dumps(result, cls=DBTypesEncoder))
+    return errors
+
+
+def echo_timing(label: str, count: int, started: float) -> None:
+    """Report elapsed time since started (time.monotonic()) and rate to stderr"""
+    elapsed = time.monotonic() - started
+    rate = count / elapsed if elapsed > 0 else 0.0
+    click.echo(f"{label}: {count} operations in {elapsed:.3f}s ({rate:.1f}/s)", err=True)
+
+
+def batch_command(
+    func: Callable[[ItemType], Awaitable[Any]],
+    items: Sequence[ItemType],
+    parallel: int = DEFAULT_PARALLEL,
+    timing: bool = False,
+    label: str = "batch",
+) -> int:
+    """Bind db, run func for items concurrently, print results and optionally timing, return number of errors"""
+    started = time.monotonic()
+    results = run_with_db(lambda: run_batch(func, items, parallel), parallel)
+    errors = echo_batch_results(items, results)
+    if timing:
+        echo_timing(label, len(items), started)
+    return errors
+
+
+def parse_uuid(pkin: Union[bytes, str]) -> uuid.UUID:
+    """Parse UUID from base64 or hex str"""
     try:
-        getpk = b64_to_uuid(ensure_utf8(pkin))
+        return b64_to_uuid(ensure_utf8(pkin))
     except ValueError:
-        getpk = uuid.UUID(ensure_str(pkin))
-    obj = await klass.get(getpk)
+        return uuid.UUID(ensure_str(pkin))
+
+
+async def get_by_uuid(klass: Type["BaseModel"], pkin: Union[bytes, str], include_deleted: bool = False) -> "BaseModel":
+    """Get a db object by its klass and UUID (base64 or hex str), reads from replica if configured
+
+    Concurrent calls within a loader_scope() (run_batch(), run_with_db() and DBConnectionMiddleware requests enter
+    one) are coalesced to one query per klass, see models.loader.
+    """
+    from .models.loader import get_loader  # pylint: disable=C0415
+
+    obj = await get_loader(klass, include_deleted).load(parse_uuid(pkin))
     if not obj:
         raise ValueError(f"{klass} with {ensure_str(pkin)} not found")
-    return cast(BaseModel, obj)
+    return obj
 
 
-async def get_and_print_json(klass: Type[BaseModel], pkin: Union[bytes, str]) -> None:
+async def get_and_print_json(klass: Type["BaseModel"], pkin: Union[bytes, str]) -> None:
     """helper to get and dump as JSON object of type klass"""
     obj = await get_by_uuid(klass, pkin)
     click.echo(json.dumps(obj.to_dict(), cls=DBTypesEncoder))
 
 
-async def create_and_print_json(klass: Type[BaseModel], init_kwargs: Dict[str, Any]) -> None:
+async def create_and_print_json(klass: Type["BaseModel"], init_kwargs: Dict[str, Any]) -> None:
     """helper to create and dump as JSON object of type klass with init args from init_kwargs"""
     obj = klass(**init_kwargs)
     await obj.create()
     click.echo(json.dumps(obj.to_dict(), cls=DBTypesEncoder))
 
 
-async def list_and_print_json(klass: Type[BaseModel]) -> None:
-    """helper to list and dump as JSON all objects of type klass"""
-    dbobjs = await models.db.all(klass.query)
+async def list_and_print_json(klass: Type["BaseModel"], include_deleted: bool = False) -> None:
+    """helper to list and dump as JSON all (not soft-deleted unless include_deleted) objects of type klass"""
+    from .models import routing, sharding  # pylint: disable=C0415
+
+    query = klass.query if include_deleted else klass.live()
+    if issubclass(klass, sharding.UserShardedModel):
+        dbobjs = [obj for objs in await sharding.each_shard(lambda: routing.read_bind().all(query)) for obj in objs]
+    else:
+        dbobjs = await routing.read_bind().all(query)
     ret: List[Dict[str, Any]] = []
     for dbobj in dbobjs:
         ret.append(dbobj.to_dict())
@@ -1,24 +1,50 @@
 """CLI entrypoints for arkia11nmodels"""
-from typing import Any
+from typing import Any, Sequence, Optional, TextIO, Dict, List, Callable, Awaitable
 import logging
 import asyncio
+import datetime
+import json
+import time
 
 import click
 from libadvian.logging import init_logging
 
-from arkia11nmodels import __version__, dbconfig, models
-from arkia11nmodels.dbdevhelpers import create_all, drop_all
+from arkia11nmodels import __version__, models
+from arkia11nmodels.clickhelpers import (
+    DEFAULT_PARALLEL,
+    DBTypesEncoder,
+    batch_command,
+    echo_batch_results,
+    echo_timing,
+    get_by_uuid,
+    list_and_print_json,
+    parse_uuid,
+    read_ids,
+    read_json_lines,
+    run_batch,
+    run_with_db,
+)
+
+# NOTE: Subcommands import dbconfig, models etc inside the command functions so that
+#       things like --version do not pay for Gino, SQLAlchemy and pydantic imports
 
 
 LOGGER = logging.getLogger(__name__)
+IDS_FILE_HELP = "Read ids from file, one per line"
+DELETED_HELP = "Include soft-deleted objects"
+SCHEMA_HELP = "Tenant schema (default DB_SCHEMA), others need DB_SCHEMA_FROM_SEARCH_PATH"
 
 
 @click.group()
 @click.version_option(version=__version__)
 @click.option("-l", "--loglevel", help="Python log level, 10=DEBUG, 20=INFO, 30=WARNING, 40=CRITICAL", default=30)
 @click.option("-v", "--verbose", count=True, help="Shorthand for info/debug loglevel (-v/-vv)")
+@click.option(
+    "-j", "--parallel", help="How many operations to run concurrently (also the pool size)", default=DEFAULT_PARALLEL
+)
+@click.option("--timing", is_flag=True, help="Report elapsed time and rate to stderr")
 @click.pass_context
-def cligroup(ctx: Any, loglevel: int, verbose: int) -> None:
+def cligroup(ctx: Any, loglevel: int, verbose: int, parallel: int, timing: bool) -> None:
     """models cli for quick and dirty devel ops, use alembic for actual migrations"""
     if verbose == 1:
         loglevel = 20
@@ -27,30 +53,496 @@ def cligroup(ctx: Any, loglevel: int, verbose: int) -> None:
     logging.getLogger("").setLevel(loglevel)
     LOGGER.setLevel(loglevel)
     ctx.ensure_object(dict)
+    ctx.obj["parallel"] = parallel
+    ctx.obj["timing"] = timing
 
 
 @cligroup.command()
-def create_tables() -> None:
+@click.option("--schema", help=SCHEMA_HELP)
+def create_tables(schema: Optional[str]) -> None:
     """Create tables"""
 
+    # pylint: disable=C0415
+    from arkia11nmodels import dbconfig
+    from arkia11nmodels.dbdevhelpers import create_all
+
     async def runner() -> None:
         await models.db.set_bind(dbconfig.DSN)
-        await create_all()
+        await create_all(schema)
 
     asyncio.get_event_loop().run_until_complete(runner())
 
 
 @cligroup.command()
-def drop_tables() -> None:
+@click.option("--schema", help=SCHEMA_HELP)
+def drop_tables(schema: Optional[str]) -> None:
     """Remove all tables"""
 
+    # pylint: disable=C0415
+    from arkia11nmodels import dbconfig
+    from arkia11nmodels.dbdevhelpers import drop_all
+
     async def runner() -> None:
         await models.db.set_bind(dbconfig.DSN)
-        await drop_all()
+        await drop_all(schema)
 
     asyncio.get_event_loop().run_until_complete(runner())
 
 
+def run_batch_in_ctx(ctx: Any, label: str, func: Callable[[Any], Awaitable[Any]], items: Sequence[Any]) -> None:
+    """Run the batch with parallelism and timing from context, exit with error if any item failed"""
+    errors = batch_command(func, items, parallel=ctx.obj["parallel"], timing=ctx.obj["timing"], label=label)
+    if errors:
+        ctx.exit(1)
+
+
+def add_crud_commands(group: click.Group, model_name: str) -> None:
+    """Add the get, list and delete commands to group, model class is resolved from models by name when run"""
+    # pylint: disable=W0612 ; # the commands are registered by the decorators
+
+    @group.command(name="get")
+    @click.argument("pks", nargs=-1)
+    @click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+    @click.option("--deleted", is_flag=True, help=DELETED_HELP)
+    @click.pass_context
+    def get_cmd(ctx: Any, pks: Sequence[str], infile: Optional[TextIO], deleted: bool) -> None:
+        """Get objects by pk (base64 or hex), prints one JSON object per line"""
+        klass = getattr(models, model_name)
+
+        async def get_one(pkin: str) -> Dict[str, Any]:
+            obj = await get_by_uuid(klass, pkin, include_deleted=deleted)
+            return dict(obj.to_dict())
+
+        run_batch_in_ctx(ctx, f"{model_name} get", get_one, read_ids(pks, infile))
+
+    @group.command(name="list")
+    @click.option("--deleted", is_flag=True, help=DELETED_HELP)
+    @click.pass_context
+    def list_cmd(ctx: Any, deleted: bool) -> None:
+        """List all objects as JSON array"""
+        klass = getattr(models, model_name)
+        started = time.monotonic()
+        run_with_db(lambda: list_and_print_json(klass, include_deleted=deleted))
+        if ctx.obj["timing"]:
+            echo_timing(f"{model_name} list", 1, started)
+
+    @group.command(name="delete")
+    @click.argument("pks", nargs=-1)
+    @click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+    @click.option("--soft", is_flag=True, help="Only mark deleted, purge removes them after the retention period")
+    @click.pass_context
+    def delete_cmd(ctx: Any, pks: Sequence[str], infile: Optional[TextIO], soft: bool) -> None:
+        """Delete objects by pk (base64 or hex)"""
+        klass = getattr(models, model_name)
+
+        async def delete_one(pkin: str) -> Dict[str, Any]:
+            obj = await get_by_uuid(klass, pkin, include_deleted=not soft)
+            if soft:
+                await obj.soft_delete()
+            else:
+                await obj.delete()
+            return {"pk": obj.pk, "deleted": True}
+
+        run_batch_in_ctx(ctx, f"{model_name} delete", delete_one, read_ids(pks, infile))
+
+
+@cligroup.command()
+@click.option("--retention-days", type=int, help="Purge rows deleted more than this many days ago")
+@click.option("--batch-size", type=int, help="Rows to delete per transaction")
+@click.pass_context
+def purge(ctx: Any, retention_days: Optional[int], batch_size: Optional[int]) -> None:
+    """Hard-delete soft-deleted objects older than the retention (DB_PURGE_RETENTION_DAYS), prints counts as JSON"""
+    from arkia11nmodels.models.purge import purge_deleted  # pylint: disable=C0415
+
+    retention = datetime.timedelta(days=retention_days) if retention_days is not None else None
+    started = time.monotonic()
+    counts = run_with_db(lambda: purge_deleted(retention, batch_size))
+    click.echo(json.dumps(counts))
+    if ctx.obj["timing"]:
+        echo_timing("purge", sum(counts.values()), started)
+
+
+@cligroup.command()
+@click.option("--users", type=int, default=100, help="How many users to seed (reused on later runs)")
+@click.option("--roles", type=int, default=8, help="How many roles to seed, each inherits the previous one")
+@click.option("--roles-per-user", type=int, default=2, help="Roles assigned to each seeded user")
+@click.option("-n", "--logins", type=int, default=1000, help="How many logins to run")
+@click.option("-c", "--concurrency", type=int, default=DEFAULT_PARALLEL, help="Logins in flight at most")
+@click.option("--rate", type=float, default=0.0, help="Logins started per second, 0 for as fast as possible")
+@click.option("--pool-size", type=int, help="Connection pool size (default -j)")
+@click.option("-o", "--output", type=click.File("w"), help="Write the report JSON to file instead of stdout")
+@click.option("--cleanup", is_flag=True, help="Delete the seeded users, tokens and roles afterwards")
+@click.pass_context
+def loadtest(  # pylint: disable=R0913
+    ctx: Any,
+    *,
+    users: int,
+    roles: int,
+    roles_per_user: int,
+    logins: int,
+    concurrency: int,
+    rate: float,
+    pool_size: Optional[int],
+    output: Optional[TextIO],
+    cleanup: bool,
+) -> None:
+    """Login storm against the database, prints latency percentiles per stage as JSON (see loadtest module)"""
+    from arkia11nmodels import loadtest as storm  # pylint: disable=C0415
+
+    pool_size = pool_size or ctx.obj["parallel"]
+
+    async def run() -> Dict[str, Any]:
+        emails = await storm.seed_users(users, roles, roles_per_user, pool_size)
+        try:
+            config = {"roles": roles, "roles_per_user": roles_per_user, "pool_size": pool_size}
+            return await storm.run_storm(emails, logins, concurrency, rate, config)
+        finally:
+            if cleanup:
+                LOGGER.info("Cleaned up {}".format(await storm.cleanup()))
+
+    report = run_with_db(run, pool_size)
+    click.echo(json.dumps(report, indent=2), file=output)
+    if report["errors"]:
+        ctx.exit(1)
+
+
+@cligroup.group()
+def tenant() -> None:
+    """Tenant schemas in one database (see models.tenants)"""
+
+
+@tenant.command(name="migrate")
+@click.argument("schemas", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help="Read schema names from file, one per line")
+@click.option("--revision", default="head", help="Alembic revision to upgrade to")
+@click.option("-c", "--config", "alembic_config", help="Alembic config file (default alembic.ini)")
+@click.pass_context
+def tenant_migrate(
+    ctx: Any, schemas: Sequence[str], infile: Optional[TextIO], revision: str, alembic_config: Optional[str]
+) -> None:
+    """Run the alembic migrations for the schemas in parallel, prints exit codes as JSON"""
+    from arkia11nmodels.models.tenants import migrate_schemas, validate_schema  # pylint: disable=C0415
+
+    try:
+        names = [validate_schema(name) for name in read_ids(schemas, infile)]
+    except ValueError as exc:
+        raise click.BadParameter(str(exc)) from exc
+    alembic_args = ["-c", alembic_config] if alembic_config else []
+    started = time.monotonic()
+    codes = asyncio.get_event_loop().run_until_complete(
+        migrate_schemas(names, ctx.obj["parallel"], revision, alembic_args)
+    )
+    click.echo(json.dumps(codes))
+    if ctx.obj["timing"]:
+        echo_timing("tenant migrate", len(names), started)
+    if any(codes.values()):
+        ctx.exit(1)
+
+
+@cligroup.group()
+def snapshot() -> None:
+    """Offline ACL snapshots for nodes without database access"""
+
+
+@snapshot.command(name="export")
+@click.argument("path")
+@click.pass_context
+def snapshot_export(ctx: Any, path: str) -> None:
+    """Export roles, ACLs and user-role links to snapshot file, prints counts as JSON"""
+    from arkia11nmodels.aclsnapshot import export_snapshot  # pylint: disable=C0415
+
+    started = time.monotonic()
+    counts = run_with_db(lambda: export_snapshot(path))
+    click.echo(json.dumps(counts))
+    if ctx.obj["timing"]:
+        echo_timing("snapshot export", counts["links"], started)
+
+
+@snapshot.command(name="acl")
+@click.argument("path")
+@click.argument("userpks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.pass_context
+def snapshot_acl(ctx: Any, path: str, userpks: Sequence[str], infile: Optional[TextIO]) -> None:
+    """Resolve merged ACLs for users from snapshot file (no database needed)"""
+    from arkia11nmodels.aclsnapshot import ACLSnapshot  # pylint: disable=C0415
+
+    pks = read_ids(userpks, infile)
+    started = time.monotonic()
+    results: List[Any] = []
+    with ACLSnapshot(path) as acl_snapshot:
+        for pkin in pks:
+            try:
+                user_pk = parse_uuid(pkin)
+                results.append({"user": user_pk, "acl": acl_snapshot.resolve_user_acl(user_pk).dict()})
+            except (ValueError, KeyError) as exc:
+                results.append(exc)
+    errors = echo_batch_results(pks, results)
+    if ctx.obj["timing"]:
+        echo_timing("snapshot acl", len(pks), started)
+    if errors:
+        ctx.exit(1)
+
+
+@cligroup.group()
+def user() -> None:
+    """Manage users"""
+
+
+@cligroup.group()
+def role() -> None:
+    """Manage roles"""
+
+
+@cligroup.group()
+def token() -> None:
+    """Manage tokens"""
+
+
+@cligroup.group()
+def link() -> None:
+    """Manage user-role links"""
+
+
+add_crud_commands(user, "User")
+add_crud_commands(role, "Role")
+add_crud_commands(token, "Token")
+
+
+def create_from_schema(ctx: Any, model_name: str, schema_name: str, objs: List[Dict[str, Any]]) -> None:
+    """Validate objs with the named schema and create model instances, prints one JSON object per line"""
+    # pylint: disable=C0415
+    from arkia11nmodels import schemas
+
+    klass = getattr(models, model_name)
+    schema = getattr(schemas, schema_name)
+    validated = [schema.parse_obj(obj).dict() for obj in objs]
+
+    async def create_one(init_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        obj = klass(**init_kwargs)
+        await obj.create()
+        return dict(obj.to_dict())
+
+    run_batch_in_ctx(ctx, f"{model_name} create", create_one, validated)
+
+
+@user.command(name="create")
+@click.option("--email", help="Email address")
+@click.option("--displayname", help="Display name, defaults to email")
+@click.option("--sms", help="SMS number")
+@click.option("-f", "--file", "infile", type=click.File("r"), help="Read user objects from file, one JSON per line")
+@click.pass_context
+def user_create(
+    ctx: Any, email: Optional[str], displayname: Optional[str], sms: Optional[str], infile: Optional[TextIO]
+) -> None:
+    """Create users"""
+    objs = read_json_lines(infile) if infile else []
+    if email:
+        objs.append({"email": email, "displayname": displayname, "sms": sms})
+    create_from_schema(ctx, "User", "UserCreate", objs)
+
+
+@user.command(name="search")
+@click.argument("term")
+@click.option("-n", "--limit", type=int, default=20, help="Max number of users to return")
+@click.pass_context
+def user_search(ctx: Any, term: str, limit: int) -> None:
+    """Search users by part of email or displayname, prints best matches first as JSON array"""
+
+    async def runner() -> List[Dict[str, Any]]:
+        return [dict(user_obj.to_dict()) for user_obj in await models.User.search(term, limit)]
+
+    started = time.monotonic()
+    found = run_with_db(runner)
+    click.echo(json.dumps(found, cls=DBTypesEncoder))
+    if ctx.obj["timing"]:
+        echo_timing("User search", 1, started)
+
+
+@role.command(name="create")
+@click.option("--displayname", help="Name of the role")
+@click.option("--priority", type=int, help="Merge priority, lower is more important")
+@click.option("--acl", help="ACL as JSON list of ACLItems")
+@click.option("-f", "--file", "infile", type=click.File("r"), help="Read role objects from file, one JSON per line")
+@click.pass_context
+def role_create(
+    ctx: Any, displayname: Optional[str], priority: Optional[int], acl: Optional[str], infile: Optional[TextIO]
+) -> None:
+    """Create roles"""
+    objs = read_json_lines(infile) if infile else []
+    if displayname:
+        obj: Dict[str, Any] = {"displayname": displayname}
+        if priority is not None:
+            obj["priority"] = priority
+        if acl:
+            obj["acl"] = json.loads(acl)
+        objs.append(obj)
+    create_from_schema(ctx, "Role", "RoleCreate", objs)
+
+
+@role.command(name="acl")
+@click.argument("userpks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.pass_context
+def role_acl(ctx: Any, userpks: Sequence[str], infile: Optional[TextIO]) -> None:
+    """Resolve merged ACLs for users"""
+
+    async def resolve_one(pkin: str) -> Dict[str, Any]:
+        user_obj = await get_by_uuid(models.User, pkin)
+        acl = await models.Role.resolve_user_acl(user_obj)
+        return {"user": user_obj.pk, "acl": acl.dict()}
+
+    run_batch_in_ctx(ctx, "Role acl", resolve_one, read_ids(userpks, infile))
+
+
+@role.command(name="inherit")
+@click.argument("rolepk")
+@click.argument("parentpks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.option("--remove", is_flag=True, help="Stop inheriting from the parents")
+@click.pass_context
+def role_inherit(ctx: Any, rolepk: str, parentpks: Sequence[str], infile: Optional[TextIO], remove: bool) -> None:
+    """Make role inherit the ACLs of parent roles"""
+
+    async def inherit_one(pkin: str) -> Dict[str, Any]:
+        role_obj = await get_by_uuid(models.Role, rolepk)
+        parent_obj = await get_by_uuid(models.Role, pkin)
+        if remove:
+            changed = await role_obj.remove_parent(parent_obj)
+        else:
+            changed = await role_obj.add_parent(parent_obj)
+        return {"role": role_obj.pk, "parent": parent_obj.pk, "changed": changed}
+
+    run_batch_in_ctx(ctx, "Role inherit", inherit_one, read_ids(parentpks, infile))
+
+
+@token.command(name="create")
+@click.argument("userpks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.option("--expires", type=float, help="Seconds until expiry, default is Token default")
+@click.option("--redirect", help="Where to redirect user after they have been issued JWT")
+@click.pass_context
+def token_create(
+    ctx: Any, userpks: Sequence[str], infile: Optional[TextIO], expires: Optional[float], redirect: Optional[str]
+) -> None:
+    """Create tokens for users (sent_to is the users email)"""
+    import pendulum  # pylint: disable=C0415
+
+    duration = pendulum.duration(seconds=expires) if expires is not None else None
+
+    async def create_one(pkin: str) -> Dict[str, Any]:
+        user_obj = await get_by_uuid(models.User, pkin)
+        token_obj = models.Token.for_user(user_obj, duration)
+        token_obj.sent_to = user_obj.email
+        if redirect:
+            token_obj.redirect = redirect
+        await token_obj.create()
+        return dict(token_obj.to_dict())
+
+    run_batch_in_ctx(ctx, "Token create", create_one, read_ids(userpks, infile))
+
+
+@token.command(name="invite")
+@click.argument("rolepk")
+@click.option("--expires", type=float, help="Seconds until expiry, default is Token default")
+@click.option("--redirect", help="Where to redirect user after they have been issued JWT")
+@click.pass_context
+def token_invite(ctx: Any, rolepk: str, expires: Optional[float], redirect: Optional[str]) -> None:
+    """Create tokens for all users of the role in bulk (sent_to is the users email)"""
+    import pendulum  # pylint: disable=C0415
+
+    duration = pendulum.duration(seconds=expires) if expires is not None else None
+    started = time.monotonic()
+
+    async def runner() -> List[Any]:
+        role_obj = await get_by_uuid(models.Role, rolepk)
+        users = role_obj.iter_role_user_records(("pk", "email"))
+        return list(await models.Token.issue_many(users, expires=duration, redirect=redirect))
+
+    tokens = run_with_db(runner)
+    for token_obj in tokens:
+        click.echo(json.dumps(token_obj.to_dict(), cls=DBTypesEncoder))
+    if ctx.obj["timing"]:
+        echo_timing("Token invite", len(tokens), started)
+
+
+def link_batch(ctx: Any, label: str, rolepk: str, userpks: Sequence[str], remove: bool) -> None:
+    """Assign or remove role for all the users over one bind"""
+    started = time.monotonic()
+
+    async def runner() -> List[Any]:
+        role_obj = await get_by_uuid(models.Role, rolepk)
+
+        async def link_one(pkin: str) -> Dict[str, Any]:
+            user_obj = await get_by_uuid(models.User, pkin)
+            if remove:
+                changed = await role_obj.remove_from(user_obj)
+            else:
+                changed = await role_obj.assign_to(user_obj)
+            return {"role": role_obj.pk, "user": user_obj.pk, "changed": changed}
+
+        return await run_batch(link_one, userpks, ctx.obj["parallel"])
+
+    results = run_with_db(runner, ctx.obj["parallel"])
+    errors = echo_batch_results(userpks, results)
+    if ctx.obj["timing"]:
+        echo_timing(label, len(userpks), started)
+    if errors:
+        ctx.exit(1)
+
+
+@link.command(name="add")
+@click.argument("rolepk")
+@click.argument("userpks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.pass_context
+def link_add(ctx: Any, rolepk: str, userpks: Sequence[str], infile: Optional[TextIO]) -> None:
+    """Assign role to users"""
+    link_batch(ctx, "link add", rolepk, read_ids(userpks, infile), remove=False)
+
+
+@link.command(name="remove")
+@click.argument("rolepk")
+@click.argument("userpks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.pass_context
+def link_remove(ctx: Any, rolepk: str, userpks: Sequence[str], infile: Optional[TextIO]) -> None:
+    """Remove role from users"""
+    link_batch(ctx, "link remove", rolepk, read_ids(userpks, infile), remove=True)
+
+
+@link.command(name="users")
+@click.argument("rolepks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.option("-c", "--columns", help="Comma separated User columns to include (default all)")
+@click.pass_context
+def link_users(ctx: Any, rolepks: Sequence[str], infile: Optional[TextIO], columns: Optional[str]) -> None:
+    """List users that have the roles"""
+
+    async def list_one(pkin: str) -> Dict[str, Any]:
+        role_obj = await get_by_uuid(models.Role, pkin)
+        names = columns.split(",") if columns else models.User.__table__.c.keys()
+        users = await role_obj.list_role_user_records(names)
+        return {"role": role_obj.pk, "users": [record._asdict() for record in users]}
+
+    run_batch_in_ctx(ctx, "link users", list_one, read_ids(rolepks, infile))
+
+
+@link.command(name="roles")
+@click.argument("userpks", nargs=-1)
+@click.option("-f", "--file", "infile", type=click.File("r"), help=IDS_FILE_HELP)
+@click.pass_context
+def link_roles(ctx: Any, userpks: Sequence[str], infile: Optional[TextIO]) -> None:
+    """List roles the users have"""
+
+    async def list_one(pkin: str) -> Dict[str, Any]:
+        user_obj = await get_by_uuid(models.User, pkin)
+        roles = await models.Role.list_user_roles(user_obj)
+        return {"user": user_obj.pk, "roles": [role_obj.to_dict() for role_obj in roles]}
+
+    run_batch_in_ctx(ctx, "link roles", list_one, read_ids(userpks, infile))
+
+
 def arkia11nmodels_cli() -> None:
     """models cli for quick and dirty devel ops, use alembic for actual migrations"""
     init_logging(logging.WARNING)
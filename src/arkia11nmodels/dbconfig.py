@@ -4,7 +4,7 @@ import logging
 
 from sqlalchemy.engine.url import URL, make_url
 from starlette.config import Config
-from starlette.datastructures import Secret
+from starlette.datastructures import Secret, CommaSeparatedStrings
 
 LOGGER = logging.getLogger(__name__)
 
@@ -36,6 +36,15 @@ SSL = config("DB_SSL", cast=str, default="prefer")  # see asyncpg.connect()
 USE_CONNECTION_FOR_REQUEST = config("DB_USE_CONNECTION_FOR_REQUEST", cast=bool, default=True)
 RETRY_LIMIT = config("DB_RETRY_LIMIT", cast=int, default=1)
 RETRY_INTERVAL = config("DB_RETRY_INTERVAL", cast=int, default=1)
+PREPARED_STATEMENTS = config("DB_PREPARED_STATEMENTS", cast=bool, default=True)  # see models.prepared
+REPLICA_DSNS = config("DB_REPLICA_DSNS", cast=CommaSeparatedStrings, default="")  # see models.routing
+REPLICA_PIN_SECONDS = config("DB_REPLICA_PIN_SECONDS", cast=float, default=5.0)
+SHARD_DSNS = config("DB_SHARD_DSNS", cast=CommaSeparatedStrings, default="")  # see models.sharding
+PURGE_RETENTION_DAYS = config("DB_PURGE_RETENTION_DAYS", cast=int, default=30)  # see models.purge
+PURGE_BATCH_SIZE = config("DB_PURGE_BATCH_SIZE", cast=int, default=1000)
+SCHEMA = config("DB_SCHEMA", default="a11n")  # see models.tenants
+SCHEMA_FROM_SEARCH_PATH = config("DB_SCHEMA_FROM_SEARCH_PATH", cast=bool, default=False)
+TIME_ORDERED_PKS = config("DB_TIME_ORDERED_PKS", cast=bool, default=False)  # see models.base.uuid7
 
 LOGGER.debug("DSN={}".format(DSN))
 LOGGER.debug("HOST={}".format(HOST))
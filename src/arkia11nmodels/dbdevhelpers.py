@@ -1,16 +1,40 @@
 """DB related helpers for development"""
+from typing import Optional
+import logging
+
 import sqlalchemy
+from asyncpg.exceptions import PostgresError
+
+from . import dbconfig, models
+from .models.tenants import tenant_scope
+
+LOGGER = logging.getLogger(__name__)
+
 
-from . import models
+async def enable_trgm() -> bool:
+    """Enable pg_trgm (needed by User.search), returns False if the extension is not available"""
+    try:
+        await models.db.status("CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public")
+    except PostgresError as exc:
+        LOGGER.warning("Could not enable pg_trgm, User.search will not work: {}".format(exc))
+        return False
+    return True
 
 
-async def create_all() -> None:
-    """Create all schemas and tables"""
-    await models.db.status(sqlalchemy.schema.CreateSchema("a11n"))
-    await models.db.gino.create_all()
+async def create_all(schema: Optional[str] = None) -> None:
+    """Create the schema (default DB_SCHEMA) and tables, other schemas need DB_SCHEMA_FROM_SEARCH_PATH"""
+    models.load_all()
+    schema = schema or dbconfig.SCHEMA
+    await enable_trgm()
+    async with tenant_scope(schema):
+        await models.db.status(sqlalchemy.schema.CreateSchema(schema))
+        await models.db.gino.create_all()
 
 
-async def drop_all() -> None:
-    """Drop all tables and schemas"""
-    await models.db.gino.drop_all()
-    await models.db.status(sqlalchemy.schema.DropSchema("a11n"))
+async def drop_all(schema: Optional[str] = None) -> None:
+    """Drop all tables and the schema (default DB_SCHEMA)"""
+    models.load_all()
+    schema = schema or dbconfig.SCHEMA
+    async with tenant_scope(schema):
+        await models.db.gino.drop_all()
+        await models.db.status(sqlalchemy.schema.DropSchema(schema))
@@ -0,0 +1,188 @@
+"""Compact JWT claims from resolved ACLs, signed with HS256 and cached
+
+The ACL goes to the "acl" claim: globally granted privileges of the codebook as a bitset, targeted grants and
+denies as lists of targets by privilege code and privileges not in the codebook by name. Global denies and inherits
+are left out, anything not granted is denied. The claims are deterministic for the same ACL so the issued times are
+rounded to the expiry bucket and the signed JWTs are cached by subject, ACL fingerprint and bucket::
+
+    builder = ClaimsBuilder(secret, PRIVILEGES, lifetime=900)
+    jwt = await builder.issue_for_user(user)
+    ...
+    acl = builder.acl_from_claims(builder.verify(jwt))  # on the receiving side, same codebook and secret
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from collections import OrderedDict
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+import uuid
+
+from libadvian.binpackers import ensure_str, uuid_to_b64
+
+from .schemas.role import ACL, ACLItem
+from .schemas.aclcodec import encode_acl
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_LIFETIME = 15 * 60
+DEFAULT_BUCKET = 60
+DEFAULT_MAX_ENTRIES = 10000
+HEADER = {"alg": "HS256", "typ": "JWT"}
+PKType = Union[uuid.UUID, str]
+
+
+def b64url(data: bytes) -> str:
+    """Unpadded URL-safe base64 as JWT uses"""
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64url_decode(data: str) -> bytes:
+    """Decode b64url()"""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def json_compact(value: Any) -> bytes:
+    """Deterministic compact JSON"""
+    return json.dumps(value, separators=(",", ":"), sort_keys=True, ensure_ascii=False).encode("utf-8")
+
+
+def sign_hs256(claims: Dict[str, Any], key: bytes) -> str:
+    """Encode and sign JWT"""
+    signing_input = f"{b64url(json_compact(HEADER))}.{b64url(json_compact(claims))}"
+    signature = hmac.new(key, signing_input.encode("ascii"), hashlib.sha256).digest()
+    return f"{signing_input}.{b64url(signature)}"
+
+
+def verify_hs256(jwt: str, key: bytes, now: Optional[float] = None) -> Dict[str, Any]:
+    """Check signature and expiry, return the claims, raises ValueError if the JWT is not valid"""
+    try:
+        header_b64, claims_b64, signature_b64 = jwt.split(".")
+        header = json.loads(b64url_decode(header_b64))
+        signature = b64url_decode(signature_b64)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError(f"Malformed JWT: {exc}") from exc
+    if header.get("alg") != HEADER["alg"]:
+        raise ValueError(f"Unsupported alg {header.get('alg')}")
+    expected = hmac.new(key, f"{header_b64}.{claims_b64}".encode("ascii"), hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected):
+        raise ValueError("Bad signature")
+    claims: Dict[str, Any] = json.loads(b64url_decode(claims_b64))
+    if claims.get("exp", 0) <= (time.time() if now is None else now):
+        raise ValueError("Expired")
+    return claims
+
+
+class ClaimsBuilder:  # pylint: disable=R0902
+    """Build and sign claims for users ACLs, privileges is the codebook (order matters, only append to it)"""
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        key: bytes,
+        privileges: Sequence[str] = (),
+        lifetime: int = DEFAULT_LIFETIME,
+        bucket: int = DEFAULT_BUCKET,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ) -> None:
+        self.key = key
+        self.privileges = list(privileges)
+        self.codes = {privilege: idx for idx, privilege in enumerate(self.privileges)}
+        # verifiers must use the same codebook
+        self.codebook_version = b64url(hashlib.sha256("\n".join(self.privileges).encode("utf-8")).digest()[:6])
+        self.lifetime = lifetime
+        self.bucket = bucket
+        self.max_entries = max_entries
+        self._signed: "OrderedDict[Tuple[str, bytes, int], str]" = OrderedDict()
+        self._fingerprints: "OrderedDict[int, Tuple[ACL, bytes]]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+    def acl_claim(self, acl: ACL) -> Dict[str, Any]:
+        """The compact "acl" claim"""
+        bits = 0
+        targeted: Dict[str, List[str]] = {}
+        denied: Dict[str, List[str]] = {}  # to keep exceptions to wider grants
+        extra: List[str] = []
+        for item in acl:
+            if item.action is None:
+                continue
+            code = self.codes.get(item.privilege)
+            if item.target is not None:
+                into = targeted if item.action else denied
+                into.setdefault(item.privilege if code is None else str(code), []).append(item.target)
+            elif not item.action:
+                continue
+            elif code is None:
+                extra.append(item.privilege)
+            else:
+                bits |= 1 << code
+        claim: Dict[str, Any] = {"v": self.codebook_version}
+        if bits:
+            claim["g"] = b64url(bits.to_bytes((bits.bit_length() + 7) // 8, "little"))
+        if targeted:
+            claim["t"] = {code: sorted(set(targets)) for code, targets in targeted.items()}
+        if denied:
+            claim["d"] = {code: sorted(set(targets)) for code, targets in denied.items()}
+        if extra:
+            claim["x"] = sorted(set(extra))
+        return claim
+
+    def acl_from_claims(self, claims: Dict[str, Any]) -> ACL:
+        """ACL from the "acl" claim, raises ValueError on codebook mismatch"""
+        claim = claims["acl"]
+        if claim.get("v") != self.codebook_version:
+            raise ValueError(f"Codebook version mismatch {claim.get('v')} != {self.codebook_version}")
+        bits = int.from_bytes(b64url_decode(claim["g"]), "little") if "g" in claim else 0
+        privileges = [privilege for idx, privilege in enumerate(self.privileges) if bits >> idx & 1]
+        items = [ACLItem(privilege=privilege, action=True) for privilege in privileges + claim.get("x", [])]
+        for action, name in ((True, "t"), (False, "d")):
+            for code, targets in claim.get(name, {}).items():
+                privilege = self.privileges[int(code)] if code.isdigit() else code
+                items += [ACLItem(privilege=privilege, target=target, action=action) for target in targets]
+        return ACL(items)
+
+    def fingerprint(self, acl: ACL) -> bytes:
+        """Digest of the ACL, remembered for the ACL objects seen last (see aclcache.MergeMemo)"""
+        entry = self._fingerprints.get(id(acl))
+        if entry is not None and entry[0] is acl:
+            self._fingerprints.move_to_end(id(acl))
+            return entry[1]
+        digest = hashlib.blake2b(encode_acl(acl), digest_size=16).digest()
+        self._fingerprints[id(acl)] = (acl, digest)  # keep the ACL alive so the id is not reused
+        while len(self._fingerprints) > self.max_entries:
+            self._fingerprints.popitem(last=False)
+        return digest
+
+    def issue(self, subject: PKType, acl: ACL, now: Optional[float] = None) -> str:
+        """Signed JWT for subject with the acl, the same one for the whole expiry bucket"""
+        if isinstance(subject, uuid.UUID):
+            subject = ensure_str(uuid_to_b64(subject))
+        issued = int(time.time() if now is None else now) // self.bucket * self.bucket
+        key = (subject, self.fingerprint(acl), issued)
+        jwt = self._signed.get(key)
+        if jwt is not None:
+            self._signed.move_to_end(key)
+            self.stats["hits"] += 1
+            return jwt
+        self.stats["misses"] += 1
+        claims = {
+            "sub": subject,
+            "iat": issued,
+            "exp": issued + self.bucket + self.lifetime,
+            "acl": self.acl_claim(acl),
+        }
+        jwt = self._signed[key] = sign_hs256(claims, self.key)
+        while len(self._signed) > self.max_entries:
+            self._signed.popitem(last=False)
+        return jwt
+
+    async def issue_for_user(self, user: Any, now: Optional[float] = None) -> str:
+        """Resolve the users ACL (see Role.resolve_user_acl) and issue JWT for it"""
+        # pylint: disable=C0415 ; # issuing from given ACLs must not need Gino
+        from .models import Role
+
+        return self.issue(user.pk, await Role.resolve_user_acl(user), now)
+
+    def verify(self, jwt: str, now: Optional[float] = None) -> Dict[str, Any]:
+        """Verify with our key, see verify_hs256"""
+        return verify_hs256(jwt, self.key, now)
@@ -0,0 +1,193 @@
+"""Login storm load generator, how many logins per second the models sustain against a database
+
+Every login goes through the stages of the login flow, the latency of each one is recorded::
+
+    queue    from the scheduled arrival until a concurrency slot is free
+    pool     waiting for a connection from the pool (one connection per login like DBConnectionMiddleware)
+    request  parsing the TokenRequest
+    lookup   User.get_by_email()
+    issue    Token.for_user() and create()
+    redeem   Token.get_by_pk(), is_valid() and mark_used()
+    acl      Role.resolve_user_acl()
+    total    from the arrival to the end, the latency the client sees
+
+seed_users() creates the users and roles (they are reused on later runs), run_storm() starts the logins at the
+arrival rate (0 means as fast as concurrency allows) and returns the report, see "arkia11nmodels loadtest"::
+
+    users = await seed_users(1000)
+    report = await run_storm(users, logins=5000, concurrency=32, rate=500)
+    print(json.dumps(report))
+
+The reports have the package version so runs against different versions can be compared.
+"""
+from typing import Any, Dict, List, Optional, Sequence
+import asyncio
+import logging
+import math
+import time
+
+import sqlalchemy as sa
+
+from . import __version__
+from .clickhelpers import run_batch
+from .models import db, sharding, Role, Token, User
+from .models.role import UserRole
+from .schemas.token import TokenRequest
+
+LOGGER = logging.getLogger(__name__)
+EMAIL_TEMPLATE = "loadtest{}@example.com"
+ROLE_PREFIX = "loadtest role"
+STAGES = ("queue", "pool", "request", "lookup", "issue", "redeem", "acl", "total")
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile of sorted samples, 0.0 for no samples"""
+    if not samples:
+        return 0.0
+    return samples[max(math.ceil(pct / 100 * len(samples)) - 1, 0)]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Count, mean, percentiles and max of the samples (seconds) in milliseconds"""
+    samples = sorted(samples)
+    ret = {"count": len(samples), "mean": sum(samples) / len(samples) * 1000 if samples else 0.0}
+    for pct in PERCENTILES:
+        ret[f"p{pct}"] = percentile(samples, pct) * 1000
+    ret["max"] = samples[-1] * 1000 if samples else 0.0
+    return ret
+
+
+async def seed_users(count: int, roles: int = 8, roles_per_user: int = 2, parallel: int = 8) -> List[str]:
+    """Create the loadtest users with roles (each role inherits the previous one), return the emails
+
+    Users and roles already there from earlier runs are reused.
+    """
+    existing_roles = await Role.query.where(Role.displayname.like(f"{ROLE_PREFIX}%")).order_by(Role.priority).gino.all()
+    role_objs: List[Role] = list(existing_roles[:roles])
+    while len(role_objs) < roles:
+        idx = len(role_objs)
+        role = await Role.create(
+            displayname=f"{ROLE_PREFIX} {idx}",
+            priority=idx,
+            acl=[{"privilege": f"fi.pvarki.loadtest.{idx}", "action": True}, {"privilege": "fi.pvarki.loadtest"}],
+        )
+        if role_objs:
+            await role.add_parent(role_objs[-1])
+        role_objs.append(role)
+    emails = [EMAIL_TEMPLATE.format(idx) for idx in range(count)]
+
+    async def seed_one(idx: int) -> None:
+        user = await User.get_by_email(emails[idx])
+        if user is not None:
+            return
+        user = await User.create(email=emails[idx], displayname=f"Load Test {idx}")
+        for offset in range(min(roles_per_user, len(role_objs))):
+            await role_objs[(idx + offset) % len(role_objs)].assign_to(user)
+
+    errors = [result for result in await run_batch(seed_one, list(range(count)), parallel) if result is not None]
+    if errors:
+        raise errors[0]
+    return emails
+
+
+async def cleanup() -> Dict[str, int]:
+    """Delete the loadtest users, their tokens and links (on every shard) and the loadtest roles, returns counts"""
+    users = sa.select([User.pk]).where(User.email.like(EMAIL_TEMPLATE.format("%")))
+
+    async def delete_users() -> Dict[str, int]:
+        counts = {}
+        for name, stmt in (
+            ("tokens", Token.delete.where(Token.user.in_(users))),
+            ("links", UserRole.delete.where(UserRole.user.in_(users))),
+            ("users", User.delete.where(User.email.like(EMAIL_TEMPLATE.format("%")))),
+        ):
+            status, _ = await db.status(stmt)
+            counts[name] = int(str(status).split()[-1])
+        return counts
+
+    ret: Dict[str, int] = {"roles": 0}
+    for counts in await sharding.each_shard(delete_users):
+        for name, count in counts.items():
+            ret[name] = ret.get(name, 0) + count
+    roles = await Role.query.where(Role.displayname.like(f"{ROLE_PREFIX}%")).gino.all()
+    for role in roles:  # unlink first, the parent may come before its child
+        for parent in await role.list_parents():
+            await role.remove_parent(parent)
+    for role in roles:
+        await role.delete()
+        ret["roles"] += 1
+    return ret
+
+
+async def login(email: str, timings: Dict[str, List[float]], arrived: float) -> None:
+    """One login through all the stages, appends the stage latencies (seconds) to timings"""
+    started = time.perf_counter()
+    timings["queue"].append(started - arrived)
+    conn = await db.acquire(reuse=True)
+    try:
+        mark = time.perf_counter()
+        timings["pool"].append(mark - started)
+
+        def stage(name: str) -> None:
+            nonlocal mark
+            now = time.perf_counter()
+            timings[name].append(now - mark)
+            mark = now
+
+        request = TokenRequest.parse_obj({"target": email, "deliver_via": "email"})
+        stage("request")
+        user = await User.get_by_email(request.target)
+        if user is None:
+            raise ValueError(f"No user {request.target}, seed first")
+        stage("lookup")
+        token = Token.for_user(user, request.expires)
+        token.sent_to = request.target
+        await token.create()
+        stage("issue")
+        redeemed = await Token.get_by_pk(token.pk)
+        if redeemed is None or not redeemed.is_valid():
+            raise ValueError(f"Token {token.pk} not valid")
+        await redeemed.mark_used({"loadtest": True})
+        stage("redeem")
+        await Role.resolve_user_acl(user)
+        stage("acl")
+    finally:
+        await conn.release()
+    timings["total"].append(time.perf_counter() - arrived)
+
+
+async def run_storm(
+    emails: Sequence[str], logins: int, concurrency: int = 8, rate: float = 0.0, config: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Run logins for the users round-robin, at most concurrency at a time, started at rate per second (0 = closed
+    loop), returns the report (latencies in milliseconds)"""
+    timings: Dict[str, List[float]] = {name: [] for name in STAGES}
+    errors: Dict[str, int] = {}
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def one(idx: int, arrived: float) -> None:
+        async with semaphore:
+            try:
+                await login(emails[idx % len(emails)], timings, arrived)
+            except Exception as exc:  # pylint: disable=W0703 ; # counted and reported
+                errors[repr(exc)] = errors.get(repr(exc), 0) + 1
+
+    started = time.perf_counter()
+    tasks = []
+    for idx in range(logins):
+        arrival = started + idx / rate if rate > 0 else time.perf_counter()
+        await asyncio.sleep(max(arrival - time.perf_counter(), 0))
+        tasks.append(asyncio.ensure_future(one(idx, arrival)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    completed = len(timings["total"])
+    return {
+        "version": __version__,
+        "config": {"logins": logins, "concurrency": concurrency, "rate": rate, "users": len(emails), **(config or {})},
+        "completed": completed,
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": completed / elapsed if elapsed > 0 else 0.0,
+        "stages": {name: summarize(samples) for name, samples in timings.items()},
+    }
@@ -0,0 +1,59 @@
+"""ASGI middlewares"""
+from typing import Any, Awaitable, Callable, MutableMapping, Optional
+import logging
+
+LOGGER = logging.getLogger(__name__)
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+SchemaFor = Callable[[Scope], Optional[str]]
+
+
+class DBConnectionMiddleware:  # pylint: disable=R0903
+    """Use one db connection per request (see models.scope) if dbconfig.USE_CONNECTION_FOR_REQUEST is set
+
+    The requests also get their own loader_scope() (see models.loader) so their get_by_uuid() lookups are coalesced.
+
+    Starlette/FastAPI::
+
+        app.add_middleware(DBConnectionMiddleware)
+
+    With schema_for the connection uses the tenant schema it returns for the request (see models.tenants),
+    None means DB_SCHEMA::
+
+        app.add_middleware(DBConnectionMiddleware, schema_for=lambda scope: TENANTS.get(hostname(scope)))
+
+    Only "http" requests are scoped by default, a websocket would keep its connection from the pool for as long as
+    it is open. Set websockets=True to scope them too (with schema_for they need it to use the tenant schema).
+    """
+
+    def __init__(self, app: ASGIApp, schema_for: Optional[SchemaFor] = None, websockets: bool = False) -> None:
+        self.app = app
+        self.schema_for = schema_for
+        self.scope_types = ("http", "websocket") if websockets else ("http",)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        from . import dbconfig  # pylint: disable=C0415 ; # deferred, reads .env and imports SQLAlchemy
+
+        if scope["type"] not in self.scope_types:
+            await self.app(scope, receive, send)
+            return
+        from .models.loader import loader_scope  # pylint: disable=C0415
+
+        with loader_scope():
+            schema = self.schema_for(scope) if self.schema_for is not None else None
+            if schema is not None:
+                from .models.tenants import tenant_scope  # pylint: disable=C0415
+
+                async with tenant_scope(schema):
+                    await self.app(scope, receive, send)
+                return
+            if not dbconfig.USE_CONNECTION_FOR_REQUEST:
+                await self.app(scope, receive, send)
+                return
+            from .models.scope import connection_scope  # pylint: disable=C0415
+
+            async with connection_scope():
+                await self.app(scope, receive, send)
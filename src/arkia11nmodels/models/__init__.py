@@ -1,7 +1,40 @@
-"""Database models"""
-from .base import db
-from .user import User
-from .token import Token
-from .role import Role
+"""Database models, loaded lazily on first attribute access so importing the package stays cheap"""
+from typing import TYPE_CHECKING, Any, Dict, List
+import importlib
+
+if TYPE_CHECKING:
+    from .base import db
+    from .user import User
+    from .token import Token
+    from .role import Role
 
 __all__ = ["db", "User", "Token", "Role"]
+
+# attribute name -> submodule that defines it
+LAZY_ATTRIBUTES: Dict[str, str] = {
+    "db": ".base",
+    "User": ".user",
+    "Token": ".token",
+    "Role": ".role",
+}
+
+
+def __getattr__(name: str) -> Any:
+    """Import the submodule defining the attribute on first access"""
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value  # cache so __getattr__ is not called again
+    return value
+
+
+def load_all() -> Any:
+    """Import all the models so their tables are in the metadata (for create_all and alembic), returns db"""
+    for name in LAZY_ATTRIBUTES:
+        __getattr__(name)
+    return globals()["db"]
+
+
+def __dir__() -> List[str]:
+    """Include the lazy attributes"""
+    return sorted(set(globals().keys()) | set(__all__))
@@ -1,23 +1,152 @@
 """The Gino baseclass with db connection wrapping"""
-from typing import Any
+from typing import Any, Dict, Iterator, Optional, Sequence, Union
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+import time
 import uuid
 
 from gino import Gino
-from sqlalchemy.dialects.postgresql import UUID as saUUID
+from gino.exceptions import UninitializedError
+from gino.declarative import declared_attr
+from sqlalchemy.dialects.postgresql import UUID as saUUID, ARRAY
 import sqlalchemy as sa
 
+from .. import dbconfig
 
 utcnow = sa.func.current_timestamp()
-db = Gino()
+_SCOPED_BIND: ContextVar[Any] = ContextVar("arkia11nmodels_scoped_bind", default=None)
+
+
+class ScopedGino(Gino):
+    """Gino whose bind can be replaced for the current context (asyncio task) with use_bind()"""
+
+    @property
+    def bind(self) -> Any:
+        """The scoped bind or the one set with set_bind()"""
+        scoped = _SCOPED_BIND.get()
+        if scoped is not None:
+            return scoped
+        return super().bind
+
+    @bind.setter
+    def bind(self, bind: Any) -> None:
+        self._bind = bind  # pylint: disable=W0201 ; # Gino.__init__ sets it via this setter
+
+
+@contextmanager
+def use_bind(bind: Any) -> Iterator[Any]:
+    """Make db and everything using it (model methods, PreparedQuery) use bind within the block, see models.sharding"""
+    token = _SCOPED_BIND.set(bind)
+    try:
+        yield bind
+    finally:
+        _SCOPED_BIND.reset(token)
+
+
+def scoped_bind() -> Any:
+    """The bind of the innermost use_bind() block, None outside them"""
+    return _SCOPED_BIND.get()
+
+
+def holds_connection(bind: Any) -> bool:
+    """Has this context a connection of bind that nested acquires reuse (like models.scope), tasks would share it"""
+    try:
+        if isinstance(bind, ScopedGino):
+            bind = bind.bind
+        return getattr(bind, "current_connection", None) is not None
+    except UninitializedError:  # db not bound yet
+        return False
+
+
+db = ScopedGino()
+# With DB_SCHEMA_FROM_SEARCH_PATH the tables are not schema qualified and the search_path picks the tenant
+TABLE_SCHEMA: Optional[str] = None if dbconfig.SCHEMA_FROM_SEARCH_PATH else dbconfig.SCHEMA
 DBModel: Any = db.Model  # workaround mypy being unhappy about using @property as baseclass
+UUID7_COUNTER_MAX = 0xFFF
+_UUID7_LOCK = threading.Lock()
+_uuid7_last = [0, 0]  # unix ms, counter
+
+
+def uuid7() -> uuid.UUID:
+    """Time-ordered UUID (version 7, RFC 9562): 48 bit unix ms timestamp, 12 bit counter, 62 random bits
+
+    The counter starts from a random value each millisecond and is incremented for UUIDs generated within the
+    same millisecond so they're monotonic within the process.
+    """
+    with _UUID7_LOCK:
+        unix_ms = time.time_ns() // 1_000_000
+        last_ms, counter = _uuid7_last
+        if unix_ms <= last_ms:
+            unix_ms = last_ms
+            counter += 1
+            if counter > UUID7_COUNTER_MAX:  # Counter overflow, borrow from the next millisecond
+                unix_ms += 1
+                counter = 0
+        else:
+            counter = int.from_bytes(os.urandom(2), "big") & (UUID7_COUNTER_MAX >> 1)  # leave room to increment
+        _uuid7_last[0], _uuid7_last[1] = unix_ms, counter
+    rand_b = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    return uuid.UUID(int=(unix_ms & ((1 << 48) - 1)) << 80 | 0x7 << 76 | counter << 64 | 0b10 << 62 | rand_b)
+
+
+def jsonb_merged(column: Any, value: Optional[Dict[str, Any]] = None, remove: Sequence[str] = ()) -> Any:
+    """SQL expression for JSONB column with the remove keys removed and then value merged in (column || value)
+
+    Top level keys in value replace the existing ones. Use in UPDATE so the database does the change and
+    concurrent updates to other keys are not lost.
+    """
+    expr = column
+    if remove:
+        keys = sa.cast(sa.literal(list(remove), type_=ARRAY(sa.Text())), ARRAY(sa.Text()))
+        expr = sa.sql.expression.Grouping(expr.op("-")(keys))
+    if value:
+        expr = expr.concat(value)
+    return expr
+
+
+def new_pk() -> uuid.UUID:
+    """Default for the primary keys: uuid7 if DB_TIME_ORDERED_PKS is set, uuid4 otherwise"""
+    if dbconfig.TIME_ORDERED_PKS:
+        return uuid7()
+    return uuid.uuid4()
 
 
 class BaseModel(DBModel):  # pylint: disable=R0903
     """Baseclass with common fields"""
 
-    __table_args__ = {"schema": "a11n"}
+    __table_args__ = {"schema": TABLE_SCHEMA}
 
-    pk = sa.Column(saUUID(), primary_key=True, default=uuid.uuid4)
+    pk = sa.Column(saUUID(), primary_key=True, default=new_pk)
     created = sa.Column(sa.DateTime(timezone=True), default=utcnow, nullable=False)
     updated = sa.Column(sa.DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=False)
     deleted = sa.Column(sa.DateTime(timezone=True), nullable=True)
+
+    @declared_attr  # type: ignore
+    def _deleted_idx(cls) -> Optional[sa.Index]:  # pylint: disable=E0213
+        """Partial index for finding the soft-deleted rows to purge (see models.purge)"""
+        tablename = getattr(cls, "__tablename__", None)
+        if not tablename:
+            return None
+        return sa.Index(f"ix_a11n_{tablename}_deleted", "deleted", postgresql_where=sa.text("deleted IS NOT NULL"))
+
+    @classmethod
+    def live(cls) -> Any:
+        """Query for the rows that are not soft-deleted"""
+        return cls.query.where(cls.deleted == None)  # pylint: disable=C0121 ; # "is None" will create invalid query
+
+    @classmethod
+    async def get_live(cls, pk: Union[uuid.UUID, str], bind: Any = None) -> Any:
+        """Get by pk unless soft-deleted, bind defaults to db"""
+        return await (db if bind is None else bind).first(cls.live().where(cls.pk == pk))
+
+    async def merge_jsonb(
+        self, column: str, value: Optional[Dict[str, Any]] = None, remove: Sequence[str] = (), **values: Any
+    ) -> None:
+        """Merge value into JSONB column in the database (see jsonb_merged), other values are set in the same UPDATE"""
+        await self.update(**{column: jsonb_merged(getattr(type(self), column), value, remove)}, **values).apply()
+
+    async def soft_delete(self) -> None:
+        """Mark deleted, models.purge will remove it after the retention period"""
+        await self.update(deleted=utcnow).apply()
@@ -0,0 +1,161 @@
+"""Coalesce get-by-pk lookups made concurrently into one query per model class
+
+ModelLoader collects the pks requested within one event loop iteration (like the coroutines of one
+asyncio.gather) and fetches them with a single "WHERE pk = ANY(:pks)" query, every waiter gets its object (or None)
+from that. Duplicate pks are fetched once. clickhelpers.get_by_uuid uses get_loader()::
+
+    from arkia11nmodels.models.loader import get_loader, loader_scope
+
+    with loader_scope():  # per request cache, the same pk is fetched only once within the block
+        users = await asyncio.gather(*(get_loader(User).load(pk) for pk in pks))
+
+The batch is fetched in the context of the first caller so loaders are only shared within loader_scope(), by the
+callers with the same tenant schema and read routing. Inside a transaction or use_bind() (like a shard) the loads
+are not batched with anyone else, they are fetched right away in the callers context so it sees its own writes.
+Outside loader_scope() get_loader() gives each caller its own loader, load_many() still makes one query. Inside
+the scope call clear() after modifying objects that may be loaded again in the same scope. The CLI batches
+(clickhelpers.run_batch) and the requests of middleware.DBConnectionMiddleware run within their own scope.
+"""
+from typing import Any, Dict, Generic, Iterator, List, Optional, Sequence, Tuple, Type, TypeVar, Union
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio
+import logging
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID as saUUID, ARRAY
+
+from .base import db, holds_connection, scoped_bind
+from . import routing, sharding, tenants
+
+LOGGER = logging.getLogger(__name__)
+ModelType = TypeVar("ModelType")  # pylint: disable=C0103
+LoaderKey = Tuple[type, bool, str, bool]  # klass, include_deleted, tenant schema, pinned to primary
+_SCOPED_LOADERS: ContextVar[Optional[Dict[LoaderKey, "ModelLoader[Any]"]]] = ContextVar(
+    "arkia11nmodels_scoped_loaders", default=None
+)
+
+
+class ModelLoader(Generic[ModelType]):
+    """Batching get-by-pk for one model class, skips soft-deleted rows unless include_deleted"""
+
+    def __init__(self, klass: Type[ModelType], include_deleted: bool = False, cache: bool = False) -> None:
+        self.klass = klass
+        self.include_deleted = include_deleted
+        self.cache = cache
+        self._cached: Dict[uuid.UUID, "asyncio.Future[Optional[ModelType]]"] = {}
+        self._pending: Dict[uuid.UUID, "asyncio.Future[Optional[ModelType]]"] = {}
+        self.stats: Dict[str, int] = {"loads": 0, "deduplicated": 0, "queries": 0, "rows": 0}
+
+    async def load(self, pk: Union[uuid.UUID, str]) -> Optional[ModelType]:
+        """Get the object by pk, None if not found"""
+        key = pk if isinstance(pk, uuid.UUID) else uuid.UUID(str(pk))
+        self.stats["loads"] += 1
+        if not batchable():
+            return (await self._fetch_now([key]))[0]
+        future = self._pending.get(key, self._cached.get(key))
+        if future is not None:
+            self.stats["deduplicated"] += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            if not self._pending:
+                loop.call_soon(self._dispatch)  # after the callbacks already scheduled for this iteration
+            self._pending[key] = future
+            if self.cache:
+                self._cached[key] = future
+        # one cancelled waiter must not cancel the others
+        return await asyncio.shield(future)
+
+    async def load_many(self, pks: List[Union[uuid.UUID, str]]) -> List[Optional[ModelType]]:
+        """Get objects by pks (in the same order, None for not found) in one batch"""
+        if not batchable():
+            self.stats["loads"] += len(pks)
+            return await self._fetch_now([pk if isinstance(pk, uuid.UUID) else uuid.UUID(str(pk)) for pk in pks])
+        return list(await asyncio.gather(*(self.load(pk) for pk in pks)))
+
+    def clear(self, pk: Optional[Union[uuid.UUID, str]] = None) -> None:
+        """Forget the cached object (all if pk is None)"""
+        if pk is None:
+            self._cached.clear()
+            return
+        self._cached.pop(pk if isinstance(pk, uuid.UUID) else uuid.UUID(str(pk)), None)
+
+    def _dispatch(self) -> None:
+        """Start fetching the pending batch"""
+        batch, self._pending = self._pending, {}
+        asyncio.ensure_future(self._fetch(batch))
+
+    async def _fetch_now(self, keys: List[uuid.UUID]) -> List[Optional[ModelType]]:
+        """Fetch in the callers context without batching or caching"""
+        loop = asyncio.get_running_loop()
+        batch = {key: loop.create_future() for key in keys}
+        self.stats["deduplicated"] += len(keys) - len(batch)
+        await self._fetch(batch)
+        return [batch[key].result() for key in keys]
+
+    def _query(self, pks: Sequence[Union[uuid.UUID, str]]) -> Any:
+        """Select the pks"""
+        klass: Any = self.klass
+        query = klass.query.where(klass.pk == sa.func.any(sa.bindparam("pks", pks, type_=ARRAY(saUUID()))))
+        if not self.include_deleted:
+            query = query.where(klass.deleted == None)  # pylint: disable=C0121
+        return query
+
+    async def _fetch(self, batch: Dict[uuid.UUID, "asyncio.Future[Optional[ModelType]]"]) -> None:
+        """Fetch the batch and resolve its futures, one query per shard when sharded"""
+        if sharding.is_sharded() and issubclass(self.klass, sharding.UserShardedModel):
+            groups = sharding.group_by_shard(list(batch))
+            queries = [(sharding.SHARDS[idx], self._query(pks)) for idx, pks in groups.items()]
+        else:
+            # a pinned pk sends the batch to the primary
+            bind = routing.read_bind(next((pk for pk in batch if routing.is_pinned(pk)), None))
+            queries = [(bind, self._query(list(batch)))]
+        self.stats["queries"] += len(queries)
+        try:
+            if len(queries) > 1 and any(holds_connection(bind) for bind, _ in queries):
+                # concurrent tasks would share the held connection (see models.scope)
+                results = [await bind.all(query) for bind, query in queries]
+            else:
+                results = await asyncio.gather(*(bind.all(query) for bind, query in queries))
+            objs = [obj for result in results for obj in result]
+        except Exception as exc:  # pylint: disable=W0703 ; # every waiter gets the error
+            for key, future in batch.items():
+                if self._cached.get(key) is future:
+                    del self._cached[key]
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        self.stats["rows"] += len(objs)
+        found = {uuid.UUID(str(obj.pk)): obj for obj in objs}
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+
+def batchable() -> bool:
+    """Can loads of this context be fetched in another callers context: not in a transaction or use_bind()"""
+    return scoped_bind() is None and not (holds_connection(db) and routing.in_primary_transaction())
+
+
+def get_loader(klass: Type[ModelType], include_deleted: bool = False) -> ModelLoader[ModelType]:
+    """The loader for klass in the current loader_scope() (see module docs), or a new non-caching one"""
+    loaders = _SCOPED_LOADERS.get()
+    if loaders is None:
+        return ModelLoader(klass, include_deleted)
+    key = (klass, include_deleted, tenants.current_schema(), routing.is_pinned())
+    if key not in loaders:
+        loaders[key] = ModelLoader(klass, include_deleted, cache=True)
+    return loaders[key]
+
+
+@contextmanager
+def loader_scope() -> Iterator[Dict[LoaderKey, ModelLoader[Any]]]:
+    """Caching loaders within the block (like one HTTP request), tasks started inside share them"""
+    loaders: Dict[LoaderKey, ModelLoader[Any]] = {}
+    token = _SCOPED_LOADERS.set(loaders)
+    try:
+        yield loaders
+    finally:
+        _SCOPED_LOADERS.reset(token)
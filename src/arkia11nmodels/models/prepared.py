@@ -0,0 +1,172 @@
+"""Compile-once statements for the fixed shape hot queries
+
+The statements are built and compiled to SQL only once per process, the SQL is then executed directly on the
+asyncpg connection which prepares it server-side and keeps the prepared statement in the per-connection statement
+cache (see statement_cache_size in asyncpg.connect) so subsequent calls skip both SQLAlchemy compilation and
+the PostgreSQL parse/plan.
+
+Set DB_PREPARED_STATEMENTS=false (or dbconfig.PREPARED_STATEMENTS = False at runtime) to execute the very same
+statements via normal Gino query execution, useful when debugging with DB_ECHO.
+"""
+from typing import Any, AsyncGenerator, Callable, Dict, List, Mapping, Optional, Sequence, Type, TypeVar, Tuple
+import collections
+import logging
+
+from .. import dbconfig
+from .base import db
+
+LOGGER = logging.getLogger(__name__)
+ModelType = TypeVar("ModelType")  # pylint: disable=C0103
+RowType = Dict[str, Any]
+RECORDS_PREFETCH = 1000  # rows per cursor round trip in iterate_records
+Processor = Optional[Callable[[Any], Any]]
+
+
+class PreparedQuery:  # pylint: disable=R0902
+    """Statement built and compiled only once, executed as prepared statement on each connection
+
+    The builder must return a SQLAlchemy statement with named sa.bindparam():s, parameters are given as
+    keyword arguments when executing. Rows are returned as dicts keyed by result column name. Pass bind to
+    execute on something else than the db (like models.routing.read_bind()).
+    """
+
+    def __init__(self, builder: Callable[[], Any]) -> None:
+        self.builder = builder
+        self._statement: Any = None
+        self._sql: Optional[str] = None
+        self._param_names: Sequence[str] = ()
+        self._bind_processors: Dict[str, Processor] = {}
+        self._result_names: Sequence[str] = ()
+        self._result_processors: Sequence[Processor] = ()
+        self._processed: Sequence[Tuple[int, Callable[[Any], Any]]] = ()
+        self._record_type: Any = None
+
+    @property
+    def statement(self) -> Any:
+        """The SQLAlchemy statement, built on first access"""
+        if self._statement is None:
+            self._statement = self.builder()
+        return self._statement
+
+    def compile(self, dialect: Any) -> str:
+        """Compile the statement (if not done yet) and return the SQL"""
+        if self._sql is not None:
+            return self._sql
+        compiled = self.statement.compile(dialect=dialect)
+        self._param_names = tuple(compiled.positiontup)
+        self._bind_processors = {
+            name: compiled.binds[name].type.dialect_impl(dialect).bind_processor(dialect) for name in self._param_names
+        }
+        # pylint: disable=W0212 ; # there is no public API for this in SQLAlchemy 1.3
+        self._result_names = tuple(col[0] for col in compiled._result_columns)
+        self._result_processors = tuple(
+            col[3].dialect_impl(dialect).result_processor(dialect, None) for col in compiled._result_columns
+        )
+        self._processed = tuple(
+            (idx, processor) for idx, processor in enumerate(self._result_processors) if processor is not None
+        )
+        self._record_type = collections.namedtuple("Record", self._result_names)  # type: ignore
+        self._sql = str(compiled)
+        LOGGER.debug("Compiled {}".format(self._sql))
+        return self._sql
+
+    def args(self, params: Mapping[str, Any]) -> List[Any]:
+        """Positional args from the keyword parameters"""
+        ret = []
+        for name in self._param_names:
+            value = params[name]
+            processor = self._bind_processors[name]
+            if processor is not None:
+                value = processor(value)
+            ret.append(value)
+        return ret
+
+    def row(self, record: Sequence[Any]) -> RowType:
+        """Convert asyncpg record to dict running the result processors"""
+        ret = {}
+        for name, processor, value in zip(self._result_names, self._result_processors, record):
+            if processor is not None:
+                value = processor(value)
+            ret[name] = value
+        return ret
+
+    @property
+    def record_type(self) -> Any:
+        """namedtuple class for the result rows (after compile)"""
+        return self._record_type
+
+    def record(self, record: Sequence[Any]) -> Any:
+        """Convert asyncpg record to read-only namedtuple running the result processors"""
+        if not self._processed:
+            return self._record_type._make(record)
+        values = list(record)
+        for idx, processor in self._processed:
+            values[idx] = processor(values[idx])
+        return self._record_type._make(values)
+
+    async def all(self, bind: Any = None, **params: Any) -> List[RowType]:
+        """Return all rows"""
+        async with (db if bind is None else bind).acquire(reuse=True) as conn:
+            if not dbconfig.PREPARED_STATEMENTS:
+                return [dict(row.items()) for row in await conn.all(self.statement, **params)]
+            sql = self.compile(conn.dialect)
+            raw = await conn.get_raw_connection()
+            return [self.row(record) for record in await raw.fetch(sql, *self.args(params))]
+
+    async def first(self, bind: Any = None, **params: Any) -> Optional[RowType]:
+        """Return first row or None"""
+        async with (db if bind is None else bind).acquire(reuse=True) as conn:
+            if not dbconfig.PREPARED_STATEMENTS:
+                row = await conn.first(self.statement, **params)
+                return dict(row.items()) if row is not None else None
+            sql = self.compile(conn.dialect)
+            raw = await conn.get_raw_connection()
+            record = await raw.fetchrow(sql, *self.args(params))
+            return self.row(record) if record is not None else None
+
+    async def status(self, bind: Any = None, **params: Any) -> str:
+        """Execute and return status message"""
+        async with (db if bind is None else bind).acquire(reuse=True) as conn:
+            if not dbconfig.PREPARED_STATEMENTS:
+                status, _ = await conn.status(self.statement, **params)
+                return str(status)
+            sql = self.compile(conn.dialect)
+            raw = await conn.get_raw_connection()
+            return str(await raw.execute(sql, *self.args(params)))
+
+    async def iterate(self, bind: Any = None, **params: Any) -> AsyncGenerator[RowType, None]:
+        """Iterate over the results with a cursor"""
+        async with (db if bind is None else bind).acquire(reuse=True) as conn:
+            # Cursors need transaction (nested one is a savepoint)
+            async with conn.transaction():
+                if not dbconfig.PREPARED_STATEMENTS:
+                    async for row in conn.iterate(self.statement, **params):
+                        yield dict(row.items())
+                    return
+                sql = self.compile(conn.dialect)
+                raw = await conn.get_raw_connection()
+                async for record in raw.cursor(sql, *self.args(params)):
+                    yield self.row(record)
+
+    async def iterate_records(self, bind: Any = None, **params: Any) -> AsyncGenerator[Any, None]:
+        """Iterate over the results as record_type namedtuples, much lighter than dicts or model instances"""
+        async with (db if bind is None else bind).acquire(reuse=True) as conn:
+            self.compile(conn.dialect)
+            async with conn.transaction():
+                if not dbconfig.PREPARED_STATEMENTS:
+                    async for row in conn.iterate(self.statement, **params):
+                        yield self._record_type._make(row)
+                    return
+                raw = await conn.get_raw_connection()
+                async for record in raw.cursor(self._sql, *self.args(params), prefetch=RECORDS_PREFETCH):
+                    yield self.record(record)
+
+
+def load_model(klass: Type[ModelType], row: Mapping[str, Any]) -> ModelType:
+    """Load model instance from row dict the same way Gino ModelLoader does"""
+    obj = klass()
+    # pylint: disable=W0212 ; # gino does not expose the column name map
+    name_map = klass._column_name_map  # type: ignore
+    for key, value in row.items():
+        obj.__values__[name_map.invert_get(key)] = value  # type: ignore
+    return obj
@@ -0,0 +1,79 @@
+"""Hard-delete rows that have been soft-deleted longer than the retention period
+
+Rows are deleted in batches of DB_PURGE_BATCH_SIZE, each batch in its own transaction so locks are held only
+briefly. Tables are processed children first and rows that are still referenced by other rows (like a deleted
+User with live Tokens) are skipped, they will be purged once the referencing rows are.
+"""
+from typing import Any, Dict, List, Optional
+import asyncio
+import datetime
+import logging
+
+import pendulum
+import sqlalchemy as sa
+
+from .. import dbconfig
+from . import load_all, sharding
+
+LOGGER = logging.getLogger(__name__)
+
+
+def purge_statement(table: sa.Table, referencing: List["sa.Column[Any]"], batch_size: int) -> Any:
+    """DELETE for one batch of soft-deleted rows older than the "cutoff" bindparam"""
+    candidates = sa.select([table.c.pk]).where(
+        table.c.deleted < sa.bindparam("cutoff", type_=sa.DateTime(timezone=True))
+    )
+    for column in referencing:
+        candidates = candidates.where(~sa.exists().where(column == table.c.pk))
+    candidates = candidates.limit(batch_size).with_for_update(skip_locked=True)
+    return table.delete().where(table.c.pk.in_(candidates))
+
+
+async def purge_table(
+    table: sa.Table, cutoff: datetime.datetime, batch_size: Optional[int] = None, pause: float = 0.0
+) -> int:
+    """Purge rows soft-deleted before cutoff from table, returns number of rows deleted"""
+    if batch_size is None:
+        batch_size = dbconfig.PURGE_BATCH_SIZE
+    db = load_all()
+    referencing = [
+        fkey.parent for other in db.sorted_tables for fkey in other.foreign_keys if fkey.column.table is table
+    ]
+    stmt = purge_statement(table, referencing, batch_size)
+    total = 0
+    while True:
+        status, _ = await db.status(stmt, cutoff=cutoff)
+        deleted = int(str(status).split()[-1])
+        total += deleted
+        LOGGER.debug("Purged {} rows from {}".format(deleted, table.fullname))
+        if deleted < batch_size:
+            return total
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def purge_deleted(
+    retention: Optional[datetime.timedelta] = None, batch_size: Optional[int] = None, pause: float = 0.0
+) -> Dict[str, int]:
+    """Purge all tables, retention defaults to DB_PURGE_RETENTION_DAYS, returns deleted counts by table name
+
+    When sharded every shard is purged concurrently and the counts are summed.
+    """
+    if retention is None:
+        retention = datetime.timedelta(days=dbconfig.PURGE_RETENTION_DAYS)
+    cutoff = pendulum.now("UTC") - retention
+
+    async def purge_all() -> Dict[str, int]:
+        counts = {}
+        for table in reversed(load_all().sorted_tables):  # children first
+            if "deleted" not in table.c:
+                continue
+            counts[table.name] = await purge_table(table, cutoff, batch_size, pause)
+        return counts
+
+    ret: Dict[str, int] = {}
+    for counts in await sharding.each_shard(purge_all):
+        for name, count in counts.items():
+            ret[name] = ret.get(name, 0) + count
+    LOGGER.info("Purged rows deleted before {}: {}".format(cutoff, ret))
+    return ret
@@ -1,22 +1,43 @@
 """Roles"""
-from typing import AsyncGenerator, List
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Tuple, Union
+import functools
+import heapq
 import logging
+import uuid
 
-from sqlalchemy.dialects.postgresql import UUID as saUUID, JSONB
+from gino.crud import DEFAULT
+from sqlalchemy.dialects.postgresql import UUID as saUUID, JSONB, ARRAY
 import sqlalchemy as sa
 import pendulum
 
-from .base import BaseModel, db
-from .user import User
-from ..schemas.role import DEFAULT_PRIORITY, ACL
+from .base import TABLE_SCHEMA, BaseModel, DBModel, db
+from .user import User, PageKey, DEFAULT_PAGE_SIZE
+from .prepared import PreparedQuery, load_model
+from . import routing, sharding
+from ..schemas.role import DEFAULT_PRIORITY, ACL, merge_acls
+from .. import aclcache
 
 LOGGER = logging.getLogger(__name__)
+DEFAULT_USER_RECORD_COLUMNS = ("pk", "email", "displayname")
+HIERARCHY_LOCK = 0x61316E526F6C65  # pg_advisory_xact_lock key serializing role hierarchy changes
+MERGED_COLUMNS = ("acl", "priority")  # changing these changes the merged ACLs of the users of the role
 
 
-class Role(BaseModel):
+class RoleUpdateRequest(sharding.ReplicatedUpdateRequest):
+    """Invalidate cached ACLs when the role ACL or priority changes"""
+
+    async def apply(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        ret = await super().apply(bind=bind, timeout=timeout)
+        if any(name in self._values for name in MERGED_COLUMNS):
+            await self._instance._hierarchy_changed()  # pylint: disable=W0212
+        return ret
+
+
+class Role(sharding.ReplicatedModel):
     """Role, ACLs (format TBDefined) stored as list of dicts in the JSON property"""
 
     __tablename__ = "roles"
+    _update_request_cls = RoleUpdateRequest
 
     displayname = sa.Column(sa.Unicode(), nullable=False)
     acl = sa.Column(JSONB, nullable=False, server_default="[]")
@@ -26,9 +47,12 @@ class Role(BaseModel):
 
     async def assign_to(self, user: User) -> bool:
         """Assign this role to user, returns True if created, False if nothing was done (already assigned)"""
-        user_role = (
-            await UserRole.query.where(UserRole.role == self.pk).where(UserRole.user == user.pk).gino.one_or_none()
-        )
+        with sharding.use_shard(user.pk):
+            return await self._assign_to(user)
+
+    async def _assign_to(self, user: User) -> bool:
+        """assign_to on the users shard"""
+        user_role = await UserRole.get_link(self.pk, user.pk)
         if user_role:
             if user_role.role != self.pk:
                 raise ValueError(
@@ -42,18 +66,23 @@ class Role(BaseModel):
                 LOGGER.info("Role {} already linked with user {}".format(self.displayname, user.displayname))
                 return False
             LOGGER.info("Role {} link to user {} marked deleted, undeleting".format(self.displayname, user.displayname))
-            await user_role.update(deleted=None).apply()
+            await SET_USERROLE_DELETED.status(userrole_pk=user_role.pk, deleted_at=None)
+            await self._user_roles_changed(user)
             return True
         LOGGER.info("Role {} link to user {} not found, creating new link".format(self.displayname, user.displayname))
         user_role = UserRole(role=self.pk, user=user.pk)
         await user_role.create()
+        await self._user_roles_changed(user)
         return True
 
     async def remove_from(self, user: User) -> bool:
         """Remove this role from user, returns True if deleted, False nothing was done"""
-        user_role = (
-            await UserRole.query.where(UserRole.role == self.pk).where(UserRole.user == user.pk).gino.one_or_none()
-        )
+        with sharding.use_shard(user.pk):
+            return await self._remove_from(user)
+
+    async def _remove_from(self, user: User) -> bool:
+        """remove_from on the users shard"""
+        user_role = await UserRole.get_link(self.pk, user.pk)
         if user_role:
             if user_role.role != self.pk:
                 raise ValueError(
@@ -66,18 +95,30 @@ class Role(BaseModel):
             if user_role.deleted:
                 LOGGER.info("Role {} link with {} already gone".format(self.displayname, user.displayname))
                 return False
+        if not user_role:
+            LOGGER.info("Role {} link with {} not found".format(self.displayname, user.displayname))
+            return False
         LOGGER.info("Role {} link to user {} found, marking deleted".format(self.displayname, user.displayname))
-        await user_role.update(deleted=pendulum.now("UTC")).apply()
+        await SET_USERROLE_DELETED.status(userrole_pk=user_role.pk, deleted_at=pendulum.now("UTC"))
+        await self._user_roles_changed(user)
         return True
 
+    async def _user_roles_changed(self, user: User) -> None:
+        """Invalidate cached data for the user, read the links from primary for a while (see models.routing)"""
+        routing.pin_primary(user.pk, self.pk)
+        cache = aclcache.get_cache()
+        if cache is not None:
+            await cache.bump(user.pk)
+
     async def iter_role_users(self) -> AsyncGenerator[User, None]:
-        """Return iterator for users with this role"""
-        async with db.acquire() as conn:  # Cursors need transaction
-            async with conn.transaction():
-                async for lnk in UserRole.load(user=User).query.where(UserRole.role == self.pk).where(
-                    UserRole.deleted == None  # pylint: disable=C0121 ; # "is None" will create invalid query
-                ).order_by(User.displayname).gino.iterate():
-                    yield lnk.user
+        """Return iterator for users with this role (when sharded all shards are read first and merged)"""
+        if sharding.is_sharded():
+            results = await sharding.each_shard(lambda: ROLE_USERS.all(role_pk=self.pk))
+            for row in heapq.merge(*results, key=lambda row: row["displayname"]):
+                yield load_model(User, row)
+            return
+        async for row in ROLE_USERS.iterate(bind=routing.read_bind(self.pk), role_pk=self.pk):
+            yield load_model(User, row)
 
     async def list_role_users(self) -> List[User]:
         """Consumes the iterator from iter_role_users and returns a list. NOTE: This might get *very* expensive"""
@@ -86,15 +127,122 @@ class Role(BaseModel):
             ret.append(user)
         return ret
 
+    async def iter_role_user_records(
+        self, columns: Sequence[str] = DEFAULT_USER_RECORD_COLUMNS
+    ) -> AsyncGenerator[Any, None]:
+        """Like iter_role_users but yields read-only namedtuples with only the given User columns
+
+        When sharded the shards are read concurrently and the records come shard by shard.
+        """
+        query = role_users_query(tuple(columns))
+        if sharding.is_sharded():
+
+            async def records() -> List[Any]:
+                return [record async for record in query.iterate_records(role_pk=self.pk)]
+
+            for result in await sharding.each_shard(records):
+                for record in result:
+                    yield record
+            return
+        async for record in query.iterate_records(bind=routing.read_bind(self.pk), role_pk=self.pk):
+            yield record
+
+    async def list_role_user_records(self, columns: Sequence[str] = DEFAULT_USER_RECORD_COLUMNS) -> List[Any]:
+        """Consumes the iterator from iter_role_user_records and returns a list"""
+        return [record async for record in self.iter_role_user_records(columns)]
+
+    async def add_parent(self, parent: "Role") -> bool:
+        """Inherit roles from parent, returns False if already a direct parent, raises ValueError on cycles"""
+        if parent.pk == self.pk:
+            raise ValueError("Role can not inherit itself")
+        added = any(await sharding.each_shard(lambda: self._add_parent(parent)))
+        if added:
+            await self._hierarchy_changed()
+        return added
+
+    async def _add_parent(self, parent: "Role") -> bool:
+        """add_parent on one shard"""
+        async with db.transaction():
+            await db.scalar(sa.select([sa.func.pg_advisory_xact_lock(HIERARCHY_LOCK)]))
+            if await ROLE_CLOSURE_ROW.first(descendant_pk=parent.pk, ancestor_pk=self.pk):
+                raise ValueError(f"Role {parent.pk} inherits {self.pk}, can not inherit it back")
+            if await ROLE_PARENT_LINK.first(role_pk=self.pk, parent_pk=parent.pk):
+                return False
+            await RoleParent.create(role=self.pk, parent=parent.pk)
+            await rebuild_closure(self.pk)
+        return True
+
+    async def remove_parent(self, parent: "Role") -> bool:
+        """Stop inheriting from parent, returns False if it was not a direct parent"""
+        removed = any(await sharding.each_shard(lambda: self._remove_parent(parent)))
+        if removed:
+            await self._hierarchy_changed()
+        return removed
+
+    async def _remove_parent(self, parent: "Role") -> bool:
+        """remove_parent on one shard"""
+        async with db.transaction():
+            await db.scalar(sa.select([sa.func.pg_advisory_xact_lock(HIERARCHY_LOCK)]))
+            status = await DELETE_ROLE_PARENT.status(role_pk=self.pk, parent_pk=parent.pk)
+            if status.endswith(" 0"):
+                return False
+            await rebuild_closure(self.pk)
+        return True
+
+    async def list_ancestors(self, max_depth: Optional[int] = None) -> List["Role"]:
+        """Inherited roles nearest first, max_depth=1 gives only the direct parents"""
+        ret = []
+        for row in await ROLE_ANCESTORS.all(bind=routing.read_bind(self.pk), role_pk=self.pk):
+            depth = row.pop("depth")
+            if max_depth is None or depth <= max_depth:
+                ret.append(load_model(Role, row))
+        return ret
+
+    async def list_parents(self) -> List["Role"]:
+        """Direct parents"""
+        return await self.list_ancestors(max_depth=1)
+
+    async def soft_delete(self) -> None:
+        """Mark deleted (on every shard), the role and what it inherits stop granting ACLs right away"""
+        await super().soft_delete()
+        await sharding.each_shard(self._soft_deleted)
+        await self._hierarchy_changed()
+
+    async def _soft_deleted(self) -> None:
+        """Rebuild the closure of descendants on one shard, inheritance does not go through deleted roles"""
+        async with db.transaction():
+            await db.scalar(sa.select([sa.func.pg_advisory_xact_lock(HIERARCHY_LOCK)]))
+            await rebuild_closure(self.pk)
+
+    async def _hierarchy_changed(self) -> None:
+        """Inherited roles (or role ACLs) of any number of users changed, cached ACLs must go"""
+        routing.pin_primary(self.pk)
+        cache = aclcache.get_cache()
+        if cache is not None:
+            await cache.invalidate_all()
+
+    @classmethod
+    async def iter_effective_roles(cls, user: User) -> AsyncGenerator[Tuple["Role", int], None]:
+        """Users roles including the inherited ones with their depth (0 for directly assigned) in merge order
+
+        Merge order is descending priority number, on the same priority the nearer role comes later so it wins.
+        Roles inherited via several paths are given only once, with the shortest depth.
+        """
+        async for row in EFFECTIVE_USER_ROLES.iterate(bind=sharding.read_bind(user.pk), user_pk=user.pk):
+            depth = row.pop("depth")
+            yield load_model(Role, row), depth
+
+    @classmethod
+    async def list_effective_roles(cls, user: User) -> List["Role"]:
+        """Effective roles of the user in merge order (see iter_effective_roles)"""
+        rows = await EFFECTIVE_USER_ROLES.all(bind=sharding.read_bind(user.pk), user_pk=user.pk)
+        return [load_model(Role, {key: value for key, value in row.items() if key != "depth"}) for row in rows]
+
     @classmethod
     async def iter_user_roles(cls, user: User) -> AsyncGenerator["Role", None]:
         """Resolve roles user has (sorted in descending priority so they're easier to merge) and yields one by one"""
-        async with db.acquire() as conn:  # Cursors need transaction
-            async with conn.transaction():
-                async for lnk in UserRole.load(role=Role).query.where(UserRole.user == user.pk).where(
-                    UserRole.deleted == None  # pylint: disable=C0121 ; # "is None" will create invalid query
-                ).order_by(Role.priority.desc()).gino.iterate():
-                    yield lnk.role
+        async for row in USER_ROLES.iterate(bind=sharding.read_bind(user.pk), user_pk=user.pk):
+            yield load_model(Role, row)
 
     @classmethod
     async def list_user_roles(cls, user: User) -> List["Role"]:
@@ -104,32 +252,316 @@ class Role(BaseModel):
             ret.append(role)
         return ret
 
+    @classmethod
+    async def list_users_with_roles(
+        cls, limit: int = DEFAULT_PAGE_SIZE, after: Optional[PageKey] = None, before: Optional[PageKey] = None
+    ) -> List[Tuple[User, List["Role"]]]:
+        """Page of (not deleted) users ordered by User.page_key() with their roles, see User.list_with_roles
+
+        When sharded every shard gives its page and the pages are merged.
+        """
+        if after is not None and before is not None:
+            raise ValueError("Give only one of after and before")
+        params: Dict[str, Any] = {"limit": limit}
+        if after is not None:
+            query = USERS_WITH_ROLES_AFTER
+            params["key_displayname"], params["key_pk"] = after
+        elif before is not None:
+            query = USERS_WITH_ROLES_BEFORE
+            params["key_displayname"], params["key_pk"] = before
+        else:
+            query = USERS_WITH_ROLES
+        results = await sharding.each_shard(lambda: query.all(bind=routing.read_bind(), **params))
+        pages: List[List[Tuple[User, List[Role]]]] = []
+        for rows in results:
+            page: List[Tuple[User, List[Role]]] = []
+            for row in rows:
+                if not page or page[-1][0].pk != row["user_pk"]:
+                    page.append((load_model(User, {name: row[f"user_{name}"] for name in USER_COLUMNS}), []))
+                if row["role_pk"] is not None:
+                    page[-1][1].append(load_model(Role, {name: row[f"role_{name}"] for name in ROLE_COLUMNS}))
+            pages.append(page)
+        if len(pages) == 1:
+            ret = pages[0]
+        else:  # each page is in query order, closest to the key first
+            ret = list(heapq.merge(*pages, key=lambda entry: entry[0].page_key(), reverse=before is not None))[:limit]
+        if before is not None:
+            ret.reverse()
+        return ret
+
     @classmethod
     async def resolve_user_acl(cls, user: User) -> ACL:
-        """Merge ACL from users' roles"""
-        by_privilege = {item.privilege: item for item in User.default_acl}
-        prev_priority = 10000
-        async for role in cls.iter_user_roles(user):
-            for item in ACL(role.acl):
-                if item.privilege not in by_privilege:
-                    by_privilege[item.privilege] = item
-                    continue
-                if role.priority < prev_priority:  # lower priority number is more important
-                    by_privilege[item.privilege] = item
-                    continue
-                if item.action is False:
-                    by_privilege[item.privilege] = item  # DENY actions are more important
-                if not by_privilege[item.privilege] is False and item.privilege:
-                    by_privilege[item.privilege] = item
-            prev_priority = role.priority
-        return ACL(list(by_privilege.values()))
-
-
-class UserRole(BaseModel):  # pylint: disable=R0903
+        """Merge ACL from users' roles, uses aclcache if configured"""
+        cache = aclcache.get_cache()
+        if cache is None:
+            return await cls.merge_user_acl(user)
+        cached, generation = await cache.get(user.pk)
+        if cached is not None:
+            return cached
+        with routing.use_primary():  # Lagging replica could leave stale ACL in the shared cache
+            acl = await cls.merge_user_acl(user)
+        await cache.set(user.pk, acl, generation)
+        return acl
+
+    @classmethod
+    async def merge_user_acl(cls, user: User) -> ACL:
+        """Merge ACL from users' roles, including inherited ones (always from database)
+
+        Merged ACLs are shared between users with the same roles via aclcache.MergeMemo, do not modify them.
+        """
+        memo = aclcache.get_merge_memo()
+        rows = await EFFECTIVE_USER_ROLE_ACLS.all(bind=sharding.read_bind(user.pk), user_pk=user.pk)
+        if memo is None:
+            return merge_acls(User.default_acl, [(row["priority"], ACL(row["acl"])) for row in rows])
+        fingerprint = aclcache.role_set_fingerprint(rows)
+        acl = memo.get(fingerprint)
+        if acl is None:
+            acl = merge_acls(User.default_acl, [(row["priority"], ACL(row["acl"])) for row in rows])
+            memo.set(fingerprint, acl)
+        return acl
+
+
+class UserRole(sharding.UserShardedModel):  # pylint: disable=R0903
     """Link Users and Roles"""
 
     __tablename__ = "userroles"
+    shard_by = "user"
 
     user = sa.Column(saUUID(), sa.ForeignKey(User.pk))
     role = sa.Column(saUUID(), sa.ForeignKey(Role.pk))
     _idx = sa.Index("user_role_unique", "user", "role", unique=True)
+    # The hot queries only look at live links
+    _user_live_idx = sa.Index("ix_a11n_userroles_user_live", "user", postgresql_where=sa.text("deleted IS NULL"))
+    _role_live_idx = sa.Index("ix_a11n_userroles_role_live", "role", postgresql_where=sa.text("deleted IS NULL"))
+
+    @classmethod
+    async def get_link(cls, role_pk: Union[uuid.UUID, str], user_pk: Union[uuid.UUID, str]) -> Optional["UserRole"]:
+        """Get the link between role and user (including deleted ones)"""
+        row = await USERROLE_BY_ROLE_AND_USER.first(role_pk=role_pk, user_pk=user_pk)
+        if row is None:
+            return None
+        return load_model(cls, row)
+
+
+class RoleParent(BaseModel):  # pylint: disable=R0903
+    """Role inheritance: role gets the ACLs of parent (and its ancestors), see RoleClosure"""
+
+    __tablename__ = "role_parents"
+
+    role = sa.Column(saUUID(), sa.ForeignKey(Role.pk), nullable=False)
+    parent = sa.Column(saUUID(), sa.ForeignKey(Role.pk), nullable=False)
+    _idx = sa.Index("role_parent_unique", "role", "parent", unique=True)
+
+
+class RoleClosure(DBModel):  # pylint: disable=R0903
+    """Every (descendant, ancestor) pair of the role hierarchy with the shortest depth, rebuilt on change
+
+    Lets the effective roles of a user be resolved with plain joins instead of walking the hierarchy.
+    """
+
+    __tablename__ = "role_closure"
+    __table_args__ = {"schema": TABLE_SCHEMA}
+
+    descendant = sa.Column(saUUID(), sa.ForeignKey(Role.pk), primary_key=True)
+    ancestor = sa.Column(saUUID(), sa.ForeignKey(Role.pk), primary_key=True)
+    depth = sa.Column(sa.Integer, nullable=False)
+    _ancestor_idx = sa.Index("ix_a11n_role_closure_ancestor", "ancestor")
+
+
+async def rebuild_closure(role_pk: Union[uuid.UUID, str]) -> None:
+    """Rebuild the closure rows of role and its descendants from RoleParent (call in transaction after changes)
+
+    Soft-deleted parents are skipped, their ancestors are inherited only via other paths.
+    """
+    closure = RoleClosure.__table__
+    affected = [role_pk] + [
+        row[0] for row in await db.all(sa.select([closure.c.descendant]).where(closure.c.ancestor == role_pk))
+    ]
+    pks = sa.bindparam("role_pks", affected, type_=ARRAY(saUUID()))
+    await db.status(closure.delete().where(closure.c.descendant == sa.func.any(pks)))
+    roles = Role.__table__
+    parents = RoleParent.__table__.join(
+        roles, sa.and_(roles.c.pk == RoleParent.parent, roles.c.deleted == None)  # pylint: disable=C0121
+    )
+    walk = (
+        sa.select(
+            [
+                RoleParent.role.label("descendant"),
+                RoleParent.parent.label("ancestor"),
+                sa.literal_column("1", sa.Integer).label("depth"),
+            ]
+        )
+        .select_from(parents)
+        .where(RoleParent.role == sa.func.any(pks))
+        .cte("walk", recursive=True)
+    )
+    walk = walk.union(
+        sa.select([walk.c.descendant, RoleParent.parent, walk.c.depth + 1]).select_from(
+            walk.join(parents, RoleParent.role == walk.c.ancestor)
+        )
+    )
+    nearest = sa.select([walk.c.descendant, walk.c.ancestor, sa.func.min(walk.c.depth)]).group_by(
+        walk.c.descendant, walk.c.ancestor
+    )
+    await db.status(closure.insert().from_select(["descendant", "ancestor", "depth"], nearest))
+
+
+def effective_user_roles_query(columns: Optional[Sequence[Any]] = None) -> Any:
+    """Directly assigned and inherited roles of user with the shortest depth, in merge order
+
+    columns defaults to all Role columns and the depth. Soft-deleted links and roles are left out, so are the roles
+    inherited only via a deleted one.
+    """
+    # pylint: disable=C0121 ; # "is None" will create invalid query
+    links = UserRole.__table__
+    closure = RoleClosure.__table__
+    roles = Role.__table__
+    assigned = roles.alias("assigned")
+    user_pk = sa.bindparam("user_pk", type_=saUUID())
+    live_links = links.join(assigned, sa.and_(assigned.c.pk == links.c.role, assigned.c.deleted == None))
+    direct = (
+        sa.select([links.c.role, sa.literal_column("0", sa.Integer).label("depth")])
+        .select_from(live_links)
+        .where(links.c.user == user_pk)
+        .where(links.c.deleted == None)
+    )
+    inherited = (
+        sa.select([closure.c.ancestor, closure.c.depth])
+        .select_from(live_links.join(closure, closure.c.descendant == links.c.role))
+        .where(links.c.user == user_pk)
+        .where(links.c.deleted == None)
+    )
+    paths = sa.union_all(direct, inherited).alias("paths")
+    nearest = (
+        sa.select([paths.c.role, sa.func.min(paths.c.depth).label("depth")]).group_by(paths.c.role).alias("nearest")
+    )
+    return (
+        sa.select([roles, nearest.c.depth] if columns is None else list(columns))
+        .select_from(nearest.join(roles, roles.c.pk == nearest.c.role))
+        .where(roles.c.deleted == None)
+        .order_by(roles.c.priority.desc(), nearest.c.depth.desc(), roles.c.pk)
+    )
+
+
+# The fixed shape hot queries, see models.prepared
+# pylint: disable=C0121 ; # "is None" will create invalid query
+USERROLE_BY_ROLE_AND_USER = PreparedQuery(
+    lambda: sa.select([UserRole.__table__])
+    .where(UserRole.role == sa.bindparam("role_pk", type_=saUUID()))
+    .where(UserRole.user == sa.bindparam("user_pk", type_=saUUID()))
+)
+SET_USERROLE_DELETED = PreparedQuery(
+    lambda: UserRole.__table__.update()
+    .where(UserRole.pk == sa.bindparam("userrole_pk", type_=saUUID()))
+    .values(deleted=sa.bindparam("deleted_at", type_=sa.DateTime(timezone=True)))
+)
+USER_ROLES = PreparedQuery(
+    lambda: sa.select([Role.__table__])
+    .select_from(UserRole.__table__.join(Role.__table__, UserRole.role == Role.pk))
+    .where(UserRole.user == sa.bindparam("user_pk", type_=saUUID()))
+    .where(UserRole.deleted == None)
+    .where(Role.deleted == None)
+    .order_by(Role.priority.desc())
+)
+ROLE_USERS = PreparedQuery(
+    lambda: sa.select([User.__table__])
+    .select_from(UserRole.__table__.join(User.__table__, UserRole.user == User.pk))
+    .where(UserRole.role == sa.bindparam("role_pk", type_=saUUID()))
+    .where(UserRole.deleted == None)
+    .where(User.deleted == None)
+    .order_by(User.displayname)
+)
+
+
+@functools.lru_cache(maxsize=32)
+def role_users_query(columns: Tuple[str, ...]) -> PreparedQuery:
+    """ROLE_USERS with only the given User columns"""
+    unknown = set(columns) - set(User.__table__.c.keys())
+    if unknown or not columns:
+        raise ValueError(f"Invalid User columns: {sorted(unknown)}")
+    return PreparedQuery(
+        lambda: sa.select([User.__table__.c[name] for name in columns])
+        .select_from(UserRole.__table__.join(User.__table__, UserRole.user == User.pk))
+        .where(UserRole.role == sa.bindparam("role_pk", type_=saUUID()))
+        .where(UserRole.deleted == None)
+        .where(User.deleted == None)
+        .order_by(User.displayname)
+    )
+
+
+def _key_order(columns: List[Any], descending: bool) -> List[Any]:
+    """Order by columns, optionally descending"""
+    if descending:
+        return [column.desc() for column in columns]
+    return columns
+
+
+def users_with_roles_query(direction: Optional[str]) -> PreparedQuery:
+    """Page of users joined with their roles, direction None for first page, "after" or "before" the key"""
+
+    def builder() -> Any:
+        users = User.__table__
+        query = sa.select([users]).where(users.c.deleted == None)
+        key = sa.tuple_(users.c.displayname, users.c.pk)
+        bound_key = sa.tuple_(
+            sa.bindparam("key_displayname", type_=sa.Unicode()), sa.bindparam("key_pk", type_=saUUID())
+        )
+        if direction == "after":
+            query = query.where(key > bound_key)
+        elif direction == "before":
+            query = query.where(key < bound_key)
+        # before-pages take the closest ones first, the result is reversed in Python
+        descending = direction == "before"
+        query = query.order_by(*_key_order([users.c.displayname, users.c.pk], descending))
+        page = query.limit(sa.bindparam("limit", type_=sa.Integer())).alias("page")
+        links = UserRole.__table__
+        roles = Role.__table__
+        joined = page.outerjoin(links, sa.and_(links.c.user == page.c.pk, links.c.deleted == None)).outerjoin(
+            roles, sa.and_(roles.c.pk == links.c.role, roles.c.deleted == None)
+        )
+        columns = [page.c[name].label(f"user_{name}") for name in USER_COLUMNS]
+        columns += [roles.c[name].label(f"role_{name}") for name in ROLE_COLUMNS]
+        return (
+            sa.select(columns)
+            .select_from(joined)
+            .order_by(*_key_order([page.c.displayname, page.c.pk], descending), roles.c.priority.desc())
+        )
+
+    return PreparedQuery(builder)
+
+
+USER_COLUMNS = tuple(User.__table__.c.keys())
+ROLE_COLUMNS = tuple(Role.__table__.c.keys())
+USERS_WITH_ROLES = users_with_roles_query(None)
+USERS_WITH_ROLES_AFTER = users_with_roles_query("after")
+USERS_WITH_ROLES_BEFORE = users_with_roles_query("before")
+
+EFFECTIVE_USER_ROLES = PreparedQuery(effective_user_roles_query)
+# the digest of the content, not updated: that is the transaction start time and the same for all changes within one
+EFFECTIVE_USER_ROLE_ACLS = PreparedQuery(
+    lambda: effective_user_roles_query(
+        [Role.pk, Role.priority, Role.acl, sa.func.md5(sa.cast(Role.acl, sa.Text)).label("acl_digest")]
+    )
+)
+ROLE_ANCESTORS = PreparedQuery(
+    lambda: sa.select([Role.__table__, RoleClosure.depth])
+    .select_from(RoleClosure.__table__.join(Role.__table__, Role.pk == RoleClosure.ancestor))
+    .where(RoleClosure.descendant == sa.bindparam("role_pk", type_=saUUID()))
+    .where(Role.deleted == None)
+    .order_by(RoleClosure.depth, Role.priority, Role.pk)
+)
+ROLE_CLOSURE_ROW = PreparedQuery(
+    lambda: sa.select([RoleClosure.__table__])
+    .where(RoleClosure.descendant == sa.bindparam("descendant_pk", type_=saUUID()))
+    .where(RoleClosure.ancestor == sa.bindparam("ancestor_pk", type_=saUUID()))
+)
+ROLE_PARENT_LINK = PreparedQuery(
+    lambda: sa.select([RoleParent.__table__])
+    .where(RoleParent.role == sa.bindparam("role_pk", type_=saUUID()))
+    .where(RoleParent.parent == sa.bindparam("parent_pk", type_=saUUID()))
+)
+DELETE_ROLE_PARENT = PreparedQuery(
+    lambda: RoleParent.__table__.delete()
+    .where(RoleParent.role == sa.bindparam("role_pk", type_=saUUID()))
+    .where(RoleParent.parent == sa.bindparam("parent_pk", type_=saUUID()))
+)
@@ -0,0 +1,130 @@
+"""Route read-only queries to read replicas
+
+Configure replicas with DB_REPLICA_DSNS and bind them with bind_replicas() after db.set_bind(), read-only model
+methods then use read_bind() to pick a replica round-robin. Replicas lag behind the primary so writes that affect
+the read-only paths (like Role.assign_to) call pin_primary() which makes reads from the same context (asyncio task),
+and reads about the same keys in this process, go to the primary for DB_REPLICA_PIN_SECONDS. Wrap code that must
+see its own writes in use_primary().
+"""
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+from contextlib import contextmanager
+from contextvars import ContextVar
+import itertools
+import logging
+import time
+import uuid
+
+import gino
+from sqlalchemy.engine.url import URL, make_url
+
+from .. import dbconfig
+from .base import db, scoped_bind
+
+LOGGER = logging.getLogger(__name__)
+PIN_PRUNE_SIZE = 10000
+REPLICAS: List[Any] = []  # GinoEngines
+_ROUND_ROBIN = itertools.count()
+_PINNED_KEYS: Dict[str, float] = {}  # key -> time.monotonic() deadline
+_PRIMARY_UNTIL: ContextVar[float] = ContextVar("arkia11nmodels_primary_until", default=0.0)
+_SCOPED_REPLICA: ContextVar[Any] = ContextVar("arkia11nmodels_scoped_replica", default=None)
+
+
+async def bind_replicas(dsns: Optional[Sequence[Union[str, URL]]] = None, **kwargs: Any) -> List[Any]:
+    """Create engines for the replicas (default dbconfig.REPLICA_DSNS), kwargs are passed to gino.create_engine"""
+    if dsns is None:
+        dsns = list(dbconfig.REPLICA_DSNS)
+    kwargs.setdefault("min_size", dbconfig.POOL_MIN_SIZE)
+    kwargs.setdefault("max_size", dbconfig.POOL_MAX_SIZE)
+    for dsn in dsns:
+        url = make_url(dsn) if isinstance(dsn, str) else dsn
+        LOGGER.debug("Binding replica {}".format(repr(url)))
+        REPLICAS.append(await gino.create_engine(url, **kwargs))
+    return REPLICAS
+
+
+async def close_replicas() -> None:
+    """Close the replica engines"""
+    while REPLICAS:
+        await REPLICAS.pop().close()
+
+
+def _key(key: Union[uuid.UUID, str]) -> str:
+    """Normalize key"""
+    return str(key)
+
+
+def pin_primary(*keys: Union[uuid.UUID, str], seconds: Optional[float] = None) -> None:
+    """Read from the primary for a while in this context and for the given keys in this process"""
+    now = time.monotonic()
+    deadline = now + (dbconfig.REPLICA_PIN_SECONDS if seconds is None else seconds)
+    if deadline > _PRIMARY_UNTIL.get():
+        _PRIMARY_UNTIL.set(deadline)
+    for key in keys:
+        _PINNED_KEYS[_key(key)] = deadline
+    if len(_PINNED_KEYS) > PIN_PRUNE_SIZE:
+        for expired in [key for key, until in _PINNED_KEYS.items() if until <= now]:
+            del _PINNED_KEYS[expired]
+
+
+@contextmanager
+def use_primary() -> Iterator[None]:
+    """Read from the primary within the block"""
+    token = _PRIMARY_UNTIL.set(float("inf"))
+    try:
+        yield None
+    finally:
+        _PRIMARY_UNTIL.reset(token)
+
+
+def is_pinned(key: Optional[Union[uuid.UUID, str]] = None) -> bool:
+    """Should reads (about key) go to the primary"""
+    now = time.monotonic()
+    if _PRIMARY_UNTIL.get() > now:
+        return True
+    if key is None:
+        return False
+    until = _PINNED_KEYS.get(_key(key))
+    if until is None:
+        return False
+    if until <= now:
+        _PINNED_KEYS.pop(_key(key), None)
+        return False
+    return True
+
+
+def next_replica() -> Any:
+    """Next replica in turn, None if no replicas are bound"""
+    if not REPLICAS:
+        return None
+    return REPLICAS[next(_ROUND_ROBIN) % len(REPLICAS)]
+
+
+@contextmanager
+def use_replica(replica: Any) -> Iterator[None]:
+    """Read from the given replica within the block (unless pinned to primary), see models.scope"""
+    token = _SCOPED_REPLICA.set(replica)
+    try:
+        yield None
+    finally:
+        _SCOPED_REPLICA.reset(token)
+
+
+def in_primary_transaction() -> bool:
+    """Is there a transaction open on the primary connection of this context"""
+    conn = db.bind.current_connection if db.bind is not None else None
+    if conn is None or conn.raw_connection is None:  # lazy connections are not acquired until used
+        return False
+    return bool(conn.raw_connection.is_in_transaction())
+
+
+def read_bind(key: Optional[Union[uuid.UUID, str]] = None) -> Any:
+    """Bind for a read-only query (about key): replica, or the primary when pinned or no replicas are bound
+
+    Inside base.use_bind() (like a shard picked by models.sharding) always db, which uses the scoped bind.
+    """
+    if not REPLICAS or scoped_bind() is not None or is_pinned(key) or in_primary_transaction():
+        return db
+    scoped = _SCOPED_REPLICA.get()
+    if scoped is not None:
+        return scoped
+    return next_replica()
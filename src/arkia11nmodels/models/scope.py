@@ -0,0 +1,30 @@
+"""Scope one connection to a block (like a HTTP request), see also middleware.DBConnectionMiddleware
+
+Gino keeps the connections acquired in the current context (asyncio task) in a context variable and the model
+methods acquire with reuse=True so within connection_scope() they all use the same connection instead of each
+borrowing one from the pool. The connections are acquired lazily on first use and returned at the end of the block.
+
+Do not run queries concurrently (asyncio.gather etc) inside the scope, the tasks would share the connection.
+The models' own fan-outs (sharding.each_shard, the loader batches) run one query at a time within the scope.
+"""
+from typing import Any, AsyncIterator
+from contextlib import asynccontextmanager
+import logging
+
+from .base import db
+from . import routing
+
+LOGGER = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def connection_scope() -> AsyncIterator[Any]:
+    """Use one primary connection (and one replica connection if replicas are bound) within the block"""
+    async with db.acquire(lazy=True) as conn:
+        replica = routing.next_replica()
+        if replica is None:
+            yield conn
+            return
+        async with replica.acquire(lazy=True):
+            with routing.use_replica(replica):
+                yield conn
@@ -0,0 +1,222 @@
+"""Place users and their rows on several databases by hash of the user pk
+
+Configure the other shards with DB_SHARD_DSNS and bind them with bind_shards() after db.set_bind(), the database
+db is bound to is the first shard. Every shard has the full schema (run the alembic migrations on each of them).
+
+User, Token and UserRole (UserShardedModel) rows are placed on the shard of the user pk. Token and UserRole pks are
+generated so they hash to the same shard (colocated_pk) so instance create/update/delete and Model.get(pk) find
+the right shard by the pk alone. Role (ReplicatedModel) rows are written to every shard and read from any, the role
+hierarchy too, so a users effective roles still resolve with joins on their own shard.
+
+Model methods route by themselves, in your own queries use use_shard() or shard_bind() to pick the shard of a user
+and each_shard() to fan out. Model level statements (Model.update.where() etc.) go to db.bind unless scoped.
+Replicated writes go to the shards one after another without distributed transactions, a failed write can leave
+the shards different: retry it. The number and order of the shards must not change once there is data in them.
+"""
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, TypeVar, Union
+from contextlib import contextmanager
+import asyncio
+import hashlib
+import logging
+import uuid
+
+import gino
+from gino.crud import UpdateRequest, DEFAULT
+from sqlalchemy.engine.url import URL, make_url
+
+from .. import dbconfig
+from .base import BaseModel, db, holds_connection, new_pk, scoped_bind, use_bind
+from . import routing
+
+LOGGER = logging.getLogger(__name__)
+SHARDS: List[Any] = []  # db.bind first, then the GinoEngines of DB_SHARD_DSNS
+ResultType = TypeVar("ResultType")  # pylint: disable=C0103
+KeyType = Union[uuid.UUID, str]
+
+
+async def bind_shards(dsns: Optional[Sequence[Union[str, URL]]] = None, **kwargs: Any) -> List[Any]:
+    """Create engines for the other shards (default dbconfig.SHARD_DSNS), kwargs are passed to gino.create_engine"""
+    if dsns is None:
+        dsns = list(dbconfig.SHARD_DSNS)
+    if not dsns:
+        return SHARDS
+    kwargs.setdefault("min_size", dbconfig.POOL_MIN_SIZE)
+    kwargs.setdefault("max_size", dbconfig.POOL_MAX_SIZE)
+    if not SHARDS:
+        SHARDS.append(db.bind)
+    for dsn in dsns:
+        url = make_url(dsn) if isinstance(dsn, str) else dsn
+        LOGGER.debug("Binding shard {}".format(repr(url)))
+        SHARDS.append(await gino.create_engine(url, **kwargs))
+    return SHARDS
+
+
+async def close_shards() -> None:
+    """Close the engines bind_shards() created"""
+    while len(SHARDS) > 1:
+        await SHARDS.pop().close()
+    SHARDS.clear()
+
+
+def is_sharded() -> bool:
+    """Are there more shards than db"""
+    return len(SHARDS) > 1
+
+
+def shard_index(key: KeyType) -> int:
+    """Index of the shard for the key (user pk, or pk of a row colocated with its user)"""
+    if not is_sharded():
+        return 0
+    key_bytes = key.bytes if isinstance(key, uuid.UUID) else uuid.UUID(str(key)).bytes
+    digest = hashlib.blake2b(key_bytes, digest_size=8).digest()
+    return int.from_bytes(digest, "big") % len(SHARDS)
+
+
+def shard_bind(key: KeyType) -> Any:
+    """The shard engine for key, db when not sharded"""
+    if not is_sharded():
+        return db
+    return SHARDS[shard_index(key)]
+
+
+def read_bind(key: KeyType) -> Any:
+    """Bind for a read-only query about key: its shard, or routing.read_bind() when not sharded"""
+    if not is_sharded():
+        return routing.read_bind(key)
+    return SHARDS[shard_index(key)]
+
+
+@contextmanager
+def use_shard(key: KeyType) -> Iterator[Any]:
+    """Make db use the shard of key within the block (see base.use_bind)"""
+    if not is_sharded():
+        yield db
+        return
+    with use_bind(SHARDS[shard_index(key)]) as bind:
+        yield bind
+
+
+def colocated_pk(key: KeyType) -> uuid.UUID:
+    """New pk that is on the same shard as key"""
+    pk = new_pk()
+    if not is_sharded():
+        return pk
+    wanted = shard_index(key)
+    while shard_index(pk) != wanted:  # takes len(SHARDS) tries on average
+        pk = new_pk()
+    return pk
+
+
+def holds_shard_connection() -> bool:
+    """Does this context hold a connection of some shard (like models.scope), concurrent tasks would share it"""
+    return any(holds_connection(shard) for shard in SHARDS)
+
+
+async def each_shard(func: Callable[[], Awaitable[ResultType]]) -> List[ResultType]:
+    """Run func concurrently on every shard (db scoped to the shard), results in shard order
+
+    Within a connection scope (or transaction) the shards are run one at a time instead.
+    """
+    if not is_sharded():
+        return [await func()]
+
+    async def run(shard: Any) -> ResultType:
+        with use_bind(shard):
+            return await func()
+
+    if holds_shard_connection():  # one at a time, the tasks would share the connection
+        return [await run(shard) for shard in SHARDS]
+    return list(await asyncio.gather(*(run(shard) for shard in SHARDS)))
+
+
+def group_by_shard(keys: Sequence[KeyType]) -> Dict[int, List[KeyType]]:
+    """Keys by shard index"""
+    ret: Dict[int, List[KeyType]] = {}
+    for key in keys:
+        ret.setdefault(shard_index(key), []).append(key)
+    return ret
+
+
+def replicating() -> bool:
+    """Should writes to replicated models go to every shard (not inside use_bind() for one shard)"""
+    return is_sharded() and scoped_bind() is None
+
+
+class ShardedUpdateRequest(UpdateRequest):
+    """Apply the update on the shard of the instance pk"""
+
+    async def apply(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        if bind is None and is_sharded():
+            bind = shard_bind(self._instance.pk)
+        return await super().apply(bind=bind, timeout=timeout)
+
+
+class ReplicatedUpdateRequest(UpdateRequest):
+    """Apply the update on every shard"""
+
+    async def apply(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        if bind is not None or not replicating():
+            return await super().apply(bind=bind, timeout=timeout)
+        for shard in SHARDS:
+            await super().apply(bind=shard, timeout=timeout)
+        return self
+
+
+class UserShardedModel(BaseModel):  # pylint: disable=R0903
+    """Rows placed on the shard of the user, shard_by names the column with the user pk"""
+
+    shard_by = "pk"
+    _update_request_cls = ShardedUpdateRequest
+
+    async def _create(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        """Generate a pk on the users shard and insert there"""
+        if bind is None and is_sharded():
+            user_pk = getattr(self, self.shard_by)
+            if self.pk is None:
+                self.pk = new_pk() if user_pk is None else colocated_pk(user_pk)
+            elif user_pk is not None and shard_index(self.pk) != shard_index(user_pk):
+                raise ValueError(f"pk {self.pk} is not on the shard of {user_pk}, use sharding.colocated_pk()")
+            bind = shard_bind(self.pk)
+        return await super()._create(bind=bind, timeout=timeout)
+
+    async def _delete(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        if bind is None and is_sharded():
+            bind = shard_bind(self.pk)
+        return await super()._delete(bind=bind, timeout=timeout)
+
+    @classmethod
+    async def get(cls, ident: Any, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        """Get by pk from its shard"""
+        if bind is None and is_sharded():
+            bind = shard_bind(ident)
+        return await super().get(ident, bind=bind, timeout=timeout)
+
+    @classmethod
+    async def get_live(cls, pk: KeyType, bind: Any = None) -> Any:
+        if bind is None and is_sharded():
+            bind = shard_bind(pk)
+        return await super().get_live(pk, bind)
+
+
+class ReplicatedModel(BaseModel):  # pylint: disable=R0903
+    """Rows written to every shard, read from any"""
+
+    _update_request_cls = ReplicatedUpdateRequest
+
+    async def _create(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        """Insert the same row (including pk and timestamps) to every shard"""
+        if bind is not None or not replicating():
+            return await super()._create(bind=bind, timeout=timeout)
+        if self.pk is None:
+            self.pk = new_pk()
+        for shard in SHARDS:  # the first insert fills in the defaults for the rest
+            await super()._create(bind=shard, timeout=timeout)
+        return self
+
+    async def _delete(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        if bind is not None or not replicating():
+            return await super()._delete(bind=bind, timeout=timeout)
+        statuses = []
+        for shard in SHARDS:
+            statuses.append(await super()._delete(bind=shard, timeout=timeout))
+        return statuses[0]
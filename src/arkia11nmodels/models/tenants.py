@@ -0,0 +1,161 @@
+"""Several tenants in one database, each in its own schema, sharing the connection pools
+
+By default the tables are in the schema DB_SCHEMA (default "a11n"). With DB_SCHEMA_FROM_SEARCH_PATH the tables are
+not schema qualified and PostgreSQL finds them via the search_path of the connection, tenant_scope() sets it for
+the connections used within the block (like a HTTP request, see middleware.DBConnectionMiddleware)::
+
+    async with tenant_scope("customer1"):
+        user = await User.get_by_email("someone@example.com")
+
+Outside the scopes the connections use DB_SCHEMA (bind with connect_kwargs() so new connections start with it).
+The search_path is per connection so tenants share the pool: a connection picks up the tenant on checkout with one
+extra round trip and PostgreSQL re-plans the cached prepared statements when the search_path changes. The path is
+set back when the block exits, a connection that fails to do that is terminated, and the pool runs RESET ALL on
+release which returns any connection to the search_path it was started with (connect_kwargs()). Like in
+models.scope do not run queries concurrently inside the scope, the tasks would share the connection. Sharding is
+not supported within tenant_scope().
+
+Create the tenant schemas with the alembic migrations, migrate_schemas() (or "arkia11nmodels tenant migrate")
+runs them for many schemas in parallel. dbdevhelpers.create_all(schema) does the same without alembic.
+"""
+from typing import Any, AsyncIterator, Dict, Optional, Sequence
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import asyncio
+import logging
+import re
+
+import sqlalchemy as sa
+
+from .. import dbconfig
+from .base import db
+from . import routing, sharding
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_SCHEMA = "a11n"  # migrating it keeps the alembic version in "alembic_version" like before tenants
+SCHEMA_NAME_RE = re.compile(r"^[a-z_][a-z0-9_]{0,62}$")
+_CURRENT_SCHEMA: ContextVar[Optional[str]] = ContextVar("arkia11nmodels_current_schema", default=None)
+
+
+def validate_schema(schema: str) -> str:
+    """Return schema if it is a valid name (lowercase, no quoting needed), raises ValueError otherwise"""
+    if not SCHEMA_NAME_RE.match(schema) or schema.startswith("pg_"):
+        raise ValueError(f"Invalid schema name {schema!r}")
+    return schema
+
+
+def search_path(schema: str) -> str:
+    """The search_path for tenant schema, public is included for the extensions (pg_trgm)"""
+    return f"{validate_schema(schema)}, public"
+
+
+def current_schema() -> str:
+    """Schema of the innermost tenant_scope(), DB_SCHEMA outside them"""
+    return _CURRENT_SCHEMA.get() or dbconfig.SCHEMA
+
+
+def connect_kwargs() -> Dict[str, Any]:
+    """Engine kwargs (for db.set_bind etc) to start connections with the DB_SCHEMA search_path when configured"""
+    if not dbconfig.SCHEMA_FROM_SEARCH_PATH:
+        return {}
+    return {"server_settings": {"search_path": search_path(dbconfig.SCHEMA)}}
+
+
+def version_table(schema: str) -> str:
+    """Name of the alembic version table (in public) for the schema"""
+    if schema == DEFAULT_SCHEMA:
+        return "alembic_version"
+    return f"alembic_version_{validate_schema(schema)}"
+
+
+async def _set_search_path(conn: Any, schema: Optional[str]) -> None:
+    """Set the search_path of conn to the tenant schema, or back to the default if None"""
+    path = search_path(dbconfig.SCHEMA if schema is None else schema)
+    await conn.scalar(sa.select([sa.func.set_config("search_path", path, False)]))
+
+
+async def _restore_search_path(conn: Any, schema: Optional[str]) -> None:
+    """Set the search_path of conn back to schema, terminate the connection if that fails (or is cancelled)
+
+    The connection may still be used by an outer scope, so it must not be left with the tenant's search_path.
+    """
+    try:
+        await _set_search_path(conn, schema)
+    except BaseException:
+        LOGGER.error("Could not restore the search_path of the connection, terminating it")
+        conn.raw_connection.terminate()
+        raise
+
+
+@asynccontextmanager
+async def tenant_scope(schema: str) -> AsyncIterator[Any]:
+    """Use schema for the queries within the block, yields the primary connection (see module docs)"""
+    if not dbconfig.SCHEMA_FROM_SEARCH_PATH and schema != dbconfig.SCHEMA:
+        raise ValueError(f"Tables are in schema {dbconfig.SCHEMA}, set DB_SCHEMA_FROM_SEARCH_PATH to use {schema}")
+    if sharding.is_sharded():
+        raise ValueError("tenant_scope() does not support sharding")
+    validate_schema(schema)
+    outer = _CURRENT_SCHEMA.get()
+    token = _CURRENT_SCHEMA.set(schema)
+    try:
+        async with db.acquire(reuse=True) as conn:
+            try:
+                await _set_search_path(conn, schema)
+                replica = routing.next_replica()
+                if replica is None:
+                    yield conn
+                    return
+                async with replica.acquire(reuse=True) as replica_conn:
+                    try:
+                        await _set_search_path(replica_conn, schema)
+                        with routing.use_replica(replica):
+                            yield conn
+                    finally:
+                        await _restore_search_path(replica_conn, outer)
+            finally:
+                # the connection may outlive the block (connection_scope or outer tenant_scope)
+                await _restore_search_path(conn, outer)
+    finally:
+        _CURRENT_SCHEMA.reset(token)
+
+
+async def migrate_schema(schema: str, revision: str = "head", alembic_args: Sequence[str] = ()) -> int:
+    """Run "alembic upgrade" for schema in a subprocess, returns the exit code"""
+    # the alembic script, "python -m" would import the migrations directory "alembic" from cwd instead
+    cmd = ["alembic", *alembic_args, "-x", f"schema={validate_schema(schema)}"]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, "upgrade", revision, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    output, _ = await proc.communicate()
+    if proc.returncode:
+        LOGGER.error("Migrating schema {} failed:\n{}".format(schema, output.decode("utf-8", "replace")))
+    return int(proc.returncode or 0)
+
+
+async def migrate_schemas(
+    schemas: Sequence[str], parallel: int = 4, revision: str = "head", alembic_args: Sequence[str] = ()
+) -> Dict[str, int]:
+    """Migrate schemas with at most parallel alembic processes, returns exit codes by schema
+
+    The first schema is migrated alone so the database wide objects (extensions) exist before the rest start.
+    """
+    schemas = [validate_schema(schema) for schema in schemas]
+    if not schemas:
+        return {}
+    ret = {schemas[0]: await migrate_schema(schemas[0], revision, alembic_args)}
+    semaphore = asyncio.Semaphore(max(parallel, 1))
+
+    async def limited(schema: str) -> int:
+        async with semaphore:
+            return await migrate_schema(schema, revision, alembic_args)
+
+    codes = await asyncio.gather(*(limited(schema) for schema in schemas[1:]))
+    ret.update(zip(schemas[1:], codes))
+    return ret
+
+
+def migration_schema() -> str:
+    """The schema alembic is migrating (see alembic/env.py), for the migrations"""
+    from alembic import context  # pylint: disable=C0415,E0611 ; # optional dependency, pylint sees ./alembic
+
+    return str(context.config.attributes.get("schema", dbconfig.SCHEMA))
@@ -1,23 +1,49 @@
 """The one-time tokens"""
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Union, List, Iterable, AsyncIterable, AsyncIterator
+import asyncio
 import datetime
+import uuid
 
 from sqlalchemy.dialects.postgresql import UUID as saUUID, JSONB
 import sqlalchemy as sa
 import pendulum
 from pendulum.duration import Duration
 
-from .base import BaseModel
+from .base import db, use_bind
 from .user import User
+from .prepared import PreparedQuery, load_model
+from . import sharding
 
 DEFAULT_EXPIRES = pendulum.duration(seconds=5 * 60)
 TimeOrDuration = Union[datetime.datetime, Duration]
+ISSUE_BATCH_SIZE = 5000  # rows per COPY in issue_many
+ISSUE_COLUMNS = ("pk", "user", "sent_to", "redirect", "expires", "created", "updated")
 
 
-class Token(BaseModel):
+def expires_at(expires: Optional[TimeOrDuration] = None, now: Optional[datetime.datetime] = None) -> datetime.datetime:
+    """Resolve expiry time from time or duration (from now), None means DEFAULT_EXPIRES"""
+    if expires is None:
+        expires = DEFAULT_EXPIRES
+    if isinstance(expires, Duration):
+        return (now or pendulum.now("UTC")) + expires
+    return expires
+
+
+async def _aiter(items: Union[Iterable[Any], AsyncIterable[Any]]) -> AsyncIterator[Any]:
+    """Iterate over sync or async iterable"""
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+        return
+    for item in items:
+        yield item
+
+
+class Token(sharding.UserShardedModel):
     """Authentication token"""
 
     __tablename__ = "tokens"
+    shard_by = "user"
 
     user = sa.Column(saUUID(), sa.ForeignKey(User.pk))
     sent_to = sa.Column(sa.String(), nullable=False)
@@ -31,17 +57,105 @@ class Token(BaseModel):
         return pendulum.now("UTC") < self.expires and not self.used
 
     async def mark_used(self, audit_meta: Optional[Dict[str, Any]] = None) -> None:
-        """Mark this token used"""
-        audit_copy = dict(self.audit_meta)
-        if audit_meta:
-            raise NotImplementedError("We have not decided how to handle this")
-        await self.update(used=pendulum.now("UTC"), audit_meta=audit_copy).apply()
+        """Mark this token used, audit_meta keys are merged to the existing ones in the same UPDATE"""
+        await self.merge_jsonb("audit_meta", audit_meta, used=pendulum.now("UTC"))
 
     @classmethod
     def for_user(cls, user: User, expires: Optional[TimeOrDuration] = None) -> "Token":
         """Return one from user instance, just a shorthand"""
-        if expires is None:
-            expires = pendulum.now("UTC") + DEFAULT_EXPIRES
-        elif isinstance(expires, Duration):
-            expires = pendulum.now("UTC") + expires
-        return Token(user=user.pk, expires=expires)
+        return Token(user=user.pk, expires=expires_at(expires))
+
+    @classmethod
+    async def issue_many(
+        cls,
+        users: Union[Iterable[Any], AsyncIterable[Any]],
+        expires: Optional[TimeOrDuration] = None,
+        sent_to: Optional[str] = None,
+        redirect: Optional[str] = None,
+    ) -> List["Token"]:
+        """Create tokens for users in bulk with COPY (all or none), returns the created tokens
+
+        Users can be anything with pk and email, like the records from Role.iter_role_user_records, and can be
+        an async iterable so whole roles can be invited without loading all the members first. Expiry and
+        timestamps are the same for the whole batch, sent_to defaults to the users email.
+
+        When sharded the users are first grouped by shard and each shard gets its tokens in its own transaction
+        (all or none per shard), the tokens are returned grouped by shard.
+        """
+        now = pendulum.now("UTC")
+        expires = expires_at(expires, now)
+        if not sharding.is_sharded():
+            return await cls._copy_tokens(users, expires, now, sent_to, redirect)
+        groups: Dict[int, List[Any]] = {}
+        async for user in _aiter(users):
+            groups.setdefault(sharding.shard_index(user.pk), []).append(user)
+
+        async def issue_group(idx: int, group: List[Any]) -> List[Token]:
+            with use_bind(sharding.SHARDS[idx]):
+                return await cls._copy_tokens(group, expires, now, sent_to, redirect)
+
+        if sharding.holds_shard_connection():  # one at a time, the tasks would share the connection
+            results = [await issue_group(idx, group) for idx, group in sorted(groups.items())]
+        else:
+            results = list(await asyncio.gather(*(issue_group(idx, group) for idx, group in sorted(groups.items()))))
+        return [token for result in results for token in result]
+
+    @classmethod
+    async def _copy_tokens(  # pylint: disable=R0913
+        cls,
+        users: Union[Iterable[Any], AsyncIterable[Any]],
+        expires: datetime.datetime,
+        now: datetime.datetime,
+        sent_to: Optional[str],
+        redirect: Optional[str],
+    ) -> List["Token"]:
+        """COPY the tokens in one transaction on db (see issue_many)"""
+        table = cls.__table__
+        ret: List[Token] = []
+        async with db.acquire(reuse=True) as conn:
+            async with conn.transaction():
+                raw = await conn.get_raw_connection()
+                batch: List[Token] = []
+
+                async def flush() -> None:
+                    await raw.copy_records_to_table(
+                        table.name,
+                        schema_name=table.schema,
+                        columns=ISSUE_COLUMNS,
+                        records=[tuple(getattr(token, name) for name in ISSUE_COLUMNS) for token in batch],
+                    )
+                    ret.extend(batch)
+                    batch.clear()
+
+                async for user in _aiter(users):
+                    batch.append(
+                        cls(
+                            pk=sharding.colocated_pk(user.pk),
+                            user=user.pk,
+                            sent_to=sent_to or user.email,
+                            redirect=redirect,
+                            expires=expires,
+                            created=now,
+                            updated=now,
+                            audit_meta={},
+                        )
+                    )
+                    if len(batch) >= ISSUE_BATCH_SIZE:
+                        await flush()
+                if batch:
+                    await flush()
+        return ret
+
+    @classmethod
+    async def get_by_pk(cls, pk: Union[uuid.UUID, str]) -> Optional["Token"]:
+        """Get token by pk, same as .get() but via prepared statement"""
+        row = await TOKEN_BY_PK.first(bind=sharding.shard_bind(pk), token_pk=pk)
+        if row is None:
+            return None
+        return load_model(cls, row)
+
+
+# The fixed shape hot queries, see models.prepared
+TOKEN_BY_PK = PreparedQuery(
+    lambda: sa.select([Token.__table__]).where(Token.pk == sa.bindparam("token_pk", type_=saUUID()))
+)
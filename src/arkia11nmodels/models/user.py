@@ -1,21 +1,85 @@
 """User model"""
-from typing import ClassVar
+from typing import Any, AsyncIterator, ClassVar, Dict, List, Optional, Sequence, Tuple, Union, TYPE_CHECKING
+from contextlib import asynccontextmanager
+import hashlib
+import uuid
+
+from asyncpg.exceptions import UniqueViolationError
+from gino.crud import DEFAULT
 from sqlalchemy.dialects.postgresql import JSONB
 import sqlalchemy as sa
 
-from .base import BaseModel
+from .base import db
+from .prepared import PreparedQuery, load_model
+from . import routing, sharding
 from ..schemas.role import ACL, ACLItem
 
+if TYPE_CHECKING:
+    from .role import Role
+
+PageKey = Tuple[str, Union[str, uuid.UUID]]
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_SEARCH_LIMIT = 20
+ADDRESS_COLUMNS = ("email", "sms")  # token delivery addresses, unique over all shards
+
+
+async def _address_taken(name: str, value: str, pk: Optional[Union[uuid.UUID, str]]) -> bool:
+    """Has a user other than pk the address on the current shard (including soft-deleted like the unique index)"""
+    column = User.__table__.c[name]
+    query = sa.select([User.pk]).where(column == value)
+    if pk is not None:
+        query = query.where(User.pk != pk)
+    return await db.scalar(query.limit(1)) is not None
+
+
+@asynccontextmanager
+async def unique_addresses(pk: Optional[Union[uuid.UUID, str]], addresses: Dict[str, Any]) -> AsyncIterator[None]:
+    """Write the user addresses within the block, when sharded they are locked and checked on every shard first
+
+    The unique indexes only cover one shard. The advisory locks are held on the first shard until the block ends
+    so concurrent writes of the same address are checked one after another. Raises UniqueViolationError.
+    """
+    addresses = {name: value for name, value in addresses.items() if isinstance(value, str)}
+    if not addresses or not sharding.is_sharded():
+        yield None
+        return
+    keys = sorted(
+        int.from_bytes(hashlib.blake2b(f"users.{name}:{value}".encode("utf-8"), digest_size=8).digest(), "big")
+        - 2**63
+        for name, value in addresses.items()
+    )
+    async with sharding.SHARDS[0].transaction() as tx:
+        for key in keys:
+            await tx.connection.scalar(sa.select([sa.func.pg_advisory_xact_lock(key)]))
+        for name, value in addresses.items():
+            if any(await sharding.each_shard(lambda: _address_taken(name, value, pk))):  # pylint: disable=W0640
+                raise UniqueViolationError(f"duplicate key value violates unique constraint: users.{name}")
+        yield None
+
+
+class UserUpdateRequest(sharding.ShardedUpdateRequest):
+    """Check changed addresses on every shard (see unique_addresses)"""
+
+    async def apply(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        if bind is not None:
+            return await super().apply(bind=bind, timeout=timeout)
+        changed = {name: self._values[name] for name in ADDRESS_COLUMNS if name in self._values}
+        async with unique_addresses(self._instance.pk, changed):
+            return await super().apply(bind=bind, timeout=timeout)
 
-class User(BaseModel):  # pylint: disable=R0903
+
+class User(sharding.UserShardedModel):  # pylint: disable=R0903
     """Users"""
 
     __tablename__ = "users"
+    _update_request_cls = UserUpdateRequest
 
     email = sa.Column(sa.String(), nullable=False, index=True, unique=True)
     sms = sa.Column(sa.String(), nullable=True, index=True, unique=True)
     displayname = sa.Column(sa.Unicode(), nullable=False, default=lambda ctx: ctx.current_parameters.get("email"))
     profile = sa.Column(JSONB, nullable=False, server_default="{}")
+    # email and displayname also have pg_trgm GIN indexes for search(), they are created by the
+    # alembic migration only since they need the extension
 
     default_acl: ClassVar[ACL] = ACL(
         [
@@ -28,3 +92,81 @@ class User(BaseModel):  # pylint: disable=R0903
             # they must not be allowed to change the delivery addresses for a full account takeover
         ]
     )
+
+    async def _create(self, bind: Any = None, timeout: Any = DEFAULT) -> Any:
+        """Check the addresses on every shard when sharded (see unique_addresses)"""
+        if bind is not None:
+            return await super()._create(bind=bind, timeout=timeout)
+        async with unique_addresses(self.pk, {name: getattr(self, name) for name in ADDRESS_COLUMNS}):
+            return await super()._create(bind=bind, timeout=timeout)
+
+    @classmethod
+    async def get_by_email(cls, email: str) -> Optional["User"]:
+        """Get (not deleted) user by email address (from every shard when sharded)"""
+        rows = await sharding.each_shard(lambda: USER_BY_EMAIL.first(email=email))
+        row = next((row for row in rows if row is not None), None)
+        if row is None:
+            return None
+        return load_model(cls, row)
+
+    @classmethod
+    async def search(cls, term: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List["User"]:
+        """Search (not deleted) users by part of email or displayname, best matches first (needs pg_trgm)"""
+        pattern = "%{}%".format(term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+        results = await sharding.each_shard(
+            lambda: USER_SEARCH.all(bind=routing.read_bind(), term=term, pattern=pattern, limit=limit)
+        )
+        rows = [row for result in results for row in result]
+        if len(results) > 1:  # best of every shard
+            rows.sort(key=lambda row: (-row["rank"], row["displayname"], row["pk"]))
+        return [load_model(cls, {key: value for key, value in row.items() if key != "rank"}) for row in rows[:limit]]
+
+    async def update_profile(self, changes: Optional[Dict[str, Any]] = None, remove: Sequence[str] = ()) -> None:
+        """Partial profile update: merge the top level keys of changes and remove the given keys in the database"""
+        await self.merge_jsonb("profile", changes, remove)
+
+    def page_key(self) -> PageKey:
+        """Keyset pagination key, users are listed in this order"""
+        return (self.displayname, self.pk)
+
+    @classmethod
+    async def list_with_roles(
+        cls, limit: int = DEFAULT_PAGE_SIZE, after: Optional[PageKey] = None, before: Optional[PageKey] = None
+    ) -> List[Tuple["User", List["Role"]]]:
+        """Page of users with their roles (in descending priority) in one query
+
+        Pass page_key() of the last user as after to get the next page, or of the first user as before
+        to get the previous page.
+        """
+        from .role import Role  # pylint: disable=C0415 ; # circular import
+
+        return await Role.list_users_with_roles(limit, after, before)
+
+
+# The fixed shape hot queries, see models.prepared
+USER_BY_EMAIL = PreparedQuery(
+    lambda: sa.select([User.__table__]).where(
+        sa.and_(User.email == sa.bindparam("email"), User.deleted == None)  # pylint: disable=C0121
+    )
+)
+
+
+def user_search_query() -> Any:
+    """Trigram similarity or substring match on email or displayname"""
+    users = User.__table__
+    term = sa.bindparam("term", type_=sa.Unicode())
+    pattern = sa.bindparam("pattern", type_=sa.Unicode())
+    # The trigram GIN indexes support both % (similarity) and ILIKE
+    matches = [users.c.email.op("%")(term), users.c.displayname.op("%")(term)]
+    matches += [users.c.email.ilike(pattern), users.c.displayname.ilike(pattern)]
+    rank = sa.func.greatest(sa.func.similarity(users.c.email, term), sa.func.similarity(users.c.displayname, term))
+    return (
+        sa.select([users, rank.label("rank")])
+        .where(users.c.deleted == None)  # pylint: disable=C0121
+        .where(sa.or_(*matches))
+        .order_by(rank.desc(), users.c.displayname, users.c.pk)
+        .limit(sa.bindparam("limit", type_=sa.Integer()))
+    )
+
+
+USER_SEARCH = PreparedQuery(user_search_query)
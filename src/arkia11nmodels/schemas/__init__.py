@@ -0,0 +1,49 @@
+"""Pydantic schemas, loaded lazily on first attribute access so importing the package stays cheap"""
+from typing import TYPE_CHECKING, Any, Dict, List
+import importlib
+
+if TYPE_CHECKING:
+    from .role import ACLItem, ACL, RoleCreate, DBRole, RoleList
+    from .token import TokenRequest, DBToken
+    from .user import UserCreate, DBUser, UserList
+
+__all__ = [
+    "ACLItem",
+    "ACL",
+    "RoleCreate",
+    "DBRole",
+    "RoleList",
+    "TokenRequest",
+    "DBToken",
+    "UserCreate",
+    "DBUser",
+    "UserList",
+]
+
+# attribute name -> submodule that defines it
+LAZY_ATTRIBUTES: Dict[str, str] = {
+    "ACLItem": ".role",
+    "ACL": ".role",
+    "RoleCreate": ".role",
+    "DBRole": ".role",
+    "RoleList": ".role",
+    "TokenRequest": ".token",
+    "DBToken": ".token",
+    "UserCreate": ".user",
+    "DBUser": ".user",
+    "UserList": ".user",
+}
+
+
+def __getattr__(name: str) -> Any:
+    """Import the submodule defining the attribute on first access"""
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value  # cache so __getattr__ is not called again
+    return value
+
+
+def __dir__() -> List[str]:
+    """Include the lazy attributes"""
+    return sorted(set(globals().keys()) | set(__all__))
@@ -0,0 +1,108 @@
+"""Compact binary encoding for ACLs, used for cache storage and as wire format between services
+
+Format (all integers little-endian)::
+
+    b"ACL" + version (1 byte)
+    string count (uint16), then for each string: length (uint16) + UTF-8 bytes
+    item count (uint16), then for each item: privilege index (uint16), target index (uint16), action (uint8)
+
+Privileges and targets share the string table so each distinct string is stored once, target index 0 means
+None (global) and other indexes are offset by one. Action is 0 for deny, 1 for grant and 2 for None (inherit).
+"""
+from typing import Dict, List, Optional
+import base64
+import struct
+import sys
+
+from .role import ACL, ACLItem
+
+MAGIC = b"ACL"
+VERSION = 1
+HEADER = MAGIC + bytes((VERSION,))
+MAX_COUNT = 0xFFFF
+COUNT = struct.Struct("<H")
+ITEM = struct.Struct("<HHB")
+ACTION_CODES: Dict[Optional[bool], int] = {False: 0, True: 1, None: 2}
+CODE_ACTIONS: Dict[int, Optional[bool]] = {code: action for action, code in ACTION_CODES.items()}
+ITEM_FIELDS = frozenset(("privilege", "action", "target"))
+
+
+def _make_item(privilege: str, target: Optional[str], action: Optional[bool]) -> ACLItem:
+    """Same as ACLItem.construct() with all fields but without its per-field default processing"""
+    item = object.__new__(ACLItem)
+    object.__setattr__(item, "__dict__", {"privilege": privilege, "action": action, "target": target})
+    object.__setattr__(item, "__fields_set__", set(ITEM_FIELDS))
+    return item
+
+
+def encode_acl(acl: ACL) -> bytes:
+    """Encode ACL to bytes"""
+    strings: Dict[str, int] = {}
+
+    def intern(value: str) -> int:
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    items = bytearray()
+    count = 0
+    for item in acl:
+        target_idx = 0 if item.target is None else intern(item.target) + 1
+        items += ITEM.pack(intern(item.privilege), target_idx, ACTION_CODES[item.action])
+        count += 1
+    if len(strings) > MAX_COUNT or count > MAX_COUNT:
+        raise ValueError(f"Too many strings ({len(strings)}) or items ({count}) to encode")
+
+    ret = bytearray(HEADER)
+    ret += COUNT.pack(len(strings))
+    for value in strings:  # dicts keep insertion order, so this is in index order
+        encoded = value.encode("utf-8")
+        if len(encoded) > MAX_COUNT:
+            raise ValueError(f"String too long to encode: {value[:32]}...")
+        ret += COUNT.pack(len(encoded))
+        ret += encoded
+    ret += COUNT.pack(count)
+    ret += items
+    return bytes(ret)
+
+
+def decode_acl(data: bytes) -> ACL:
+    """Decode encode_acl() output, raises ValueError on malformed data"""
+    if data[: len(HEADER)] != HEADER:
+        raise ValueError("Not an encoded ACL or unsupported version")
+    try:
+        offset = len(HEADER)
+        (string_count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        strings: List[str] = []
+        for _ in range(string_count):
+            (length,) = COUNT.unpack_from(data, offset)
+            offset += COUNT.size
+            strings.append(sys.intern(data[offset : offset + length].decode("utf-8")))
+            offset += length
+        (item_count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        end = offset + item_count * ITEM.size
+        if end != len(data):
+            raise ValueError("Length mismatch")
+        targets: List[Optional[str]] = [None, *strings]
+        # skip validation, the data is already known to be valid
+        acl: ACL = ACL.construct(
+            __root__=[
+                _make_item(strings[priv], targets[target], CODE_ACTIONS[action])
+                for priv, target, action in ITEM.iter_unpack(data[offset:end])
+            ]
+        )
+        return acl
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError) as exc:
+        raise ValueError(f"Malformed encoded ACL: {exc}") from exc
+
+
+def acl_to_b64(acl: ACL) -> str:
+    """Encode to URL-safe base64 string (for headers and JSON)"""
+    return base64.urlsafe_b64encode(encode_acl(acl)).decode("ascii")
+
+
+def acl_from_b64(data: str) -> ACL:
+    """Decode acl_to_b64() output"""
+    return decode_acl(base64.urlsafe_b64decode(data))
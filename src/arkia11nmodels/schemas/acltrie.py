@@ -0,0 +1,177 @@
+"""Target matching for ACL items, indexed in a trie per privilege
+
+Targets are an FQDN optionally followed by a path, like "node1.pvarki.fi/devices/radio". They are split to
+segments with the FQDN labels reversed and then the path segments ("fi", "pvarki", "node1", "devices", "radio")
+so targets under the same domain share the trie prefix. FQDN labels are case-insensitive, path segments are not.
+
+In ACL item targets a "*" segment matches exactly one segment and a "**" segment (only allowed last) matches zero
+or more segments, so "*.pvarki.fi" matches "node1.pvarki.fi" and "**.pvarki.fi" or "pvarki.fi/**" everything
+under pvarki.fi. Items without target are global and match every target.
+
+The most specific matching item wins: segments are compared from the start and at the first difference a literal
+segment beats "*" which beats "**", global items come last. Items with action None (inherit) defer to the next most
+specific match. Of items with the same privilege and target the first deny wins, otherwise the first one.
+A check walks the trie along the target so its cost depends on the target depth, not on the ACL size::
+
+    matcher = ACLMatcher(acl)
+    if matcher.check("fi.pvarki.device:read", "node1.pvarki.fi/devices/radio"):
+        ...
+
+For listings use the batch methods (or ACL.filter_allowed) instead of calling check() in a loop.
+"""
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+if TYPE_CHECKING:
+    from .role import ACLItem  # role imports this module for ACL.filter_allowed
+
+WILDCARD = "*"
+RECURSIVE_WILDCARD = "**"
+TargetType = TypeVar("TargetType", bound=Optional[str])  # pylint: disable=C0103
+
+
+def target_segments(target: str) -> List[str]:
+    """Split target to trie segments, reversed FQDN labels followed by path segments"""
+    host, sep, path = target.partition("/")
+    segments = host.lower().split(".")
+    segments.reverse()
+    if sep:
+        segments += [segment for segment in path.split("/") if segment]
+    return segments
+
+
+def _item_wins(new: "ACLItem", old: "ACLItem") -> bool:
+    """Which of the items with same privilege and target to keep"""
+    return new.action is False and old.action is not False
+
+
+class _Node:  # pylint: disable=R0903
+    """Trie node"""
+
+    __slots__ = ("children", "item")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        self.item: Optional["ACLItem"] = None
+
+
+def _matches(node: _Node, segments: Sequence[str], pos: int) -> Iterator["ACLItem"]:
+    """Items matching segments[pos:] under node, most specific first"""
+    if pos == len(segments):
+        if node.item is not None:
+            yield node.item
+    else:
+        child = node.children.get(segments[pos])
+        if child is not None:
+            yield from _matches(child, segments, pos + 1)
+        child = node.children.get(WILDCARD)
+        if child is not None:
+            yield from _matches(child, segments, pos + 1)
+    child = node.children.get(RECURSIVE_WILDCARD)
+    if child is not None and child.item is not None:
+        yield child.item
+
+
+def _decide(node: _Node, segments: Sequence[str], pos: int) -> Optional["ACLItem"]:
+    """First non-inherit item of _matches() without the generator overhead, for the batch checks"""
+    if pos == len(segments):
+        item = node.item
+        if item is not None and item.action is not None:
+            return item
+    else:
+        child = node.children.get(segments[pos])
+        if child is not None:
+            found = _decide(child, segments, pos + 1)
+            if found is not None:
+                return found
+        child = node.children.get(WILDCARD)
+        if child is not None:
+            found = _decide(child, segments, pos + 1)
+            if found is not None:
+                return found
+    child = node.children.get(RECURSIVE_WILDCARD)
+    if child is not None and child.item is not None and child.item.action is not None:
+        return child.item
+    return None
+
+
+class ACLMatcher:
+    """Index of ACL items by privilege and target, build once and check many times"""
+
+    def __init__(self, items: Iterable["ACLItem"]) -> None:
+        self._tries: Dict[str, _Node] = {}
+        self._globals: Dict[str, "ACLItem"] = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item: "ACLItem") -> None:
+        """Index item, raises ValueError if the target has "**" anywhere but last"""
+        if item.target is None:
+            old = self._globals.get(item.privilege)
+            if old is None or _item_wins(item, old):
+                self._globals[item.privilege] = item
+            return
+        segments = target_segments(item.target)
+        if RECURSIVE_WILDCARD in segments[:-1]:
+            raise ValueError(f"'{RECURSIVE_WILDCARD}' must be the last segment, got target {item.target}")
+        node = self._tries.setdefault(item.privilege, _Node())
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        if node.item is None or _item_wins(item, node.item):
+            node.item = item
+
+    def iter_matches(self, privilege: str, target: Optional[str]) -> Iterator["ACLItem"]:
+        """Items of privilege matching target, most specific first, None target matches only global items"""
+        root = self._tries.get(privilege)
+        if root is not None and target is not None:
+            yield from _matches(root, target_segments(target), 0)
+        if privilege in self._globals:
+            yield self._globals[privilege]
+
+    def match(self, privilege: str, target: Optional[str]) -> Optional["ACLItem"]:
+        """The deciding item: most specific match that is not inherit, None if there is no such item"""
+        for item in self.iter_matches(privilege, target):
+            if item.action is not None:
+                return item
+        return None
+
+    def check(self, privilege: str, target: Optional[str]) -> bool:
+        """True if privilege is granted for target, no matching item means deny"""
+        item = self.match(privilege, target)
+        return item is not None and bool(item.action)
+
+    def allowed_mask(self, privilege: str, targets: Sequence[Optional[str]]) -> List[bool]:
+        """check() for each of the targets in one pass, repeated targets are resolved only once"""
+        fallback = self.match(privilege, None)
+        default = fallback is not None and bool(fallback.action)
+        root = self._tries.get(privilege)
+        if root is None:
+            return [default] * len(targets)
+        resolved: Dict[Optional[str], bool] = {None: default}
+        mask = []
+        for target in targets:
+            allowed = resolved.get(target)
+            if allowed is None:
+                item = _decide(root, target_segments(target), 0)  # type: ignore[arg-type] # None is resolved
+                allowed = resolved[target] = default if item is None else bool(item.action)
+            mask.append(allowed)
+        return mask
+
+    def filter_allowed(self, privilege: str, targets: Iterable[TargetType]) -> List[TargetType]:
+        """The targets privilege is granted for, in the given order"""
+        targets = list(targets)
+        return [target for target, allowed in zip(targets, self.allowed_mask(privilege, targets)) if allowed]
+
+    def check_many(self, pairs: Iterable[Tuple[str, Optional[str]]]) -> List[bool]:
+        """check() for each (privilege, target) pair, batched by privilege"""
+        pairs = list(pairs)
+        by_privilege: Dict[str, List[int]] = {}
+        for idx, (privilege, _) in enumerate(pairs):
+            by_privilege.setdefault(privilege, []).append(idx)
+        ret = [False] * len(pairs)
+        for privilege, idxs in by_privilege.items():
+            for idx, allowed in zip(idxs, self.allowed_mask(privilege, [pairs[idx][1] for idx in idxs])):
+                ret[idx] = allowed
+        return ret
@@ -1,5 +1,5 @@
 """Pydantic schemas for models.Role"""
-from typing import Optional, Sequence
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 import logging
 import uuid
 
@@ -9,6 +9,7 @@ from pydantic_collections import BaseCollectionModel
 from libadvian.binpackers import ensure_str, uuid_to_b64
 
 from .base import CreateBase, DBBase
+from .acltrie import ACLMatcher
 
 
 # pylint: disable=R0903
@@ -24,13 +25,46 @@ class ACLItem(BaseModel, extra="forbid"):
         default=False, description="True for granting, False for denying, None for 'inherit'"
     )
     target: Optional[str] = Field(
-        default=None, nullable=True, description="Target (if not null=global), start with FQDN"
+        default=None,
+        nullable=True,
+        description="Target (if not null=global), start with FQDN, may have /path and * or ** wildcards (see acltrie)",
     )
 
 
 class ACL(BaseCollectionModel[ACLItem]):
     """Sequence of ACLItems"""
 
+    def filter_allowed(self, privilege: str, targets: Iterable[Optional[str]]) -> List[Optional[str]]:
+        """The targets privilege is granted for, indexes the ACL once for the whole batch (see acltrie)"""
+        return ACLMatcher(self).filter_allowed(privilege, targets)
+
+    def check_many(self, pairs: Iterable[Tuple[str, Optional[str]]]) -> List[bool]:
+        """Is privilege granted for target for each (privilege, target) pair (see acltrie)"""
+        return ACLMatcher(self).check_many(pairs)
+
+
+def merge_acls(default_acl: Iterable[ACLItem], role_acls: Iterable[Tuple[int, Iterable[ACLItem]]]) -> ACL:
+    """Merge (priority, items) of users roles, given in descending priority number order, over the default ACL
+
+    This is the merge Role.merge_user_acl and the offline aclsnapshot resolver both use.
+    """
+    by_privilege: Dict[str, ACLItem] = {item.privilege: item for item in default_acl}
+    prev_priority = 10000
+    for priority, items in role_acls:
+        for item in items:
+            if item.privilege not in by_privilege:
+                by_privilege[item.privilege] = item
+                continue
+            if priority < prev_priority:  # lower priority number is more important
+                by_privilege[item.privilege] = item
+                continue
+            if item.action is False:
+                by_privilege[item.privilege] = item  # DENY actions are more important
+            if not by_privilege[item.privilege] is False and item.privilege:  # type: ignore[comparison-overlap]
+                by_privilege[item.privilege] = item
+        prev_priority = priority
+    return ACL(list(by_privilege.values()))
+
 
 class RoleCreate(CreateBase):
     """Create Role objects"""
@@ -1,10 +1,29 @@
-"""Helpers for tests"""
-from typing import Generator, Any
+"""Helpers for tests
+
+dockerdb gives every test session (every pytest-xdist worker) its own database cloned from a template database
+with "CREATE DATABASE ... TEMPLATE", the template is created once and again only when the models change. Tests
+that use rollbackdb run in a transaction that is rolled back afterwards, so they do not need to clean up::
+
+    from arkia11nmodels.testhelpers import monkeysession, dockerdb, rollbackdb  # in conftest.py
+
+    @pytest_asyncio.fixture
+    async def with_role(rollbackdb: Any) -> AsyncGenerator[Role, None]:
+        yield await Role.create(displayname="Testing role")  # gone after the test
+"""
+from typing import Generator, Any, Iterator, List, Tuple
+from contextlib import contextmanager
+import copy
+import hashlib
 import logging
 import asyncio
+import os
+import zlib
 
+import gino
 import pytest
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import URL
 
 
 from arkia11nmodels.dbdevhelpers import create_all
@@ -38,12 +57,14 @@ def db_is_responsive(url: sqlalchemy.engine.url.URL) -> bool:
 
         asyncio.get_event_loop().run_until_complete(create_tables())
 
+        from arkia11nmodels import dbconfig  # pylint: disable=C0415
+
         inspector = sqlalchemy.inspect(engine)
         schemas = inspector.get_schema_names()
-        if "a11n" not in schemas:
-            LOGGER.warning("a11n schema not found")
+        if dbconfig.SCHEMA not in schemas:
+            LOGGER.warning("{} schema not found".format(dbconfig.SCHEMA))
             return False
-        tables = inspector.get_table_names(schema="a11n")
+        tables = inspector.get_table_names(schema=dbconfig.SCHEMA)
         if "users" not in tables:
             LOGGER.warning("users table not found")
             return False
@@ -54,6 +75,130 @@ def db_is_responsive(url: sqlalchemy.engine.url.URL) -> bool:
         return False
 
 
+def db_is_reachable(url: URL) -> bool:
+    """Check if we can connect to the db"""
+    engine = sqlalchemy.create_engine(url)
+    try:
+        LOGGER.debug("Trying to connect to {}".format(url))
+        engine.connect().close()
+        return True
+    except sqlalchemy.exc.OperationalError:
+        # While waiting for db to come up we get this error a bunch
+        return False
+    finally:
+        engine.dispose()
+
+
+def worker_database(database: str) -> str:
+    """Name of the database for this test session, different for each pytest-xdist worker"""
+    return f"{database}_{os.environ.get('PYTEST_XDIST_WORKER', 'main')}"
+
+
+def schema_fingerprint() -> str:
+    """Digest of the DDL for the models, the template is recreated when it changes"""
+    from arkia11nmodels import dbconfig, models  # pylint: disable=C0415
+
+    metadata = models.load_all()
+    dialect = postgresql.dialect()
+    ddl: List[str] = [dbconfig.SCHEMA]
+    # pylint: disable=E1120 ; # false positive on the DDL element constructors
+    for table in metadata.sorted_tables:
+        ddl.append(str(sqlalchemy.schema.CreateTable(table).compile(dialect=dialect)))
+        ddl += sorted(str(sqlalchemy.schema.CreateIndex(index).compile(dialect=dialect)) for index in table.indexes)
+    return hashlib.sha256("\n".join(ddl).encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def database_lock(url: URL, name: str) -> Iterator[Any]:
+    """Autocommit connection (for CREATE/DROP DATABASE) holding advisory lock for name, across xdist workers"""
+    engine = sqlalchemy.create_engine(url, isolation_level="AUTOCOMMIT")
+    key = zlib.crc32(name.encode("utf-8"))
+    try:
+        with engine.connect() as conn:
+            conn.execute(sqlalchemy.text("SELECT pg_advisory_lock(:key)"), key=key)
+            try:
+                yield conn
+            finally:
+                conn.execute(sqlalchemy.text("SELECT pg_advisory_unlock(:key)"), key=key)
+    finally:
+        engine.dispose()
+
+
+async def create_template_tables(url: URL) -> None:
+    """Create the schema and tables to the database at url"""
+    from arkia11nmodels.models.base import use_bind  # pylint: disable=C0415
+
+    engine = await gino.create_engine(url)
+    try:
+        with use_bind(engine):
+            await create_all()
+    finally:
+        await engine.close()  # cloning needs the template to have no connections
+
+
+def clone_template(url: URL, database: str) -> URL:
+    """(Re)create database from the template of the database at url, creates the template first if needed"""
+    template = f"{url.database}_template"
+    fingerprint = schema_fingerprint()
+    with database_lock(url, template) as conn:
+        current = conn.execute(
+            sqlalchemy.text("SELECT shobj_description(oid, 'pg_database') FROM pg_database WHERE datname = :name"),
+            name=template,
+        ).scalar()
+        if current != fingerprint:
+            LOGGER.info("Creating template database {}".format(template))
+            conn.execute(f"DROP DATABASE IF EXISTS {template}")
+            conn.execute(f"CREATE DATABASE {template}")
+            template_url = copy.copy(url)
+            template_url.database = template
+            asyncio.get_event_loop().run_until_complete(create_template_tables(template_url))
+            conn.execute(f"COMMENT ON DATABASE {template} IS '{fingerprint}'")
+        conn.execute(f"DROP DATABASE IF EXISTS {database}")
+        conn.execute(f"CREATE DATABASE {database} TEMPLATE {template}")
+    ret = copy.copy(url)
+    ret.database = database
+    return ret
+
+
+class SingleConnectionBind:
+    """Engine look-alike for base.use_bind() that runs everything on one connection (see rollbackdb)"""
+
+    def __init__(self, conn: Any) -> None:
+        self.conn = conn
+
+    @property
+    def current_connection(self) -> Any:
+        """The connection, like GinoEngine.current_connection"""
+        return self.conn
+
+    def acquire(self, **kwargs: Any) -> "_SameConnection":
+        """The same connection whatever is asked"""
+        _ = kwargs
+        return _SameConnection(self.conn)
+
+    def transaction(self, *args: Any, **kwargs: Any) -> Any:
+        """Nested transaction (savepoint) on the connection"""
+        for engine_only in ("timeout", "reuse", "reusable"):
+            kwargs.pop(engine_only, None)
+        return self.conn.transaction(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.conn, name)
+
+
+class _SameConnection:  # pylint: disable=R0903
+    """Acquire context that gives the connection and does not release it"""
+
+    def __init__(self, conn: Any) -> None:
+        self.conn = conn
+
+    async def __aenter__(self) -> Any:
+        return self.conn
+
+    async def __aexit__(self, *args: Any) -> None:
+        return None
+
+
 @pytest.fixture(scope="session")
 def event_loop() -> Generator[asyncio.AbstractEventLoop, None, None]:
     """return event loop, made session scoped fixture to allow db connections to persists between tests"""
@@ -78,7 +223,7 @@ def dockerdb(docker_ip: str, docker_services: Any, monkeysession: Any) -> Genera
         monkeysession.setenv(f"DB_{key}", str(value))
         monkeysession.setattr(dbconfig, key, value)
 
-    new_dsn = sqlalchemy.engine.url.URL(
+    base_dsn = sqlalchemy.engine.url.URL(
         drivername=dbconfig.DRIVER,
         username=dbconfig.USER,
         password=dbconfig.PASSWORD,
@@ -86,9 +231,41 @@ def dockerdb(docker_ip: str, docker_services: Any, monkeysession: Any) -> Genera
         port=dbconfig.PORT,
         database=dbconfig.DATABASE,
     )
-    monkeysession.setattr(dbconfig, "DSN", new_dsn)
 
     LOGGER.debug("Waiting for db")
-    docker_services.wait_until_responsive(timeout=30.0, pause=0.5, check=lambda: db_is_responsive(dbconfig.DSN))
+    docker_services.wait_until_responsive(timeout=30.0, pause=0.5, check=lambda: db_is_reachable(base_dsn))
+
+    new_dsn = clone_template(base_dsn, worker_database(str(dbconfig.DATABASE)))
+    monkeysession.setenv("DB_DATABASE", new_dsn.database)
+    monkeysession.setattr(dbconfig, "DATABASE", new_dsn.database)
+    monkeysession.setattr(dbconfig, "DSN", new_dsn)
+    from arkia11nmodels.models import db  # pylint: disable=C0415
+
+    asyncio.get_event_loop().run_until_complete(db.set_bind(new_dsn))
 
     yield str(dbconfig.DSN)
+
+
+@pytest.fixture
+def rollbackdb(dockerdb: str, event_loop: asyncio.AbstractEventLoop) -> Generator[Any, None, None]:
+    """Run the test (and the fixtures set up after this one) in a transaction that is rolled back afterwards
+
+    Everything goes through one connection: do not run queries concurrently (asyncio.gather) and wrap statements
+    that are expected to fail in "async with db.transaction()" (a savepoint) to keep the transaction usable.
+    Separate processes (CLI) and other binds (replicas, shards) do not see the uncommitted rows.
+    """
+    _ = dockerdb
+    from arkia11nmodels.models.base import db, use_bind  # pylint: disable=C0415
+
+    async def begin() -> Tuple[Any, Any]:
+        conn = await db.acquire(reusable=False)
+        return conn, await conn.transaction()
+
+    conn, transaction = event_loop.run_until_complete(begin())
+    try:
+        # set in this context (not in a fixture task) so that the tasks running the test inherit it
+        with use_bind(SingleConnectionBind(conn)):
+            yield conn
+    finally:
+        event_loop.run_until_complete(transaction.rollback())
+        event_loop.run_until_complete(conn.release())
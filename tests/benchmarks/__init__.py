@@ -0,0 +1,13 @@
+"""Benchmarks, deselected from the normal suite (see addopts in pyproject.toml) as they assert on timings
+
+Run them with "-m benchmark -o log_cli=true --log-cli-level=INFO" to see the numbers, set BENCHMARK_SCALE env to
+multiply the sizes. The bench fixture (see conftest.py) does the measuring and logging.
+"""
+import os
+
+SCALE = float(os.environ.get("BENCHMARK_SCALE", "1.0"))
+
+
+def scaled(size: int) -> int:
+    """Scale the size with BENCHMARK_SCALE"""
+    return max(int(size * SCALE), 1)
@@ -0,0 +1,53 @@
+"""The bench fixture: measures the variants of a benchmark and logs every result as it is recorded"""
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import logging
+import time
+
+import pytest
+
+
+class Bench:
+    """Results of one benchmark by variant name"""
+
+    def __init__(self, logger: logging.Logger) -> None:
+        self.logger = logger
+        self.results: Dict[str, Any] = {}
+
+    def record(self, name: str, value: Any, text: Optional[str] = None) -> Any:
+        """Keep value as the result of name and log it (text instead of the value if given), returns value"""
+        self.results[name] = value
+        self.logger.info("{}: {}".format(name, value if text is None else text))
+        return value
+
+    def cpu_us(self, name: str, func: Callable[[], object], rounds: int = 1) -> float:
+        """Average CPU time of func in microseconds"""
+        started = time.process_time()
+        for _ in range(rounds):
+            func()
+        elapsed = (time.process_time() - started) / rounds * 1_000_000
+        return float(self.record(name, elapsed, "cpu {:.2f}us/call".format(elapsed)))
+
+    def wall_us(self, name: str, func: Callable[[], object], rounds: int = 1) -> float:
+        """Average wall time of func in microseconds"""
+        started = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        elapsed = (time.perf_counter() - started) / rounds * 1_000_000
+        return float(self.record(name, elapsed, "wall {:.2f}us/call".format(elapsed)))
+
+    async def timed(self, name: str, func: Callable[[], Awaitable[object]], rounds: int = 1) -> Tuple[float, float]:
+        """Average wall and CPU time of awaiting func in microseconds"""
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        for _ in range(rounds):
+            await func()
+        wall = (time.perf_counter() - wall_started) / rounds * 1_000_000
+        cpu = (time.process_time() - cpu_started) / rounds * 1_000_000
+        self.record(name, (wall, cpu), "wall {:.1f}us/call, cpu {:.1f}us/call".format(wall, cpu))
+        return wall, cpu
+
+
+@pytest.fixture
+def bench(request: pytest.FixtureRequest) -> Bench:
+    """Bench logging to the logger of the test module"""
+    return Bench(logging.getLogger(request.module.__name__))
@@ -0,0 +1,37 @@
+"""Bulk permission filtering vs checking targets one by one"""
+from typing import List
+
+import pytest
+
+from arkia11nmodels.schemas.acltrie import ACLMatcher
+from arkia11nmodels.schemas.role import ACL, ACLItem
+
+from . import scaled
+from .conftest import Bench
+
+PRIV = "fi.pvarki.device:read"
+BENCH_ACL = ACL(
+    [ACLItem(privilege=PRIV, target=f"node{idx}.pvarki.fi/devices/**", action=idx % 2 == 0) for idx in range(200)]
+    + [
+        ACLItem(privilege=PRIV, target="*.pvarki.fi/devices/secret", action=False),
+        ACLItem(privilege=PRIV, target="**.pvarki.fi", action=None),
+        ACLItem(privilege=PRIV, action=False),
+    ]
+)
+
+
+def per_item_loop(acl: ACL, targets: List[str]) -> List[str]:
+    """What the listing endpoints do now: one check per target"""
+    matcher = ACLMatcher(acl)
+    return [target for target in targets if matcher.check(PRIV, target)]
+
+
+@pytest.mark.benchmark
+def test_filter_allowed_vs_loop(bench: Bench) -> None:
+    """Time to filter 10k targets (a fifth of them repeats)"""
+    count = scaled(10000)
+    targets = [f"node{idx % 400}.pvarki.fi/devices/radio{idx % (count * 4 // 5)}" for idx in range(count)]
+    assert per_item_loop(BENCH_ACL, targets) == BENCH_ACL.filter_allowed(PRIV, targets)
+    bench.cpu_us("per item", lambda: per_item_loop(BENCH_ACL, targets), 5)
+    bench.cpu_us("filter_allowed", lambda: BENCH_ACL.filter_allowed(PRIV, targets), 5)
+    assert bench.results["filter_allowed"] < bench.results["per item"]
@@ -0,0 +1,59 @@
+"""Compare the binary ACL encoding with JSON"""
+from typing import Callable
+import json
+import tracemalloc
+
+import pytest
+
+from arkia11nmodels.schemas.aclcodec import encode_acl, decode_acl
+from arkia11nmodels.schemas.role import ACL, ACLItem
+from . import scaled
+from .conftest import Bench
+
+BENCH_ACL = ACL(
+    [
+        ACLItem(privilege=f"fi.pvarki.arkia11nmodels.{model}:{action}", target=target, action=True)
+        for model in ("user", "role", "token")
+        for action in ("create", "read", "update", "delete")
+        for target in ("self", None)
+    ]
+    + [ACLItem(privilege="fi.pvarki.superadmin", action=False)]
+)
+
+
+def memory_per_entry(make: Callable[[], object], count: int) -> float:
+    """Average bytes allocated per entry kept alive"""
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        entries = [make() for _ in range(count)]
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(entries) == count
+    return (after - before) / count
+
+
+@pytest.mark.benchmark
+def test_codec_vs_json(bench: Bench) -> None:
+    """Deserialisation time and memory per cached ACL"""
+    rounds = scaled(500)
+    encoded = encode_acl(BENCH_ACL)
+    as_json = BENCH_ACL.json().encode("utf-8")
+
+    json_us = bench.cpu_us("decode json", lambda: ACL.parse_obj(json.loads(as_json)), rounds)
+    codec_us = bench.cpu_us("decode codec", lambda: decode_acl(encoded), rounds)
+    bench.record(
+        "size", (len(as_json), len(encoded)), "json {} bytes, codec {} bytes".format(len(as_json), len(encoded))
+    )
+
+    count = scaled(200)
+    json_mem = memory_per_entry(lambda: bytes(bytearray(as_json)), count)
+    codec_mem = memory_per_entry(lambda: bytes(bytearray(encoded)), count)
+    bench.record(
+        "cached entry", (json_mem, codec_mem), "json {:.0f} bytes, codec {:.0f} bytes".format(json_mem, codec_mem)
+    )
+
+    assert len(encoded) < len(as_json)
+    assert codec_mem < json_mem
+    assert codec_us < json_us
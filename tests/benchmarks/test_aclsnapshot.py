@@ -0,0 +1,34 @@
+"""Offline snapshot open and resolve times"""
+from pathlib import Path
+import itertools
+import uuid
+
+import pytest
+
+from arkia11nmodels.aclsnapshot import ACLSnapshot, build_snapshot
+from arkia11nmodels.schemas.role import ACL, ACLItem
+from . import scaled
+from .conftest import Bench
+
+
+@pytest.mark.benchmark
+def test_snapshot_open_and_resolve(tmp_path: Path, bench: Bench) -> None:
+    """Opening must not depend on the snapshot size, resolving only touches the users pages"""
+    roles = [
+        (uuid.uuid4(), idx, ACL([ACLItem(privilege=f"fi.pvarki.bench{idx}.priv{pidx}") for pidx in range(10)]))
+        for idx in range(scaled(100))
+    ]
+    user_pks = [uuid.uuid4() for _ in range(scaled(20000))]
+    links = [
+        (user_pk, roles[(idx * 7 + ridx) % len(roles)][0]) for idx, user_pk in enumerate(user_pks) for ridx in range(3)
+    ]
+    path = tmp_path / "acl.snapshot"
+    path.write_bytes(build_snapshot(ACL([]), roles, user_pks, links))
+
+    bench.record("size", path.stat().st_size, "{} bytes, {} users".format(path.stat().st_size, len(user_pks)))
+    opened = bench.wall_us("open", lambda: ACLSnapshot(str(path)).close())
+    with ACLSnapshot(str(path)) as snapshot:
+        pks = itertools.cycle(user_pks)
+        bench.wall_us("resolve", lambda: snapshot.resolve_user_acl(next(pks)), scaled(2000))
+        assert all(len(snapshot.resolve_user_acl(pk)) == 30 for pk in user_pks[:100])
+    assert opened < 50_000
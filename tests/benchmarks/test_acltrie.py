@@ -0,0 +1,44 @@
+"""Trie target matching cost vs ACL size"""
+from typing import Optional
+
+import pytest
+
+from arkia11nmodels.schemas.acltrie import ACLMatcher
+from arkia11nmodels.schemas.role import ACL, ACLItem
+from . import scaled
+from .conftest import Bench
+
+PRIV = "fi.pvarki.device:read"
+
+
+def big_acl(size: int) -> ACL:
+    """ACL with size targeted items for the same privilege"""
+    return ACL(
+        [ACLItem(privilege=PRIV, target=f"node{idx}.pvarki.fi/devices/radio{idx}", action=True) for idx in range(size)]
+        + [ACLItem(privilege=PRIV, target="**.pvarki.fi", action=False)]
+    )
+
+
+def linear_check(acl: ACL, privilege: str, target: Optional[str]) -> bool:
+    """Exact target scan, what callers had to do without the matcher"""
+    for item in acl:
+        if item.privilege == privilege and item.target == target:
+            return bool(item.action)
+    return False
+
+
+@pytest.mark.benchmark
+def test_trie_vs_scan(bench: Bench) -> None:
+    """Check latency stays flat when the ACL grows"""
+    rounds = scaled(2000)
+    sizes = (10, scaled(5000))
+    for size in sizes:
+        acl = big_acl(size)
+        matcher = ACLMatcher(acl)
+        target = f"node{size - 1}.pvarki.fi/devices/radio{size - 1}"
+        assert matcher.check(PRIV, target) and linear_check(acl, PRIV, target)
+        bench.cpu_us(f"trie {size} items", lambda: matcher.check(PRIV, target), rounds)  # pylint: disable=W0640
+        bench.cpu_us(f"scan {size} items", lambda: linear_check(acl, PRIV, target), rounds)  # pylint: disable=W0640
+    small, large = sizes
+    assert bench.results[f"trie {large} items"] < bench.results[f"scan {large} items"]
+    assert bench.results[f"trie {large} items"] < bench.results[f"trie {small} items"] * 3
@@ -0,0 +1,100 @@
+"""Role hierarchies, closure maintenance cost and effective role resolving vs recursive walk"""
+from typing import Any, AsyncGenerator, List, Tuple
+import logging
+import time
+
+import pytest
+import pytest_asyncio
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID as saUUID
+
+from arkia11nmodels.models import Role, User
+from arkia11nmodels.models.prepared import PreparedQuery
+from arkia11nmodels.models.role import UserRole, RoleParent, RoleClosure, EFFECTIVE_USER_ROLES
+from . import scaled
+from .conftest import Bench
+
+LOGGER = logging.getLogger(__name__)
+HierarchyType = Tuple[User, List[Role]]
+
+# pylint: disable=W0621
+
+
+def recursive_walk_query() -> Any:
+    """Effective roles walking role_parents on every call, what the closure replaces"""
+    links = UserRole.__table__
+    parents = RoleParent.__table__
+    walk = (
+        sa.select([links.c.role])
+        .where(links.c.user == sa.bindparam("user_pk", type_=saUUID()))
+        .where(links.c.deleted == None)  # pylint: disable=C0121
+        .cte("walk", recursive=True)
+    )
+    walk = walk.union(sa.select([parents.c.parent]).select_from(walk.join(parents, parents.c.role == walk.c.role)))
+    return sa.select([Role.__table__]).where(Role.pk.in_(sa.select([walk.c.role])))
+
+
+RECURSIVE_WALK = PreparedQuery(recursive_walk_query)
+
+
+async def build_hierarchy(name: str, deep: bool) -> HierarchyType:
+    """Chain of roles (deep) or one role with many parents (wide), user is assigned the bottom role"""
+    size = scaled(50) if deep else scaled(200)
+    roles = [
+        await Role.create(displayname=f"{name} {idx}", acl=[{"privilege": f"fi.pvarki.{name}.{idx}", "action": True}])
+        for idx in range(size + 1)
+    ]
+    started = time.perf_counter()
+    for idx, role in enumerate(roles[1:], 1):
+        assert await (roles[idx - 1] if deep else roles[0]).add_parent(role)
+    LOGGER.info("{}: {} edges, {:.1f}ms/edge".format(name, size, (time.perf_counter() - started) / size * 1000))
+    user = await User.create(email=f"{name}@example.com")
+    await roles[0].assign_to(user)
+    return user, roles
+
+
+async def drop_hierarchy(user: User, roles: List[Role]) -> None:
+    """Clean up"""
+    pks = [role.pk for role in roles]
+    await RoleClosure.delete.where(RoleClosure.descendant.in_(pks)).gino.status()
+    await RoleParent.delete.where(RoleParent.role.in_(pks)).gino.status()
+    await UserRole.delete.where(UserRole.user == user.pk).gino.status()
+    await user.delete()
+    await Role.delete.where(Role.pk.in_(pks)).gino.status()
+
+
+@pytest_asyncio.fixture(params=["deep", "wide"])
+async def hierarchy(dockerdb: str, request: Any) -> AsyncGenerator[HierarchyType, None]:
+    """Deep chain or wide fan of parents"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    user, roles = await build_hierarchy(f"hierarchy{request.param}", request.param == "deep")
+    yield user, roles
+    await drop_hierarchy(user, roles)
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_effective_roles(hierarchy: HierarchyType, bench: Bench) -> None:
+    """Latency of resolving the effective roles (rows only) and the merged ACL"""
+    user, roles = hierarchy
+    rounds = scaled(100)
+    assert len(await Role.list_effective_roles(user)) == len(roles)
+    assert len(await RECURSIVE_WALK.all(user_pk=user.pk)) == len(roles)
+    acl = await Role.merge_user_acl(user)
+    assert {f"fi.pvarki.{role.displayname.replace(' ', '.')}" for role in roles} <= {item.privilege for item in acl}
+
+    async def closure() -> None:
+        await EFFECTIVE_USER_ROLES.all(user_pk=user.pk)
+
+    async def walk() -> None:
+        await RECURSIVE_WALK.all(user_pk=user.pk)
+
+    async def merge() -> None:
+        await Role.merge_user_acl(user)
+
+    for name, func in (("recursive walk", walk), ("closure", closure), ("closure merge", merge)):
+        await func()  # warm up
+        await bench.timed(f"{len(roles)} roles, {name}", func, rounds)
+    if len(await roles[0].list_parents()) == 1:  # deep, the wide one is a single step for the walk too
+        closure_wall = bench.results[f"{len(roles)} roles, closure"][0]
+        assert closure_wall < bench.results[f"{len(roles)} roles, recursive walk"][0] * 2
@@ -0,0 +1,30 @@
+"""Cached signed claims vs building and signing every time"""
+import secrets
+import uuid
+
+import pytest
+
+from arkia11nmodels.jwtclaims import ClaimsBuilder, sign_hs256
+from . import scaled
+from .conftest import Bench
+from .test_aclcodec import BENCH_ACL
+
+
+@pytest.mark.benchmark
+def test_issue_cached(bench: Bench) -> None:
+    """CPU time of issuing the same users claims repeatedly"""
+    privileges = sorted({item.privilege for item in BENCH_ACL})
+    builder = ClaimsBuilder(secrets.token_bytes(32), privileges)
+    subject = uuid.uuid4()
+    rounds = scaled(2000)
+
+    def uncached() -> str:
+        claims = {"sub": str(subject), "iat": 0, "exp": 900, "acl": builder.acl_claim(BENCH_ACL)}
+        return sign_hs256(claims, builder.key)
+
+    bench.cpu_us("uncached", uncached, rounds)
+    builder.issue(subject, BENCH_ACL)
+    bench.cpu_us("cached", lambda: builder.issue(subject, BENCH_ACL), rounds)
+    bench.record("stats", builder.stats)
+    assert len(builder.issue(subject, BENCH_ACL)) < len(sign_hs256({"acl": BENCH_ACL.dict()}, b"k"))
+    assert bench.results["cached"] < bench.results["uncached"]
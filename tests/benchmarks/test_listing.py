@@ -0,0 +1,29 @@
+"""Users with roles listing, 1+N queries vs one"""
+import pytest
+
+from arkia11nmodels.models import Role, User
+from ..test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+from . import scaled
+from .conftest import Bench
+
+# pylint: disable=W0621
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_list_with_roles_vs_n_plus_1(role_test_db: RoleTestDbType, bench: Bench) -> None:
+    """Latency of listing a page of users with their roles"""
+    _ = role_test_db
+    rounds = scaled(100)
+
+    async def n_plus_1() -> None:
+        for user in await User.query.where(User.deleted == None).gino.all():  # pylint: disable=C0121
+            await Role.list_user_roles(user)
+
+    async def one_query() -> None:
+        await User.list_with_roles()
+
+    for name, func in (("1+N", n_plus_1), ("one query", one_query)):
+        await func()  # warm up
+        await bench.timed(name, func, rounds)
+    assert bench.results["one query"][0] < bench.results["1+N"][0]
@@ -0,0 +1,33 @@
+"""Coalesced get-by-pk vs one query per lookup under fan-out"""
+import pytest
+
+from arkia11nmodels.models import Role, User
+from arkia11nmodels.models.loader import ModelLoader
+from arkia11nmodels.clickhelpers import run_batch
+from .test_records import big_role  # pylint: disable=W0611 # false positive
+from . import scaled
+from .conftest import Bench
+
+# pylint: disable=W0621
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_loader_vs_get(big_role: Role, bench: Bench) -> None:
+    """Time to look up role members concurrently with some overlap"""
+    pks = [record.pk for record in await big_role.list_role_user_records(("pk",))][: scaled(1000)]
+    lookups = pks + pks[: len(pks) // 2]
+    loader: ModelLoader[User] = ModelLoader(User)
+
+    for name, func in (("get_live", User.get_live), ("loader", loader.load)):
+        found = []
+
+        async def lookup() -> None:
+            found.extend(await run_batch(func, lookups, parallel=32))  # pylint: disable=W0640
+
+        await bench.timed(f"{len(lookups)} lookups with {name}", lookup)
+        assert all(isinstance(obj, User) for obj in found)
+    bench.record("loader stats", loader.stats)
+    assert loader.stats["queries"] < len(lookups) / 10
+    loader_wall = bench.results[f"{len(lookups)} lookups with loader"][0]
+    assert loader_wall < bench.results[f"{len(lookups)} lookups with get_live"][0]
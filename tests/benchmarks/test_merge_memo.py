@@ -0,0 +1,33 @@
+"""Merged ACL memo vs merging every time"""
+import pytest
+
+from arkia11nmodels import aclcache
+from arkia11nmodels.models import Role
+from ..test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+from . import scaled
+from .conftest import Bench
+
+# pylint: disable=W0621
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_merge_memo(role_test_db: RoleTestDbType, bench: Bench) -> None:
+    """Latency of merge_user_acl for users with the same role set"""
+    _user1, user2, role_1, _role_100, role_1000 = role_test_db
+    acl = [{"privilege": f"fi.pvarki.memobench.{idx}", "action": idx % 3 == 0} for idx in range(50)]
+    await role_1.update(acl=acl).apply()
+    await role_1000.update(acl=acl[::2]).apply()
+    rounds = scaled(200)
+    default = aclcache.get_merge_memo()
+    memo = aclcache.MergeMemo()
+    try:
+        for name, configured in (("no memo", None), ("memo", memo)):
+            aclcache.set_merge_memo(configured)
+            await Role.merge_user_acl(user2)  # warm up
+            await bench.timed(name, lambda: Role.merge_user_acl(user2), rounds)
+    finally:
+        aclcache.set_merge_memo(default)
+    bench.record("memo stats", memo.get_stats())
+    assert memo.get_stats()["dedup_ratio"] > rounds / 2
+    assert bench.results["memo"][1] < bench.results["no memo"][1]
@@ -0,0 +1,51 @@
+"""Compare random (v4) and time-ordered (v7) primary keys on the tokens table"""
+from typing import Callable, Tuple
+import time
+import uuid
+
+import pendulum
+import pytest
+
+from arkia11nmodels.models import db
+from arkia11nmodels.models.base import uuid7
+from . import scaled
+from .conftest import Bench
+
+BATCH_SIZE = 100
+INSERT_SQL = "INSERT INTO bench_tokens (pk, sent_to, expires, created, updated) VALUES ($1, $2, $3, now(), now())"
+
+
+async def insert_tokens(make_pk: Callable[[], uuid.UUID], count: int) -> Tuple[float, int]:
+    """Insert count tokens to copy of the tokens table, return inserts/s and pk index size in bytes"""
+    expires = pendulum.now("UTC").add(minutes=5)
+    async with db.acquire() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.execute("CREATE TEMP TABLE bench_tokens (LIKE a11n.tokens INCLUDING ALL)")
+        try:
+            started = time.perf_counter()
+            for offset in range(0, count, BATCH_SIZE):
+                await raw.executemany(
+                    INSERT_SQL,
+                    [(make_pk(), "bench@example.com", expires) for _ in range(min(BATCH_SIZE, count - offset))],
+                )
+            rate = count / (time.perf_counter() - started)
+            index_size = await raw.fetchval(
+                "SELECT pg_relation_size(indexrelid) FROM pg_index WHERE indrelid = 'bench_tokens'::regclass "
+                "AND indisprimary"
+            )
+        finally:
+            await raw.execute("DROP TABLE bench_tokens")
+    return rate, int(index_size)
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_uuid4_vs_uuid7(dockerdb: str, bench: Bench) -> None:
+    """Insert throughput and pk index size"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    count = scaled(5000)
+    for name, make_pk in (("uuid4", uuid.uuid4), ("uuid7", uuid7)):
+        result = await insert_tokens(make_pk, count)
+        bench.record(name, result, "{:.0f} inserts/s, pk index {} bytes".format(*result))
+    # Throughput is too noisy to assert on, appending to the right edge of the index must keep it smaller
+    assert bench.results["uuid7"][1] < bench.results["uuid4"][1]
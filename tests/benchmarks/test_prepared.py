@@ -0,0 +1,30 @@
+"""Compare the prepared statement path with plain Gino execution"""
+import pytest
+
+from arkia11nmodels import dbconfig
+from arkia11nmodels.models import Role, User
+from ..test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+from . import scaled
+from .conftest import Bench
+
+# pylint: disable=W0621
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_prepared_vs_gino(role_test_db: RoleTestDbType, monkeypatch: pytest.MonkeyPatch, bench: Bench) -> None:
+    """Per-call CPU and latency of the hot queries with and without prepared statements"""
+    user1, _user2, role_1, _role_100, _role_1000 = role_test_db
+    rounds = scaled(200)
+
+    async def hot_queries() -> None:
+        await Role.list_user_roles(user1)
+        await role_1.list_role_users()
+        await User.get_by_email(user1.email)
+
+    for enabled in (False, True):
+        monkeypatch.setattr(dbconfig, "PREPARED_STATEMENTS", enabled)
+        await hot_queries()  # warm up (compile, prepare)
+        await bench.timed(f"prepared={enabled}", hot_queries, rounds)
+    # Not asserting on wall time, it's too noisy on shared runners, but skipping the compilation must save CPU
+    assert bench.results["prepared=True"][1] < bench.results["prepared=False"][1]
@@ -0,0 +1,72 @@
+"""Compare model instances and the lightweight records for big roles
+
+BENCHMARK_SCALE=20 gives the 100k member role.
+"""
+from typing import Any, AsyncGenerator, Awaitable, Callable, Tuple
+import datetime
+import time
+import tracemalloc
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from arkia11nmodels.models import db, Role, User
+from arkia11nmodels.models.role import UserRole
+from . import scaled
+from .conftest import Bench
+
+MEMBER_PREFIX = "Big role member "
+
+# pylint: disable=W0621
+
+
+@pytest_asyncio.fixture
+async def big_role(dockerdb: str) -> AsyncGenerator[Role, None]:
+    """Role with lots of members, bulk loaded with COPY"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    role = await Role.create(displayname="Big role")
+    now = datetime.datetime.now(datetime.timezone.utc)
+    user_pks = [uuid.uuid4() for _ in range(scaled(5000))]
+    async with db.acquire() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.copy_records_to_table(
+            "users",
+            schema_name="a11n",
+            columns=["pk", "email", "displayname", "created", "updated"],
+            records=[(pk, f"{pk}@example.com", f"{MEMBER_PREFIX}{pk}", now, now) for pk in user_pks],
+        )
+        await raw.copy_records_to_table(
+            "userroles",
+            schema_name="a11n",
+            columns=["pk", "user", "role", "created", "updated"],
+            records=[(uuid.uuid4(), pk, role.pk, now, now) for pk in user_pks],
+        )
+    yield role
+    await UserRole.delete.where(UserRole.role == role.pk).gino.status()
+    await User.delete.where(User.displayname.startswith(MEMBER_PREFIX)).gino.status()
+    await role.delete()
+
+
+async def measure(func: Callable[[], Awaitable[Any]]) -> Tuple[float, int]:
+    """Return seconds and peak traced memory for func"""
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        result = await func()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert result
+    return elapsed, peak
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_models_vs_records(big_role: Role, bench: Bench) -> None:
+    """Time and peak memory of listing the members"""
+    for name, func in (("models", big_role.list_role_users), ("records", big_role.list_role_user_records)):
+        elapsed, peak = await measure(func)
+        bench.record(name, (elapsed, peak), "{:.3f}s, peak {:.1f}MiB".format(elapsed, peak / 2**20))
+    assert bench.results["records"][1] < bench.results["models"][1]
@@ -0,0 +1,39 @@
+"""Token per user vs bulk issuance for a big role"""
+from typing import List
+
+import pytest
+
+from arkia11nmodels.models import Role, Token
+from arkia11nmodels.models.token import expires_at
+from .test_records import big_role  # pylint: disable=W0611 # false positive
+from . import scaled
+from .conftest import Bench
+
+SENT_TO = "bulk-benchmark@example.com"
+
+# pylint: disable=W0621
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_create_vs_issue_many(big_role: Role, bench: Bench) -> None:
+    """Per token time of creating tokens one by one (for a sample of the members) and in bulk"""
+    tokens: List[Token] = []
+    try:
+        sample = (await big_role.list_role_user_records(("pk", "email")))[: scaled(200)]
+        records = iter(sample)
+        await bench.timed(
+            "create per token",
+            lambda: Token.create(user=next(records).pk, sent_to=SENT_TO, expires=expires_at()),
+            len(sample),
+        )
+        await Token.delete.where(Token.sent_to == SENT_TO).gino.status()
+
+        async def issue_many() -> None:
+            tokens.extend(await Token.issue_many(big_role.iter_role_user_records(("pk", "email")), sent_to=SENT_TO))
+
+        wall, _ = await bench.timed("issue_many", issue_many)
+    finally:
+        await Token.delete.where(Token.sent_to == SENT_TO).gino.status()
+    per_token = bench.record("issue_many per token", wall / len(tokens), "{:.1f}us/token".format(wall / len(tokens)))
+    assert per_token < bench.results["create per token"][0]
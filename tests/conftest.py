@@ -6,7 +6,7 @@ import asyncio
 import pytest
 from libadvian.logging import init_logging
 
-from arkia11nmodels.testhelpers import monkeysession, db_is_responsive, dockerdb  # pylint: disable=W0611
+from arkia11nmodels.testhelpers import monkeysession, db_is_responsive, dockerdb, rollbackdb  # pylint: disable=W0611
 
 init_logging(logging.DEBUG)
 LOGGER = logging.getLogger(__name__)
@@ -0,0 +1,291 @@
+"""Test the ACL cache and backends"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Generator
+import asyncio
+import logging
+import time
+import uuid
+
+import pytest
+
+from arkia11nmodels import aclcache
+from arkia11nmodels.aclcache import ACLCache, ACLCacheBackend, MemoryBackend, RedisBackend
+from arkia11nmodels.aclcache import MergeMemo
+from arkia11nmodels.models import db, Role, User
+from arkia11nmodels.models.role import UserRole
+from arkia11nmodels.schemas.aclcodec import encode_acl, decode_acl
+from arkia11nmodels.schemas.role import ACL, ACLItem
+from .test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+
+LOGGER = logging.getLogger(__name__)
+
+# pylint: disable=W0621
+
+
+class LocalRedis:
+    """Minimal stand-in for redis.asyncio.Redis for the commands RedisBackend uses"""
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Tuple[Optional[float], bytes]] = {}
+
+    def _get(self, key: str) -> Optional[bytes]:
+        if key not in self.data:
+            return None
+        expires, value = self.data[key]
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    async def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """MGET"""
+        return [self._get(key) for key in keys]
+
+    async def set(self, key: str, value: bytes, px: Optional[int] = None) -> bool:
+        """SET with optional PX"""
+        self.data[key] = (time.monotonic() + px / 1000 if px else None, value)
+        return True
+
+    async def incr(self, key: str) -> int:
+        """INCR"""
+        value = int(self._get(key) or 0) + 1
+        self.data[key] = (None, str(value).encode("ascii"))
+        return value
+
+    async def delete(self, key: str) -> int:
+        """DEL"""
+        return 1 if self.data.pop(key, None) else 0
+
+
+@pytest.fixture(params=["memory", "localredis", "fakeredis"])
+def backend(request: Any) -> ACLCacheBackend:
+    """Each of the backends"""
+    if request.param == "memory":
+        return MemoryBackend()
+    if request.param == "localredis":
+        return RedisBackend(LocalRedis())
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisBackend(fakeredis.FakeAsyncRedis())
+
+
+@pytest.fixture
+def with_cache(backend: ACLCacheBackend) -> Generator[ACLCache, None, None]:
+    """Configure the cache for Role.resolve_user_acl"""
+    cache = ACLCache(backend)
+    aclcache.set_cache(cache)
+    yield cache
+    aclcache.set_cache(None)
+
+
+TEST_ACL = ACL(
+    [
+        ACLItem(privilege="fi.pvarki.arkia11nmodels.user:read", target="self", action=True),
+        ACLItem(privilege="fi.pvarki.superadmin", action=False),
+        ACLItem(privilege="fi.pvarki.inherited", target="fi.pvarki.example", action=None),
+    ]
+)
+
+
+def test_encode_decode() -> None:
+    """Check the serialisation round-trips"""
+    encoded = encode_acl(TEST_ACL)
+    assert len(encoded) < len(TEST_ACL.json())
+    assert decode_acl(encoded) == TEST_ACL
+
+
+@pytest.mark.asyncio
+async def test_generations(backend: ACLCacheBackend) -> None:
+    """Check that bumping generations invalidates"""
+    cache = ACLCache(backend)
+    user_pk = uuid.uuid4()
+    cached, generation = await cache.get(user_pk)
+    assert cached is None
+    await cache.set(user_pk, TEST_ACL, generation)
+    cached, _ = await cache.get(user_pk)
+    assert cached == TEST_ACL
+
+    await cache.bump(user_pk)
+    cached, generation = await cache.get(user_pk)
+    assert cached is None
+    await cache.set(user_pk, TEST_ACL, generation)
+    cached, _ = await cache.get(user_pk)
+    assert cached == TEST_ACL
+
+    await cache.invalidate_all()
+    cached, _ = await cache.get(user_pk)
+    assert cached is None
+    assert cache.stats == {"hits": 2, "misses": 3}
+
+
+@pytest.mark.asyncio
+async def test_stale_set_is_ignored(backend: ACLCacheBackend) -> None:
+    """ACL resolved before a bump must not become valid when stored after it"""
+    cache = ACLCache(backend)
+    user_pk = uuid.uuid4()
+    _, generation = await cache.get(user_pk)
+    await cache.bump(user_pk)  # assignment changed while we were resolving
+    await cache.set(user_pk, TEST_ACL, generation)
+    cached, _ = await cache.get(user_pk)
+    assert cached is None
+
+
+@pytest.mark.asyncio
+async def test_ttl(backend: ACLCacheBackend) -> None:
+    """Check entries expire"""
+    cache = ACLCache(backend, ttl=0.1)
+    user_pk = uuid.uuid4()
+    _, generation = await cache.get(user_pk)
+    await cache.set(user_pk, TEST_ACL, generation)
+    assert (await cache.get(user_pk))[0] == TEST_ACL
+    await asyncio.sleep(0.2)
+    assert (await cache.get(user_pk))[0] is None
+
+
+@pytest.mark.asyncio
+async def test_memory_lru() -> None:
+    """Check the memory backend is bounded"""
+    backend = MemoryBackend(max_entries=2)
+    await backend.set("a", b"1")
+    await backend.set("b", b"2")
+    assert await backend.mget(["a"]) == [b"1"]  # a is now most recently used
+    await backend.set("c", b"3")
+    assert await backend.mget(["a", "b", "c"]) == [b"1", None, b"3"]
+    await backend.delete("a")
+    assert await backend.mget(["a"]) == [None]
+
+
+@pytest.mark.asyncio
+async def test_eviction_keeps_generations() -> None:
+    """Evicting entries must not reset the generations and bring revoked ACLs back"""
+    cache = ACLCache(MemoryBackend(max_entries=3))
+    user_pk = uuid.uuid4()
+    await cache.bump(user_pk)
+    _, generation = await cache.get(user_pk)
+    await cache.set(user_pk, TEST_ACL, generation)
+    for _ in range(3):  # others fill the cache
+        await cache.set(uuid.uuid4(), ACL([]), b"0.0")
+    await cache.bump(user_pk)  # role removed
+    cached, current = await cache.get(user_pk)
+    assert cached is None and current == b"0.2"
+    # a set() that raced with the bump
+    await cache.backend.set(cache.user_key(user_pk), generation + b":" + encode_acl(TEST_ACL))
+    assert (await cache.get(user_pk))[0] is None
+
+
+@pytest.mark.asyncio
+async def test_resolve_user_acl_cached(role_test_db: RoleTestDbType, with_cache: ACLCache) -> None:
+    """Check Role.resolve_user_acl uses the cache and role assignments invalidate"""
+    user1, _user2, _role_1, role_100, _role_1000 = role_test_db
+    await role_100.update(acl=[{"privilege": "fi.pvarki.cachetest", "action": True}]).apply()
+
+    acl = await Role.resolve_user_acl(user1)
+    assert with_cache.stats["misses"] == 1
+    assert await Role.resolve_user_acl(user1) == acl
+    assert with_cache.stats["hits"] == 1
+    assert "fi.pvarki.cachetest" in {item.privilege for item in acl}
+
+    assert await role_100.remove_from(user1)
+    acl = await Role.resolve_user_acl(user1)
+    assert with_cache.stats["misses"] == 2
+    assert "fi.pvarki.cachetest" not in {item.privilege for item in acl}
+    assert acl == await Role.merge_user_acl(user1)
+
+    assert await role_100.assign_to(user1)
+    acl = await Role.resolve_user_acl(user1)
+    assert "fi.pvarki.cachetest" in {item.privilege for item in acl}
+
+
+@pytest.mark.asyncio
+async def test_role_update_invalidates(role_test_db: RoleTestDbType, with_cache: ACLCache) -> None:
+    """Check changing the ACL or priority of a role invalidates cached ACLs of its users"""
+    user1, _user2, _role_1, role_100, _role_1000 = role_test_db
+    acl = await Role.resolve_user_acl(user1)
+    assert "fi.pvarki.cachetest" not in {item.privilege for item in acl}
+    assert await Role.resolve_user_acl(user1) == acl
+    assert with_cache.stats == {"hits": 1, "misses": 1}
+
+    await role_100.update(acl=[{"privilege": "fi.pvarki.cachetest", "action": True}]).apply()
+    acl = await Role.resolve_user_acl(user1)
+    assert with_cache.stats["misses"] == 2
+    assert "fi.pvarki.cachetest" in {item.privilege for item in acl}
+
+    await role_100.update(priority=role_100.priority + 1).apply()
+    assert await Role.resolve_user_acl(user1) == acl
+    assert with_cache.stats["misses"] == 3
+
+    await role_100.update(displayname="renamed").apply()
+    assert await Role.resolve_user_acl(user1) == acl
+    assert with_cache.stats == {"hits": 2, "misses": 3}
+
+
+@pytest.fixture
+def with_memo() -> Generator[MergeMemo, None, None]:
+    """Fresh merge memo so the stats start from zero"""
+    default = aclcache.get_merge_memo()
+    memo = MergeMemo(max_entries=2)
+    aclcache.set_merge_memo(memo)
+    yield memo
+    aclcache.set_merge_memo(default)
+
+
+def test_merge_memo_lru() -> None:
+    """Check the memo is bounded and counts"""
+    memo = MergeMemo(max_entries=2)
+    other = ACL([])
+    memo.set(b"a", TEST_ACL)
+    memo.set(b"b", other)
+    assert memo.get(b"a") is TEST_ACL  # a is now most recently used
+    memo.set(b"c", other)
+    assert memo.get(b"b") is None
+    assert memo.get(b"c") is other
+    stats = memo.get_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 2
+    assert stats["dedup_ratio"] == 3.0
+    assert stats["bytes_saved"] > stats["bytes"] / 2
+    memo.clear()
+    assert memo.get(b"a") is None
+
+
+@pytest.mark.asyncio
+async def test_merge_shared(role_test_db: RoleTestDbType, with_memo: MergeMemo) -> None:
+    """Users with the same roles get the same merged ACL object until one of the roles changes"""
+    user1, user2, role_1, _role_100, role_1000 = role_test_db
+    user3 = await User.create(email="samerolesasuser2@example.com")
+    try:
+        await role_1.assign_to(user3)
+        await role_1000.assign_to(user3)
+        acl = await Role.merge_user_acl(user2)
+        assert await Role.merge_user_acl(user3) is acl
+        assert await Role.merge_user_acl(user1) is not acl
+        assert with_memo.get_stats()["dedup_ratio"] == 1.5
+
+        updated = role_1.updated
+        await role_1.update(acl=[{"privilege": "fi.pvarki.memotest", "action": True}]).apply()
+        assert (await Role.get(role_1.pk)).updated > updated
+        changed = await Role.merge_user_acl(user3)
+        assert "fi.pvarki.memotest" in {item.privilege for item in changed}
+        assert await Role.merge_user_acl(user2) is changed
+    finally:
+        await UserRole.delete.where(UserRole.user == user3.pk).gino.status()
+        await user3.delete()
+
+
+@pytest.mark.asyncio
+async def test_merge_same_transaction(role_test_db: RoleTestDbType, with_memo: MergeMemo) -> None:
+    """Role changed twice in one transaction (same updated timestamp) is merged again"""
+    _user1, user2, role_1, _role_100, _role_1000 = role_test_db
+    acl = list(role_1.acl)
+    try:
+        async with db.transaction():
+            await role_1.update(acl=[{"privilege": "fi.pvarki.txtest", "action": True}]).apply()
+            first = await Role.merge_user_acl(user2)
+            await role_1.update(acl=[{"privilege": "fi.pvarki.txtest", "action": False}]).apply()
+            second = await Role.merge_user_acl(user2)
+        assert {item.privilege: item.action for item in first}["fi.pvarki.txtest"] is True
+        assert {item.privilege: item.action for item in second}["fi.pvarki.txtest"] is False
+        assert await Role.merge_user_acl(user2) is second
+        assert with_memo.stats["misses"] == 2
+    finally:
+        await role_1.update(acl=acl).apply()
@@ -0,0 +1,50 @@
+"""Test the binary ACL encoding"""
+import pytest
+
+from arkia11nmodels.schemas.aclcodec import encode_acl, decode_acl, acl_to_b64, acl_from_b64
+from arkia11nmodels.schemas.role import ACL, ACLItem
+
+TEST_ACL = ACL(
+    [
+        ACLItem(privilege="fi.pvarki.arkia11nmodels.user:read", target="self", action=True),
+        ACLItem(privilege="fi.pvarki.arkia11nmodels.user:update", target="self", action=True),
+        ACLItem(privilege="fi.pvarki.superadmin", action=False),
+        ACLItem(privilege="fi.pvarki.inherited", target="fi.pvarki.inherited", action=None),
+        ACLItem(privilege="fi.pvarki.ääkköset", target="🙂", action=True),
+    ]
+)
+
+
+def test_roundtrip() -> None:
+    """Check encoding round-trips losslessly and is more compact than JSON"""
+    encoded = encode_acl(TEST_ACL)
+    assert len(encoded) < len(TEST_ACL.json()) / 2
+    decoded = decode_acl(encoded)
+    assert decoded == TEST_ACL
+    assert [item.dict() for item in decoded] == [item.dict() for item in TEST_ACL]
+    assert acl_from_b64(acl_to_b64(TEST_ACL)) == TEST_ACL
+    assert decode_acl(encode_acl(ACL([]))) == ACL([])
+
+
+def test_strings_interned() -> None:
+    """Repeated privileges and targets are stored once"""
+    encoded = encode_acl(TEST_ACL)
+    assert encoded.count(b"self") == 1
+    assert encoded.count(b"fi.pvarki.inherited") == 1
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"nope",
+        b"ACL\x02",  # unsupported version
+        encode_acl(TEST_ACL)[:-1],
+        encode_acl(TEST_ACL) + b"\x00",
+        encode_acl(TEST_ACL)[:10],
+    ],
+)
+def test_malformed(data: bytes) -> None:
+    """Malformed input raises ValueError"""
+    with pytest.raises(ValueError):
+        decode_acl(data)
@@ -0,0 +1,111 @@
+"""Test the offline ACL snapshot"""
+from pathlib import Path
+import logging
+import uuid
+
+import pytest
+
+from arkia11nmodels.aclsnapshot import ACLSnapshot, build_snapshot, export_snapshot, HEADER
+from arkia11nmodels.models import Role, User
+from arkia11nmodels.models.role import UserRole
+from arkia11nmodels.schemas.role import ACL, ACLItem
+from .test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+from .test_role import role_hierarchy, RoleHierarchyType  # pylint: disable=W0611 # false positive
+from .test_console import run_cli, json_lines
+
+LOGGER = logging.getLogger(__name__)
+
+# pylint: disable=W0621
+
+
+@pytest.mark.asyncio
+async def test_export_and_resolve(role_test_db: RoleTestDbType, tmp_path: Path) -> None:  # pylint: disable=R0914
+    """Snapshot resolves the same ACLs as the database"""
+    user1, user2, role_1, role_100, role_1000 = role_test_db
+    await role_1.update(acl=[{"privilege": "fi.pvarki.snapshottest", "action": True}]).apply()
+    await role_100.update(acl=[{"privilege": "fi.pvarki.snapshottest", "action": False}]).apply()
+    await role_1000.update(
+        acl=[
+            {"privilege": "fi.pvarki.snapshottest", "action": True, "target": "fi.pvarki.example"},
+            {"privilege": "fi.pvarki.arkia11nmodels.user:read", "action": False},
+        ]
+    ).apply()
+    user3 = User(email="snapshot-deleted@example.com")
+    await user3.create()
+    await role_1.assign_to(user3)
+    await user3.soft_delete()
+
+    path = str(tmp_path / "acl.snapshot")
+    try:
+        counts = await export_snapshot(path)
+    finally:
+        await UserRole.delete.where(UserRole.user == user3.pk).gino.status()
+        await user3.delete()
+    LOGGER.debug("counts={}".format(counts))
+    assert counts["links"] >= 5
+
+    with ACLSnapshot(path) as snapshot:
+        for user in (user1, user2):
+            assert snapshot.resolve_user_acl(user.pk) == await Role.merge_user_acl(user)
+            roles = await Role.list_user_roles(user)
+            assert snapshot.user_role_pks(str(user.pk)) == [role.pk for role in roles]
+        with pytest.raises(KeyError):
+            snapshot.resolve_user_acl(user3.pk)
+        with pytest.raises(KeyError):
+            snapshot.resolve_user_acl(uuid.uuid4())
+
+    code, out, err = await run_cli("snapshot", "acl", path, str(user1.pk), str(user3.pk))
+    assert code == 1
+    assert str(user3.pk) in err
+    assert ACL.parse_obj(json_lines(out)[0]["acl"]) == await Role.merge_user_acl(user1)
+
+
+@pytest.mark.asyncio
+async def test_inherited_roles(role_hierarchy: RoleHierarchyType, tmp_path: Path) -> None:
+    """Snapshot has the inherited roles in the same merge order as the database"""
+    (user1, user2, role_1, _role_100, _role_1000), _parent, grandparent = role_hierarchy
+    assert await role_1.add_parent(grandparent)
+    path = str(tmp_path / "acl.snapshot")
+    await export_snapshot(path)
+    with ACLSnapshot(path) as snapshot:
+        for user in (user1, user2):
+            roles = await Role.list_effective_roles(user)
+            assert snapshot.user_role_pks(user.pk) == [role.pk for role in roles]
+            assert snapshot.resolve_user_acl(user.pk) == await Role.merge_user_acl(user)
+
+
+@pytest.mark.asyncio
+async def test_soft_deleted_child(role_hierarchy: RoleHierarchyType, tmp_path: Path) -> None:
+    """Roles inherited via a soft-deleted assigned role are left out like in the database"""
+    (user1, _user2, _role_1, role_100, _role_1000), parent, grandparent = role_hierarchy
+    await role_100.soft_delete()
+    path = str(tmp_path / "acl.snapshot")
+    await export_snapshot(path)
+    acl = await Role.merge_user_acl(user1)
+    assert "fi.pvarki.inherittest" not in {item.privilege for item in acl}
+    with ACLSnapshot(path) as snapshot:
+        pks = snapshot.user_role_pks(user1.pk)
+        assert role_100.pk not in pks and parent.pk not in pks and grandparent.pk not in pks
+        assert snapshot.resolve_user_acl(user1.pk) == acl
+
+
+def test_user_without_roles(tmp_path: Path) -> None:
+    """Live users without roles get the default ACL"""
+    default_acl = ACL([ACLItem(privilege="fi.pvarki.default", action=True)])
+    user_pk, role_pk = uuid.uuid4(), uuid.uuid4()
+    path = tmp_path / "acl.snapshot"
+    path.write_bytes(build_snapshot(default_acl, [(role_pk, 1, ACL([]))], [user_pk], [(uuid.uuid4(), role_pk)]))
+    with ACLSnapshot(str(path)) as snapshot:
+        assert snapshot.resolve_user_acl(user_pk) == default_acl
+        assert snapshot.user_role_pks(user_pk) == []
+        assert (snapshot.role_count, snapshot.user_count, snapshot.link_count) == (1, 1, 0)
+
+
+def test_invalid_file(tmp_path: Path) -> None:
+    """Truncated or foreign files are rejected"""
+    data = build_snapshot(ACL([]), [], [uuid.uuid4()], [])
+    path = tmp_path / "acl.snapshot"
+    for broken in (data[:-1], b"NOTASNAP" + data[8:], data[: HEADER.size - 1]):
+        path.write_bytes(broken)
+        with pytest.raises(ValueError):
+            ACLSnapshot(str(path))
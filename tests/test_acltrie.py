@@ -0,0 +1,94 @@
+"""Test the ACL target trie matching"""
+import pytest
+
+from arkia11nmodels.schemas.acltrie import ACLMatcher, target_segments
+from arkia11nmodels.schemas.role import ACL, ACLItem
+
+PRIV = "fi.pvarki.device:read"
+TEST_ACL = ACL(
+    [
+        ACLItem(privilege=PRIV, action=False),
+        ACLItem(privilege=PRIV, target="**.pvarki.fi", action=True),
+        ACLItem(privilege=PRIV, target="*.pvarki.fi/devices", action=False),
+        ACLItem(privilege=PRIV, target="node1.pvarki.fi/devices", action=True),
+        ACLItem(privilege=PRIV, target="node1.pvarki.fi/devices/*", action=None),
+        ACLItem(privilege=PRIV, target="node1.pvarki.fi/devices/secret", action=False),
+        ACLItem(privilege="fi.pvarki.superadmin", action=True),
+    ]
+)
+
+
+def test_segments() -> None:
+    """FQDN is reversed and lowercased, path is kept as is"""
+    assert target_segments("Node1.pvarki.FI/Devices//radio/") == ["fi", "pvarki", "node1", "Devices", "radio"]
+    assert target_segments("self") == ["self"]
+    assert target_segments("pvarki.fi/**") == target_segments("**.pvarki.fi")
+
+
+@pytest.mark.parametrize(
+    "target,expected",
+    [
+        (None, False),  # only the global item
+        ("example.com", False),  # global item
+        ("pvarki.fi", True),  # ** matches zero segments
+        ("node2.pvarki.fi/things/radio", True),
+        ("node2.pvarki.fi/devices", False),  # * beats **
+        ("NODE1.pvarki.fi/devices", True),  # literal beats *
+        ("node1.pvarki.fi/devices/radio", True),  # inherit defers to the next match
+        ("node1.pvarki.fi/devices/secret", False),
+        ("node1.pvarki.fi/devices/secret/more", True),  # nothing more specific than **
+    ],
+)
+def test_most_specific_wins(target: str, expected: bool) -> None:
+    """Check the precedence rules"""
+    matcher = ACLMatcher(TEST_ACL)
+    assert matcher.check(PRIV, target) is expected
+
+
+def test_match_details() -> None:
+    """Matches are given most specific first, unknown privileges are denied"""
+    matcher = ACLMatcher(TEST_ACL)
+    matches = list(matcher.iter_matches(PRIV, "node1.pvarki.fi/devices/radio"))
+    assert [item.target for item in matches] == ["node1.pvarki.fi/devices/*", "**.pvarki.fi", None]
+    item = matcher.match(PRIV, "node1.pvarki.fi/devices/radio")
+    assert item is not None and item.target == "**.pvarki.fi"
+    assert matcher.check("fi.pvarki.superadmin", "anything.example.com/at/all")
+    assert not matcher.check("fi.pvarki.unknown", None)
+    assert matcher.match("fi.pvarki.unknown", "pvarki.fi") is None
+
+
+def test_duplicates_and_errors() -> None:
+    """Deny wins on same target, misplaced ** is rejected"""
+    matcher = ACLMatcher(
+        [
+            ACLItem(privilege=PRIV, target="pvarki.fi", action=True),
+            ACLItem(privilege=PRIV, target="PVARKI.fi", action=False),
+            ACLItem(privilege=PRIV, target="pvarki.fi", action=True),
+        ]
+    )
+    assert not matcher.check(PRIV, "pvarki.fi")
+    with pytest.raises(ValueError):
+        ACLMatcher([ACLItem(privilege=PRIV, target="**.pvarki.fi/devices", action=True)])
+
+
+def test_batch() -> None:
+    """Batch methods give the same answers as check()"""
+    matcher = ACLMatcher(TEST_ACL)
+    targets = [
+        None,
+        "pvarki.fi",
+        "node1.pvarki.fi/devices",
+        "node2.pvarki.fi/devices",
+        "node1.pvarki.fi/devices/secret",
+        "node1.pvarki.fi/devices/radio",
+        "pvarki.fi",
+        "example.com",
+    ]
+    expected = [matcher.check(PRIV, target) for target in targets]
+    assert matcher.allowed_mask(PRIV, targets) == expected
+    assert TEST_ACL.filter_allowed(PRIV, iter(targets)) == [
+        target for target, allowed in zip(targets, expected) if allowed
+    ]
+    pairs = [(privilege, target) for target in targets for privilege in (PRIV, "fi.pvarki.superadmin", "nope")]
+    assert TEST_ACL.check_many(pairs) == [matcher.check(*pair) for pair in pairs]
+    assert matcher.allowed_mask("fi.pvarki.superadmin", targets) == [True] * len(targets)
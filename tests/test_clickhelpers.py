@@ -1,10 +1,16 @@
 """Just test they don't blow up"""
+from typing import Any, Dict, List
+import asyncio
+import io
 import logging
+import uuid
 
 import pytest
 
 from arkia11nmodels.models import User, Role
 from arkia11nmodels.clickhelpers import list_and_print_json, get_and_print_json, create_and_print_json
+from arkia11nmodels.clickhelpers import read_ids, read_json_lines, run_batch, get_by_uuid
+from arkia11nmodels.models.loader import ModelLoader
 from .test_token import with_user  # pylint: disable=W0611 # false positive
 from .test_role import with_role  # pylint: disable=W0611 # false positive
 
@@ -39,3 +45,51 @@ async def test_create_and_print(dockerdb: str) -> None:
     # TODO: create a click context for output, capture it and check for the email and dn
     await create_and_print_json(User, {"email": "clicktest@example.com"})
     await create_and_print_json(Role, {"displayname": "Click test Role"})
+
+
+def test_read_ids() -> None:
+    """Test combining ids from arguments and file"""
+    infile = io.StringIO("# comment\n\nabc\n  def  \n")
+    assert read_ids(["xyz"], infile) == ["xyz", "abc", "def"]
+    assert read_ids(["xyz"]) == ["xyz"]
+    assert read_json_lines(io.StringIO('{"a": 1}\n\n# comment\n{"b": 2}\n')) == [{"a": 1}, {"b": 2}]
+
+
+@pytest.mark.asyncio
+async def test_run_batch() -> None:
+    """Check parallelism is limited, order is kept and exceptions are returned"""
+    in_flight = 0
+    max_in_flight = 0
+
+    async def work(item: int) -> int:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if item == 3:
+            raise ValueError("three")
+        return item * 2
+
+    results = await run_batch(work, list(range(10)), parallel=4)
+    assert max_in_flight == 4
+    assert isinstance(results[3], ValueError)
+    assert [res for res in results if not isinstance(res, BaseException)] == [0, 2, 4, 8, 10, 12, 14, 16, 18]
+
+
+@pytest.mark.asyncio
+async def test_run_batch_loads(with_user: User, monkeypatch: pytest.MonkeyPatch) -> None:
+    """The get_by_uuid() calls of a batch are coalesced"""
+    fetches: List[int] = []
+    orig_fetch = ModelLoader._fetch  # pylint: disable=W0212
+
+    async def fetch(self: ModelLoader[Any], batch: Dict[Any, Any]) -> None:
+        fetches.append(len(batch))
+        await orig_fetch(self, batch)
+
+    monkeypatch.setattr(ModelLoader, "_fetch", fetch)
+    pks = [str(with_user.pk)] * 5 + [str(uuid.uuid4())]
+    results = await run_batch(lambda pk: get_by_uuid(User, pk), pks, parallel=8)
+    assert [result.pk for result in results[:5]] == [with_user.pk] * 5  # type: ignore[union-attr]
+    assert isinstance(results[5], ValueError)
+    assert fetches == [2]
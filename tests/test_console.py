@@ -1,10 +1,19 @@
 """Test CLI scripts"""
+from typing import Optional, Tuple, List, Dict, Any
+from pathlib import Path
 import asyncio
+import json
 
 import pytest
 from libadvian.binpackers import ensure_str
 
 from arkia11nmodels import __version__
+from arkia11nmodels.clickhelpers import parse_uuid
+from arkia11nmodels.models import User, Token
+from arkia11nmodels.models.role import UserRole
+from .test_user import search_users  # pylint: disable=W0611 # false positive
+from .test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+from .test_role import role_hierarchy, RoleHierarchyType  # pylint: disable=W0611 # false positive
 
 
 @pytest.mark.asyncio
@@ -21,3 +30,159 @@ async def test_version_cli():  # type: ignore
     assert process.returncode == 0
     # Check output
     assert ensure_str(out[0]).strip().endswith(__version__)
+
+
+async def run_cli(*args: str, stdin: Optional[bytes] = None) -> Tuple[int, str, str]:
+    """Run the CLI with args, return exit code, stdout and stderr"""
+    process = await asyncio.create_subprocess_exec(
+        "arkia11nmodels",
+        *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out = await asyncio.wait_for(process.communicate(stdin), 30)
+    assert process.returncode is not None
+    return process.returncode, ensure_str(out[0]), ensure_str(out[1])
+
+
+def json_lines(out: str) -> List[Dict[str, Any]]:
+    """Parse JSON lines output"""
+    return [json.loads(line) for line in out.splitlines() if line.strip()]
+
+
+@pytest.mark.asyncio
+async def test_crud_cli(dockerdb: str, tmp_path: Path) -> None:  # pylint: disable=R0915
+    """Test the batched user, role, link and token commands, NOTE: base64 ids may start with "-" hence the "--" """
+    _ = dockerdb  # consume the fixture to keep linter happy
+    users_file = tmp_path / "users.jsonl"
+    users_file.write_text("\n".join(json.dumps({"email": f"clibatch{idx}@example.com"}) for idx in range(5)))
+    code, out, err = await run_cli("--timing", "-j", "3", "user", "create", "-f", str(users_file))
+    assert code == 0, err
+    assert "User create: 5 operations" in err
+    users = json_lines(out)
+    assert len(users) == 5
+    user_pks = [user["pk"] for user in users]
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("# user ids\n" + "\n".join(user_pks[2:]) + "\n")
+
+    code, out, err = await run_cli("role", "create", "--displayname", "CLI role", "--priority", "10")
+    assert code == 0, err
+    role_pk = json_lines(out)[0]["pk"]
+
+    try:
+        code, out, err = await run_cli("user", "get", "-f", str(ids_file), "--", *user_pks[:2])
+        assert code == 0, err
+        assert [user["pk"] for user in json_lines(out)] == user_pks
+
+        code, out, err = await run_cli("link", "add", "--", role_pk, *user_pks)
+        assert code == 0, err
+        assert all(lnk["changed"] for lnk in json_lines(out))
+
+        code, out, err = await run_cli("link", "users", "--", role_pk)
+        assert code == 0, err
+        assert len(json_lines(out)[0]["users"]) == 5
+        code, out, err = await run_cli("link", "users", "-c", "pk,email", "--", role_pk)
+        assert code == 0, err
+        assert {user["email"] for user in json_lines(out)[0]["users"]} == {user["email"] for user in users}
+        assert set(json_lines(out)[0]["users"][0].keys()) == {"pk", "email"}
+
+        code, out, err = await run_cli("link", "roles", "--", user_pks[0])
+        assert code == 0, err
+        assert json_lines(out)[0]["roles"][0]["pk"] == role_pk
+
+        code, out, err = await run_cli("role", "acl", "--", user_pks[0])
+        assert code == 0, err
+        assert json_lines(out)[0]["acl"]
+
+        code, out, err = await run_cli("token", "create", "--expires", "60", "--", *user_pks)
+        assert code == 0, err
+        tokens = json_lines(out)
+        assert {token["sent_to"] for token in tokens} == {user["email"] for user in users}
+        code, out, err = await run_cli("token", "delete", "--", *[token["pk"] for token in tokens])
+        assert code == 0, err
+
+        code, out, err = await run_cli("link", "remove", "-f", str(ids_file), "--", role_pk)
+        assert code == 0, err
+        assert len(json_lines(out)) == 3
+
+        # Non-existent ids are reported as errors but the rest are processed
+        code, out, err = await run_cli("user", "get", "--", user_pks[0], "917813ec-9243-45df-a46e-0a8dacc5c0e0")
+        assert code == 1
+        assert len(json_lines(out)) == 1
+        assert "917813ec-9243-45df-a46e-0a8dacc5c0e0" in err
+    finally:
+        await UserRole.delete.where(UserRole.role == parse_uuid(role_pk)).gino.status()
+        code, out, err = await run_cli("role", "delete", "--", role_pk)
+        assert code == 0, err
+        code, out, err = await run_cli("user", "delete", "--", *user_pks)
+        assert code == 0, err
+
+
+@pytest.mark.asyncio
+async def test_soft_delete_purge_cli(dockerdb: str) -> None:
+    """Test soft delete, the --deleted flags and purge"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    code, out, err = await run_cli("user", "create", "--email", "clisoftdelete@example.com")
+    assert code == 0, err
+    user_pk = json_lines(out)[0]["pk"]
+    code, out, err = await run_cli("user", "delete", "--soft", "--", user_pk)
+    assert code == 0, err
+
+    code, out, err = await run_cli("user", "get", "--", user_pk)
+    assert code == 1
+    code, out, err = await run_cli("user", "get", "--deleted", "--", user_pk)
+    assert code == 0, err
+    assert json_lines(out)[0]["deleted"]
+    code, out, err = await run_cli("user", "list")
+    assert user_pk not in {user["pk"] for user in json.loads(out)}
+    code, out, err = await run_cli("user", "list", "--deleted")
+    assert user_pk in {user["pk"] for user in json.loads(out)}
+
+    code, out, err = await run_cli("purge", "--retention-days", "0")
+    assert code == 0, err
+    assert json.loads(out)["users"] >= 1
+    code, out, err = await run_cli("user", "get", "--deleted", "--", user_pk)
+    assert code == 1
+
+
+@pytest.mark.asyncio
+async def test_search_cli(search_users: List[User]) -> None:  # pylint: disable=W0621
+    """Test the user search command"""
+    code, out, err = await run_cli("user", "search", "-n", "5", "meikal")
+    assert code == 0, err
+    found = json.loads(out)
+    assert {parse_uuid(item["pk"]) for item in found} == {user.pk for user in search_users[:2]}
+
+
+@pytest.mark.asyncio
+async def test_token_invite_cli(role_test_db: RoleTestDbType) -> None:  # pylint: disable=W0621
+    """Test inviting all users of a role"""
+    user1, user2, role_1, _role_100, _role_1000 = role_test_db
+    code, out, err = await run_cli("--timing", "token", "invite", "--expires", "60", "--", str(role_1.pk))
+    try:
+        assert code == 0, err
+        assert "Token invite: 2 operations" in err
+        tokens = json_lines(out)
+        assert {parse_uuid(token["user"]) for token in tokens} == {user1.pk, user2.pk}
+        assert {token["sent_to"] for token in tokens} == {user1.email, user2.email}
+    finally:
+        await Token.delete.where(Token.user.in_([user1.pk, user2.pk])).gino.status()
+
+
+@pytest.mark.asyncio
+async def test_role_inherit_cli(role_hierarchy: RoleHierarchyType) -> None:  # pylint: disable=W0621
+    """Test adding and removing role parents"""
+    (_user1, _user2, role_1, _role_100, _role_1000), parent, grandparent = role_hierarchy
+    code, out, err = await run_cli("role", "inherit", "--", str(role_1.pk), str(parent.pk), str(parent.pk))
+    assert code == 0, err
+    assert sorted(result["changed"] for result in json_lines(out)) == [False, True]
+    assert [role.pk for role in await role_1.list_ancestors()] == [parent.pk, grandparent.pk]
+    code, out, err = await run_cli("role", "inherit", "--remove", "--", str(role_1.pk), str(parent.pk))
+    assert code == 0, err
+    assert json_lines(out)[0]["changed"]
+    assert await role_1.list_ancestors() == []
+    # cycles are errors
+    code, out, err = await run_cli("role", "inherit", "--", str(grandparent.pk), str(parent.pk))
+    assert code == 1
+    assert "can not inherit" in err
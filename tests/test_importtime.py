@@ -0,0 +1,57 @@
+"""Import regression tests, make sure entry points do not start pulling in heavy deps again
+
+Checks what gets imported rather than how long it takes so the results do not depend on the machine.
+"""
+from typing import Dict, Set, FrozenSet
+import subprocess  # nosec
+import sys
+
+import pytest
+
+# Things that are expensive to import and that most entry points should not need
+DB_MODULES = frozenset(("gino", "sqlalchemy", "asyncpg", "starlette", "pendulum"))
+PYDANTIC_MODULES = frozenset(("pydantic", "pydantic_collections", "email_validator"))
+
+# Module to import -> modules that must not get imported
+FORBIDDEN: Dict[str, FrozenSet[str]] = {
+    "arkia11nmodels": DB_MODULES | PYDANTIC_MODULES,
+    "arkia11nmodels.models": DB_MODULES | PYDANTIC_MODULES,
+    "arkia11nmodels.schemas": DB_MODULES | PYDANTIC_MODULES,
+    "arkia11nmodels.schemas.role": DB_MODULES | frozenset(("email_validator",)),
+    "arkia11nmodels.jwtclaims": DB_MODULES | frozenset(("email_validator",)),
+    "arkia11nmodels.clickhelpers": DB_MODULES | PYDANTIC_MODULES,
+    "arkia11nmodels.console": DB_MODULES | PYDANTIC_MODULES,
+}
+
+
+def imported_toplevels(module: str) -> Set[str]:
+    """Import the module in a fresh interpreter, return the top level names of all modules it got loaded"""
+    proc = subprocess.run(  # nosec
+        [sys.executable, "-c", f"import sys; import {module}; print(' '.join(sys.modules))"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    return {name.split(".")[0] for name in proc.stdout.split()}
+
+
+@pytest.mark.parametrize("module", sorted(FORBIDDEN.keys()))
+def test_import_deps(module: str) -> None:
+    """Check the entry point does not import the forbidden modules"""
+    toplevels = imported_toplevels(module)
+    assert module.split(".")[0] in toplevels
+    assert not toplevels & FORBIDDEN[module], f"{module} imported {toplevels & FORBIDDEN[module]}"
+
+
+def test_lazy_attributes() -> None:
+    """Make sure the lazy re-exports resolve to the real things"""
+    # pylint: disable=C0415
+    from arkia11nmodels import models, schemas
+    from arkia11nmodels.models.role import Role
+    from arkia11nmodels.schemas.role import ACL
+
+    assert models.Role is Role
+    assert schemas.ACL is ACL
+    assert "User" in dir(models)
+    with pytest.raises(AttributeError):
+        assert not models.NoSuchThing
@@ -0,0 +1,99 @@
+"""Test the JWT claims builder"""
+import logging
+import secrets
+import uuid
+
+import pytest
+
+from arkia11nmodels.jwtclaims import ClaimsBuilder, b64url, verify_hs256
+from arkia11nmodels.models import Role
+from arkia11nmodels.schemas.role import ACL, ACLItem
+from arkia11nmodels.schemas.acltrie import ACLMatcher
+from .test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+
+LOGGER = logging.getLogger(__name__)
+PRIVILEGES = ("fi.pvarki.jwttest:read", "fi.pvarki.jwttest:write", "fi.pvarki.jwttest:admin")
+NOW = 1_700_000_000
+
+# pylint: disable=W0621
+
+
+def sample_acl() -> ACL:
+    """ACL with global, targeted, unknown, denied and inherit items"""
+    return ACL(
+        [
+            ACLItem(privilege="fi.pvarki.jwttest:read", action=True),
+            ACLItem(privilege="fi.pvarki.jwttest:admin", action=True),
+            ACLItem(privilege="fi.pvarki.jwttest:write", action=False),
+            ACLItem(privilege="fi.pvarki.jwttest:write", action=True, target="node1.pvarki.fi"),
+            ACLItem(privilege="fi.pvarki.other", action=True, target="*.pvarki.fi"),
+            ACLItem(privilege="fi.pvarki.jwttest:read", action=False, target="node2.pvarki.fi"),
+            ACLItem(privilege="fi.pvarki.unknown", action=True),
+            ACLItem(privilege="fi.pvarki.inherited", action=None),
+        ]
+    )
+
+
+def test_roundtrip() -> None:
+    """Claims give the same decisions, global denies and inherits are dropped"""
+    builder = ClaimsBuilder(secrets.token_bytes(32), PRIVILEGES)
+    subject = uuid.uuid4()
+    claims = builder.verify(builder.issue(subject, sample_acl(), NOW), NOW + 1)
+    LOGGER.debug("claims={}".format(claims))
+    assert claims["iat"] == NOW // builder.bucket * builder.bucket
+    assert claims["exp"] == claims["iat"] + builder.bucket + builder.lifetime
+    assert claims["acl"]["g"] == b64url(bytes([0b101]))
+    assert claims["acl"]["t"] == {"1": ["node1.pvarki.fi"], "fi.pvarki.other": ["*.pvarki.fi"]}
+    assert claims["acl"]["d"] == {"0": ["node2.pvarki.fi"]}
+    assert claims["acl"]["x"] == ["fi.pvarki.unknown"]
+    expected, got = ACLMatcher(sample_acl()), ACLMatcher(builder.acl_from_claims(claims))
+    for privilege in PRIVILEGES + ("fi.pvarki.other", "fi.pvarki.unknown", "fi.pvarki.inherited"):
+        for target in (None, "node1.pvarki.fi", "node2.pvarki.fi", "pvarki.fi"):
+            assert got.check(privilege, target) == expected.check(privilege, target), (privilege, target)
+
+    other = ClaimsBuilder(builder.key, PRIVILEGES + ("fi.pvarki.jwttest:new",))
+    with pytest.raises(ValueError):
+        other.acl_from_claims(claims)
+
+
+def test_cache_and_determinism() -> None:
+    """Same ACL content gives the same JWT within the bucket"""
+    key = secrets.token_bytes(32)
+    builder = ClaimsBuilder(key, PRIVILEGES, bucket=60)
+    subject = uuid.uuid4()
+    jwt = builder.issue(subject, sample_acl(), NOW)
+    assert builder.issue(subject, sample_acl(), NOW + 1) == jwt
+    assert builder.stats == {"hits": 1, "misses": 1}
+    assert ClaimsBuilder(key, PRIVILEGES, bucket=60).issue(subject, sample_acl(), NOW) == jwt
+    assert builder.issue(subject, sample_acl(), NOW + 60) != jwt
+    assert builder.issue(uuid.uuid4(), sample_acl(), NOW) != jwt
+    assert builder.stats == {"hits": 1, "misses": 3}
+
+
+def test_verify_rejects() -> None:
+    """Bad signature, tampering and expiry raise ValueError"""
+    builder = ClaimsBuilder(secrets.token_bytes(32), PRIVILEGES)
+    jwt = builder.issue(uuid.uuid4(), sample_acl(), NOW)
+    with pytest.raises(ValueError, match="signature"):
+        verify_hs256(jwt, secrets.token_bytes(32), NOW)
+    header, claims, signature = jwt.split(".")
+    with pytest.raises(ValueError, match="signature"):
+        builder.verify(".".join((header, claims[:-2] + "AA", signature)), NOW)
+    with pytest.raises(ValueError, match="Malformed"):
+        builder.verify(header, NOW)
+    with pytest.raises(ValueError, match="Expired"):
+        builder.verify(jwt, NOW + builder.bucket + builder.lifetime)
+
+
+@pytest.mark.asyncio
+async def test_issue_for_user(role_test_db: RoleTestDbType) -> None:
+    """Claims carry the users resolved ACL"""
+    user1, _, role_1, _, _ = role_test_db
+    await role_1.update(acl=[{"privilege": "fi.pvarki.jwttest:read", "action": True}]).apply()
+    builder = ClaimsBuilder(secrets.token_bytes(32), PRIVILEGES)
+    claims = builder.verify(await builder.issue_for_user(user1))
+    got = ACLMatcher(builder.acl_from_claims(claims))
+    expected = ACLMatcher(await Role.resolve_user_acl(user1))
+    assert got.check("fi.pvarki.jwttest:read", None)
+    for privilege in PRIVILEGES + ("fi.pvarki.arkia11nmodels.user:read",):
+        assert got.check(privilege, None) == expected.check(privilege, None), privilege
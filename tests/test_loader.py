@@ -0,0 +1,105 @@
+"""Test the batching get-by-pk loader"""
+from typing import Any
+import asyncio
+import uuid
+
+import pytest
+
+from arkia11nmodels import dbconfig
+from arkia11nmodels.models import db, Role, User, routing
+from arkia11nmodels.models.loader import ModelLoader, get_loader, loader_scope
+from arkia11nmodels.clickhelpers import get_by_uuid
+from .test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+
+# pylint: disable=W0621
+
+
+@pytest.mark.asyncio
+async def test_coalesce(role_test_db: RoleTestDbType) -> None:
+    """Concurrent loads are one query, duplicates are fetched once"""
+    user1, user2, _role_1, role_100, _role_1000 = role_test_db
+    loader: ModelLoader[User] = ModelLoader(User)
+    missing = uuid.uuid4()
+    found = await asyncio.gather(*(loader.load(pk) for pk in (user1.pk, str(user2.pk), missing, user1.pk)))
+    assert [obj.pk if obj else None for obj in found] == [user1.pk, user2.pk, None, user1.pk]
+    assert loader.stats == {"loads": 4, "deduplicated": 1, "queries": 1, "rows": 2}
+
+    # Next tick is a new batch and nothing is cached
+    assert (await loader.load(user1.pk)).email == user1.email  # type: ignore[union-attr]
+    assert loader.stats["queries"] == 2
+
+    # soft-deleted are skipped unless asked for
+    await role_100.soft_delete()
+    assert await ModelLoader(Role).load(role_100.pk) is None
+    assert (await ModelLoader(Role, include_deleted=True).load_many([role_100.pk]))[0] is not None
+
+
+@pytest.mark.asyncio
+async def test_scope_cache(role_test_db: RoleTestDbType) -> None:
+    """Within loader_scope loaded objects are cached, also for tasks started in it"""
+    user1, user2, _role_1, _role_100, _role_1000 = role_test_db
+    with loader_scope() as loaders:
+        await asyncio.gather(*(get_by_uuid(User, str(pk)) for pk in (user1.pk, user2.pk, user1.pk)))
+        loader = loaders[(User, False, dbconfig.SCHEMA, False)]
+        assert loader.stats["queries"] == 1
+        assert (await asyncio.create_task(get_by_uuid(User, str(user2.pk)))).pk == user2.pk
+        assert loader.stats["queries"] == 1
+        loader.clear(user2.pk)
+        await get_loader(User).load(user2.pk)
+        assert loader.stats["queries"] == 2
+    assert get_loader(User) is not loader
+    assert get_loader(User) is not get_loader(User)  # not shared outside the scope
+    assert not get_loader(User).cache
+
+    with pytest.raises(ValueError):
+        await get_by_uuid(User, str(uuid.uuid4()))
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_all_waiters(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Query failure is raised to every waiter and nothing is cached"""
+
+    class FailingBind:  # pylint: disable=R0903
+        """Bind that can not run queries"""
+
+        async def all(self, query: Any) -> None:
+            """Fail"""
+            _ = query  # str(query) would need a bound engine
+            raise ConnectionError("can not run the query")
+
+    monkeypatch.setattr(routing, "read_bind", lambda key: FailingBind())
+    loader: ModelLoader[User] = ModelLoader(User, cache=True)
+    results = await asyncio.gather(loader.load(uuid.uuid4()), loader.load(uuid.uuid4()), return_exceptions=True)
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert loader.stats["queries"] == 1
+    assert not loader._cached  # pylint: disable=W0212
+
+
+@pytest.mark.asyncio
+async def test_callers_context(role_test_db: RoleTestDbType) -> None:
+    """Loads are not batched with callers in other contexts, inside a transaction the own writes are seen"""
+    user1, user2, _role_1, _role_100, _role_1000 = role_test_db
+    displayname = str(user2.displayname)
+    with loader_scope() as loaders:
+        with routing.use_primary():
+            await get_loader(User).load(user1.pk)
+        await get_loader(User).load(user1.pk)
+        assert len(loaders) == 2
+
+        async def renamed() -> str:
+            async with db.transaction() as tx:
+                await user2.update(displayname="uncommitted").apply()
+                found = await get_loader(User).load(user2.pk)
+                loaded = await get_loader(User).load_many([user2.pk, user2.pk])
+                tx.raise_rollback()
+            assert all(obj is not None and obj.displayname == "uncommitted" for obj in loaded)
+            assert found is not None
+            return str(found.displayname)
+
+        async def other() -> str:
+            found = await get_loader(User).load(user2.pk)
+            assert found is not None
+            return str(found.displayname)
+
+        assert list(await asyncio.gather(renamed(), other())) == ["uncommitted", displayname]
+        assert (await get_loader(User).load(user2.pk)).displayname == displayname  # type: ignore[union-attr]
@@ -0,0 +1,59 @@
+"""Test the login storm load generator"""
+import json
+
+import pytest
+
+from arkia11nmodels import __version__
+from arkia11nmodels.loadtest import STAGES, cleanup, percentile, run_storm, seed_users, summarize
+from arkia11nmodels.models import Role, User
+from .test_console import run_cli
+
+
+def test_percentiles() -> None:
+    """Nearest-rank percentiles in milliseconds"""
+    samples = [idx / 1000 for idx in range(1, 101)]
+    assert percentile(samples, 50) == 0.05
+    assert percentile(samples, 99) == 0.099
+    assert percentile([0.2], 95) == 0.2
+    assert percentile([], 50) == 0.0
+    summary = summarize(list(reversed(samples)))
+    assert summary["count"] == 100
+    assert round(summary["p95"], 6) == 95.0
+    assert round(summary["max"], 6) == 100.0
+    assert summarize([])["p99"] == 0.0
+
+
+@pytest.mark.asyncio
+async def test_storm(dockerdb: str) -> None:
+    """Seed, run at a rate and clean up"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    emails = await seed_users(5, roles=3)
+    assert await seed_users(5, roles=3) == emails  # reused
+    user = await User.get_by_email(emails[0])
+    assert user is not None and len(await Role.list_user_roles(user)) == 2
+    try:
+        report = await run_storm(emails, logins=12, concurrency=3, rate=200)
+        assert report["version"] == __version__
+        assert report["errors"] == {} and report["completed"] == 12
+        assert list(report["stages"]) == list(STAGES)
+        assert all(stage["count"] == 12 for stage in report["stages"].values())
+        assert report["stages"]["total"]["p99"] >= report["stages"]["acl"]["p99"]
+        assert report["elapsed"] >= 11 / 200
+        missing = await run_storm(["nosuchuser@example.com"], logins=2)
+        assert missing["completed"] == 0 and sum(missing["errors"].values()) == 2
+    finally:
+        counts = await cleanup()
+    assert counts["users"] == 5 and counts["roles"] == 3 and counts["tokens"] == 12
+    assert await User.get_by_email(emails[0]) is None
+
+
+@pytest.mark.asyncio
+async def test_cli(dockerdb: str) -> None:
+    """The command prints the report"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    code, out, err = await run_cli("loadtest", "--users", "3", "--roles", "2", "-n", "6", "-c", "2", "--cleanup")
+    assert code == 0, err
+    report = json.loads(out)
+    assert report["completed"] == 6
+    assert report["config"]["pool_size"] == 8 and report["config"]["roles_per_user"] == 2
+    assert await User.get_by_email("loadtest0@example.com") is None
@@ -0,0 +1,146 @@
+"""Test the per-request connection scoping"""
+from typing import Any, AsyncGenerator, Dict, List
+import asyncio
+import logging
+
+import pytest
+import pytest_asyncio
+
+from arkia11nmodels import dbconfig
+from arkia11nmodels.middleware import DBConnectionMiddleware, Message, Receive, Scope, Send
+from arkia11nmodels.models import db, Role, Token, User
+from arkia11nmodels.models.loader import ModelLoader
+from arkia11nmodels.clickhelpers import get_by_uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# pylint: disable=W0621
+
+
+@pytest_asyncio.fixture
+async def with_token(dockerdb: str) -> AsyncGenerator[Token, None]:
+    """User with a token"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    user = await User.create(email="middlewaretest@example.com")
+    token = Token.for_user(user)
+    token.sent_to = user.email
+    await token.create()
+    yield token
+    await token.delete()
+    await user.delete()
+
+
+@pytest.fixture
+def pool_acquires(monkeypatch: pytest.MonkeyPatch) -> List[Any]:
+    """Record connections acquired from the primary pool"""
+    acquired: List[Any] = []
+    pool = db.bind._pool  # pylint: disable=W0212
+    orig_acquire = pool.acquire
+
+    async def acquire(*args: Any, **kwargs: Any) -> Any:
+        conn = await orig_acquire(*args, **kwargs)
+        acquired.append(conn)
+        return conn
+
+    monkeypatch.setattr(pool, "acquire", acquire)
+    return acquired
+
+
+async def request_handler(scope: Scope, receive: Receive, send: Send) -> None:
+    """ASGI app doing the typical request work"""
+    _ = scope, receive
+    token = await Token.get_by_pk(scope["token_pk"])
+    assert token
+    user = await get_by_uuid(User, str(token.user))
+    assert await Role.resolve_user_acl(user)
+    await token.mark_used()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def call_app(token: Token, scope_type: str = "http", **kwargs: Any) -> List[Message]:
+    """Call the app wrapped in the middleware"""
+    sent: List[Message] = []
+
+    async def receive() -> Message:
+        return {"type": "http.request", "body": b""}
+
+    async def send(message: Message) -> None:
+        sent.append(message)
+
+    await DBConnectionMiddleware(request_handler, **kwargs)({"type": scope_type, "token_pk": token.pk}, receive, send)
+    return sent
+
+
+@pytest.mark.asyncio
+async def test_one_connection_per_request(with_token: Token, pool_acquires: List[Any]) -> None:
+    """All the model calls within the request use the same connection"""
+    sent = await call_app(with_token)
+    assert sent[0]["status"] == 200
+    assert len(pool_acquires) == 1
+    assert (await Token.get(with_token.pk)).used
+
+
+@pytest.mark.asyncio
+async def test_disabled(with_token: Token, pool_acquires: List[Any], monkeypatch: pytest.MonkeyPatch) -> None:
+    """Without DB_USE_CONNECTION_FOR_REQUEST each call borrows its own"""
+    monkeypatch.setattr(dbconfig, "USE_CONNECTION_FOR_REQUEST", False)
+    await call_app(with_token)
+    assert len(pool_acquires) > 1
+
+
+@pytest.mark.asyncio
+async def test_tenant_schema(with_token: Token, pool_acquires: List[Any], monkeypatch: pytest.MonkeyPatch) -> None:
+    """schema_for scopes the request to the tenant schema, also one connection"""
+    monkeypatch.setattr(dbconfig, "USE_CONNECTION_FOR_REQUEST", False)
+    schemas: List[str] = []
+
+    def schema_for(scope: Scope) -> str:
+        schemas.append(scope["type"])
+        return str(dbconfig.SCHEMA)
+
+    sent = await call_app(with_token, schema_for=schema_for)
+    assert sent[0]["status"] == 200
+    assert schemas == ["http"]
+    assert len(pool_acquires) == 1
+
+
+@pytest.mark.asyncio
+async def test_websockets(with_token: Token, pool_acquires: List[Any]) -> None:
+    """Websockets are passed through unless enabled, they would hold the connection while open"""
+    await call_app(with_token, "websocket")
+    assert len(pool_acquires) > 1
+    pool_acquires.clear()
+    await call_app(with_token, "websocket", websockets=True)
+    assert len(pool_acquires) == 1
+
+
+@pytest.mark.asyncio
+async def test_loads_coalesced(with_token: Token, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Concurrent get_by_uuid() calls within a request are one query"""
+    fetches: List[int] = []
+    orig_fetch = ModelLoader._fetch  # pylint: disable=W0212
+
+    async def fetch(self: ModelLoader[Any], batch: Dict[Any, Any]) -> None:
+        fetches.append(len(batch))
+        await orig_fetch(self, batch)
+
+    monkeypatch.setattr(ModelLoader, "_fetch", fetch)
+
+    async def handler(scope: Scope, receive: Receive, send: Send) -> None:
+        _ = scope, receive
+        pk = str(with_token.user)
+        users = await asyncio.gather(*(get_by_uuid(User, pk) for _ in range(3)))
+        assert all(user.pk == with_token.user for user in users)
+        await get_by_uuid(User, pk)  # cached for the request
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+
+    async def receive() -> Message:
+        return {"type": "http.request", "body": b""}
+
+    async def send(message: Message) -> None:
+        _ = message
+
+    for _ in range(2):
+        await DBConnectionMiddleware(handler)({"type": "http"}, receive, send)
+    assert fetches == [1, 1]  # one per request
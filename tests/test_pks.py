@@ -0,0 +1,47 @@
+"""Test the primary key generation"""
+import uuid
+
+import pytest
+from libadvian.binpackers import b64_to_uuid, uuid_to_b64
+
+from arkia11nmodels import dbconfig
+from arkia11nmodels.models import User
+from arkia11nmodels.models.base import uuid7, new_pk
+
+
+def test_uuid7_format() -> None:
+    """Check version, variant and the timestamp"""
+    before = uuid7()
+    value = uuid7()
+    assert value.version == 7
+    assert value.variant == uuid.RFC_4122
+    assert b64_to_uuid(uuid_to_b64(value)) == value
+    assert before.int >> 80 <= value.int >> 80
+
+
+def test_uuid7_monotonic() -> None:
+    """Check the values sort in generation order (also within the same millisecond)"""
+    values = [uuid7() for _ in range(10000)]
+    assert values == sorted(values, key=lambda val: val.bytes)
+    assert len(set(values)) == len(values)
+
+
+def test_new_pk(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check the config switch"""
+    assert new_pk().version == 4
+    monkeypatch.setattr(dbconfig, "TIME_ORDERED_PKS", True)
+    assert new_pk().version == 7
+
+
+@pytest.mark.asyncio
+async def test_model_pk(dockerdb: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check models get uuid7 pks when configured"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    monkeypatch.setattr(dbconfig, "TIME_ORDERED_PKS", True)
+    user = await User.create(email="pktest@example.com")
+    try:
+        assert user.pk.version == 7
+        fetched = await User.get(user.pk)
+        assert fetched.pk == user.pk
+    finally:
+        await user.delete()
@@ -0,0 +1,81 @@
+"""Test the prepared statements and the switch to turn them off"""
+import logging
+
+import pytest
+
+from arkia11nmodels import dbconfig
+from arkia11nmodels.models import Role, User, Token
+from arkia11nmodels.models.role import UserRole
+from .test_role import role_test_db, RoleTestDbType  # pylint: disable=W0611 # false positive
+from .test_token import with_user  # pylint: disable=W0611 # false positive
+
+LOGGER = logging.getLogger(__name__)
+
+# pylint: disable=W0621
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("enabled", [True, False])
+async def test_same_results(role_test_db: RoleTestDbType, monkeypatch: pytest.MonkeyPatch, enabled: bool) -> None:
+    """Results must be the same with prepared statements on or off"""
+    monkeypatch.setattr(dbconfig, "PREPARED_STATEMENTS", enabled)
+    user1, user2, role_1, role_100, _role_1000 = role_test_db
+
+    roles = await Role.list_user_roles(user1)
+    assert [role.priority for role in roles] == [1000, 100, 1]
+    assert isinstance(roles[0].acl, list)
+    assert roles[0].created
+    users = await role_1.list_role_users()
+    assert {user.pk for user in users} == {user1.pk, user2.pk}
+    assert users[0].profile == {}
+
+    link = await UserRole.get_link(role_100.pk, user1.pk)
+    assert link
+    assert link.user == user1.pk
+    assert not await UserRole.get_link(role_100.pk, user2.pk)
+    assert not await role_100.remove_from(user2)
+    assert await role_100.remove_from(user1)
+    link = await UserRole.get_link(role_100.pk, user1.pk)
+    assert link
+    assert link.deleted
+    assert await role_100.assign_to(user1)
+
+    fetched = await User.get_by_email(user1.email)
+    assert fetched
+    assert fetched.pk == user1.pk
+    assert not await User.get_by_email("nosuchuser@example.com")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("enabled", [True, False])
+async def test_token_get_by_pk(with_user: User, monkeypatch: pytest.MonkeyPatch, enabled: bool) -> None:
+    """Test token lookup"""
+    monkeypatch.setattr(dbconfig, "PREPARED_STATEMENTS", enabled)
+    token = Token.for_user(with_user)
+    token.sent_to = with_user.email
+    await token.create()
+    try:
+        fetched = await Token.get_by_pk(token.pk)
+        assert fetched
+        assert fetched.pk == token.pk
+        assert fetched.is_valid()
+        assert fetched.audit_meta == {}
+    finally:
+        await token.delete()
+    assert not await Token.get_by_pk(token.pk)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("enabled", [True, False])
+async def test_role_user_records(role_test_db: RoleTestDbType, monkeypatch: pytest.MonkeyPatch, enabled: bool) -> None:
+    """Check the lightweight records match the models"""
+    monkeypatch.setattr(dbconfig, "PREPARED_STATEMENTS", enabled)
+    _user1, _user2, role_1, _role_100, _role_1000 = role_test_db
+    users = await role_1.list_role_users()
+    records = await role_1.list_role_user_records()
+    assert [(user.pk, user.email, user.displayname) for user in users] == [tuple(record) for record in records]
+    assert records[0].email == users[0].email
+    records = await role_1.list_role_user_records(["email", "profile"])
+    assert records[0]._asdict() == {"email": users[0].email, "profile": {}}
+    with pytest.raises(ValueError):
+        await role_1.list_role_user_records(["nosuchcolumn"])
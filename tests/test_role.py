@@ -1,16 +1,19 @@
 """Test roles and linking"""
-from typing import AsyncGenerator, List, Tuple
+from typing import Any, AsyncGenerator, List, Tuple
 import logging
 import json
+import uuid
 
 import pytest
 import pytest_asyncio
-from asyncpg.exceptions import UniqueViolationError
+import pendulum
+from asyncpg.exceptions import UniqueViolationError, ForeignKeyViolationError
 from libadvian.binpackers import b64_to_uuid, uuid_to_b64
 from pydantic import ValidationError
 
-from arkia11nmodels.models import Role, User
-from arkia11nmodels.models.role import UserRole
+from arkia11nmodels.models import db, Role, User, Token
+from arkia11nmodels.models.role import UserRole, RoleParent, RoleClosure
+from arkia11nmodels import aclcache
 from arkia11nmodels.schemas.role import RoleCreate, DBRole, ACLItem, ACL
 from arkia11nmodels.clickhelpers import get_by_uuid
 from .test_token import with_user  # pylint: disable=W0611 # false positive
@@ -21,14 +24,12 @@ LOGGER = logging.getLogger(__name__)
 
 
 @pytest_asyncio.fixture(scope="function")
-async def with_role(dockerdb: str) -> AsyncGenerator[User, None]:
-    """Create a role for tests"""
-    _ = dockerdb  # consume the fixture to keep linter happy
+async def with_role(rollbackdb: Any) -> AsyncGenerator[User, None]:
+    """Create a role for tests, it and everything the test does after is rolled back"""
+    _ = rollbackdb  # consume the fixture to keep linter happy
     role = Role(displayname="Testing role")
     await role.create()
     yield role
-    await UserRole.delete.where(UserRole.role == role.pk).gino.status()  # Nuke leftovers
-    await role.delete()
 
 
 @pytest.mark.asyncio
@@ -182,13 +183,15 @@ async def test_userrole_unique(with_user: User, with_role: Role) -> None:
     await link1.create()
 
     with pytest.raises(UniqueViolationError):
-        link2 = UserRole(role=with_role.pk, user=with_user.pk)
-        await link2.create()
+        async with db.transaction():  # savepoint, the error would abort the rollbackdb transaction
+            link2 = UserRole(role=with_role.pk, user=with_user.pk)
+            await link2.create()
 
     await link1.delete()
 
 
 RoleTestDbType = Tuple[User, User, Role, Role, Role]
+RoleHierarchyType = Tuple[RoleTestDbType, Role, Role]
 
 
 @pytest_asyncio.fixture
@@ -288,3 +291,182 @@ async def test_acl_merge(role_test_db: RoleTestDbType) -> None:
 
     _user2_acl = await Role.resolve_user_acl(user2)
     # FIXME: Check the merged ACLs are what we expect
+
+
+@pytest.mark.asyncio
+async def test_list_with_roles(role_test_db: RoleTestDbType) -> None:
+    """Test users with roles in one query and the keyset pagination"""
+    user1, user2, _role_1, _role_100, role_1000 = role_test_db
+    # user without roles is listed too
+    user3 = User(email="norole@example.com")
+    await user3.create()
+    try:
+        listed = {user.pk: roles for user, roles in await User.list_with_roles()}
+        for user in (user1, user2):
+            assert [role.pk for role in listed[user.pk]] == [role.pk for role in await Role.list_user_roles(user)]
+        assert listed[user3.pk] == []
+
+        # removed links are not listed
+        assert await role_1000.remove_from(user2)
+        listed = {user.pk: roles for user, roles in await User.list_with_roles()}
+        assert role_1000.pk not in {role.pk for role in listed[user2.pk]}
+
+        # walk forward one by one, then back
+        pages = []
+        page = await User.list_with_roles(limit=1)
+        while page:
+            assert len(page) == 1
+            pages.append(page[0][0])
+            page = await User.list_with_roles(limit=1, after=page[0][0].page_key())
+        keys = [user.page_key() for user in pages]
+        assert keys == sorted(keys)
+        assert {user1.pk, user2.pk, user3.pk} <= {user.pk for user in pages}
+        back = await User.list_with_roles(limit=2, before=pages[-1].page_key())
+        assert [user.pk for user, _ in back] == [user.pk for user in pages[-3:-1]]
+
+        with pytest.raises(ValueError):
+            await User.list_with_roles(after=user1.page_key(), before=user2.page_key())
+    finally:
+        await user3.delete()
+
+
+@pytest.mark.asyncio
+async def test_issue_tokens_for_role(role_test_db: RoleTestDbType) -> None:
+    """Test bulk token issuance for role members"""
+    user1, user2, role_1, _role_100, _role_1000 = role_test_db
+    expires = pendulum.now("UTC") + pendulum.duration(hours=1)
+    tokens = await Token.issue_many(role_1.iter_role_user_records(("pk", "email")), expires=expires, redirect="/x")
+    try:
+        assert {token.user for token in tokens} == {user1.pk, user2.pk}
+        for token in tokens:
+            fetched = await Token.get(token.pk)
+            assert fetched.to_dict() == token.to_dict()
+            assert fetched.expires == expires
+            assert fetched.sent_to in (user1.email, user2.email)
+            assert fetched.is_valid()
+
+        # Sync iterables work too, and one bad user means none are created
+        class Missing:  # pylint: disable=R0903
+            """Not in the DB"""
+
+            pk = uuid.uuid4()
+            email = "missing@example.com"
+
+        with pytest.raises(ForeignKeyViolationError):
+            await Token.issue_many([user1, Missing()], sent_to="override@example.com")
+        assert await Token.query.where(Token.sent_to == "override@example.com").gino.all() == []
+    finally:
+        await Token.delete.where(Token.user.in_([user1.pk, user2.pk])).gino.status()
+
+
+@pytest_asyncio.fixture
+async def role_hierarchy(role_test_db: RoleTestDbType) -> AsyncGenerator[RoleHierarchyType, None]:
+    """role_100 inherits parent which inherits grandparent, both with same priority and conflicting ACLs"""
+    _user1, _user2, _role_1, role_100, _role_1000 = role_test_db
+    parent = Role(displayname="Parent", priority=50, acl=[{"privilege": "fi.pvarki.inherittest", "action": True}])
+    await parent.create()
+    grandparent = Role(
+        displayname="Grandparent", priority=50, acl=[{"privilege": "fi.pvarki.inherittest", "action": False}]
+    )
+    await grandparent.create()
+    assert await parent.add_parent(grandparent)
+    assert await role_100.add_parent(parent)
+
+    yield role_test_db, parent, grandparent
+
+    # clean up
+    pks = [role.pk for role in role_test_db[2:]] + [parent.pk, grandparent.pk]
+    await RoleClosure.delete.where(RoleClosure.descendant.in_(pks)).gino.status()
+    await RoleParent.delete.where(RoleParent.role.in_(pks)).gino.status()
+    await parent.delete()
+    await grandparent.delete()
+
+
+@pytest.mark.asyncio
+async def test_role_inheritance(role_hierarchy: RoleHierarchyType) -> None:  # pylint: disable=R0914
+    """Inherited roles are resolved via the closure with nearest role winning on same priority"""
+    (user1, user2, role_1, role_100, _role_1000), parent, grandparent = role_hierarchy
+    assert [role.pk for role in await role_100.list_parents()] == [parent.pk]
+    assert [role.pk for role in await role_100.list_ancestors()] == [parent.pk, grandparent.pk]
+    effective = [(role.pk, depth) async for role, depth in Role.iter_effective_roles(user1)]
+    assert (parent.pk, 1) in effective
+    assert (grandparent.pk, 2) in effective
+    assert effective.index((grandparent.pk, 2)) < effective.index((parent.pk, 1))
+    # direct roles are not changed
+    assert {role.pk for role in await Role.list_user_roles(user1)} == {role_1.pk, role_100.pk, _role_1000.pk}
+    acl = {item.privilege: item.action for item in await Role.merge_user_acl(user1)}
+    assert acl["fi.pvarki.inherittest"] is True
+    assert "fi.pvarki.inherittest" not in {item.privilege for item in await Role.merge_user_acl(user2)}
+
+    # no cycles, no duplicates
+    with pytest.raises(ValueError):
+        await grandparent.add_parent(role_100)
+    with pytest.raises(ValueError):
+        await role_100.add_parent(role_100)
+    assert not await role_100.add_parent(parent)
+
+    # Shortest path is used, user2 gets grandparent via role_1
+    cache = aclcache.ACLCache(aclcache.MemoryBackend())
+    aclcache.set_cache(cache)
+    try:
+        await Role.resolve_user_acl(user2)
+        assert await role_1.add_parent(grandparent)
+        acl = {item.privilege: item.action for item in await Role.resolve_user_acl(user2)}
+        assert acl["fi.pvarki.inherittest"] is False
+        effective = [(role.pk, depth) async for role, depth in Role.iter_effective_roles(user1)]
+        assert [pk for pk, _ in effective].count(grandparent.pk) == 1
+        assert (grandparent.pk, 1) in effective
+
+        # removing rebuilds the closure of the role and its descendants
+        assert await parent.remove_parent(grandparent)
+        assert not await parent.remove_parent(grandparent)
+        assert [role.pk for role in await role_100.list_ancestors()] == [parent.pk]
+        assert await role_1.remove_parent(grandparent)
+        assert grandparent.pk not in {role.pk for role in await Role.list_effective_roles(user1)}
+        acl = {item.privilege: item.action for item in await Role.resolve_user_acl(user2)}
+        assert "fi.pvarki.inherittest" not in acl
+    finally:
+        aclcache.set_cache(None)
+
+
+@pytest.mark.asyncio
+async def test_soft_deleted_role(rollbackdb: Any) -> None:
+    """Soft-deleted roles do not grant, not even what they inherit, soft-deleted users are not members"""
+    _ = rollbackdb  # consume the fixture to keep linter happy
+    user = await User.create(email="softrole@example.com")
+    other = await User.create(email="softrole2@example.com")
+    roles = [
+        await Role.create(
+            displayname=f"softrole {idx}", acl=[{"privilege": f"fi.pvarki.softrole{idx}", "action": True}]
+        )
+        for idx in range(3)
+    ]
+    assert await roles[0].add_parent(roles[1])
+    assert await roles[1].add_parent(roles[2])
+    for member in (user, other):
+        assert await roles[0].assign_to(member)
+    cache = aclcache.ACLCache(aclcache.MemoryBackend())
+    aclcache.set_cache(cache)
+    try:
+        privileges = {item.privilege for item in await Role.resolve_user_acl(user)}
+        assert {"fi.pvarki.softrole0", "fi.pvarki.softrole1", "fi.pvarki.softrole2"} <= privileges
+
+        await roles[1].soft_delete()  # and with it the grandparent inherited only via it
+        privileges = {item.privilege for item in await Role.resolve_user_acl(user)}
+        assert "fi.pvarki.softrole0" in privileges
+        assert not privileges & {"fi.pvarki.softrole1", "fi.pvarki.softrole2"}
+        assert await roles[0].list_ancestors() == []
+
+        await roles[0].soft_delete()
+        privileges = {item.privilege for item in await Role.resolve_user_acl(user)}
+        assert not any(privilege.startswith("fi.pvarki.softrole") for privilege in privileges)
+        assert await Role.list_user_roles(user) == []
+        assert await Role.list_effective_roles(user) == []
+    finally:
+        aclcache.set_cache(None)
+
+    assert await roles[2].assign_to(user)
+    assert await roles[2].assign_to(other)
+    await other.soft_delete()
+    assert [member.pk for member in await roles[2].list_role_users()] == [user.pk]
+    assert [record.pk for record in await roles[2].list_role_user_records()] == [user.pk]
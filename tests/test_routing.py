@@ -0,0 +1,118 @@
+"""Test the read replica routing"""
+from typing import AsyncGenerator, Tuple
+import asyncio
+import copy
+import logging
+
+import gino
+import pytest
+import pytest_asyncio
+import sqlalchemy
+from sqlalchemy.engine.url import make_url
+
+from arkia11nmodels import dbconfig
+from arkia11nmodels.models import db, Role, User
+from arkia11nmodels.models import routing
+from arkia11nmodels.models.role import UserRole
+from arkia11nmodels.models.scope import connection_scope
+from arkia11nmodels.clickhelpers import get_by_uuid
+
+LOGGER = logging.getLogger(__name__)
+ReplicaTestType = Tuple[str, User, Role]
+
+# pylint: disable=W0621
+
+
+async def execute_raw(sql: str) -> None:
+    """Execute outside transaction (CREATE/DROP DATABASE)"""
+    async with db.acquire() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.execute(sql)
+
+
+@pytest_asyncio.fixture(scope="module")
+async def replica_dsn(dockerdb: str) -> AsyncGenerator[str, None]:
+    """Second database with the same schema standing in for a replica"""
+    url = copy.copy(make_url(dockerdb))
+    url.database = name = f"{url.database}_replica"  # unique per xdist worker like dockerdb
+    await execute_raw(f"DROP DATABASE IF EXISTS {name}")
+    await execute_raw(f"CREATE DATABASE {name}")
+    engine = await gino.create_engine(url)
+    await engine.status(sqlalchemy.schema.CreateSchema("a11n"))
+    await db.gino.create_all(bind=engine)
+    await engine.close()
+    yield str(url)
+    await execute_raw(f"DROP DATABASE IF EXISTS {name}")
+
+
+@pytest_asyncio.fixture
+async def with_replica(replica_dsn: str, monkeypatch: pytest.MonkeyPatch) -> AsyncGenerator[ReplicaTestType, None]:
+    """Bind the replica and create the same user and role in both databases, with different displaynames"""
+    monkeypatch.setattr(dbconfig, "REPLICA_PIN_SECONDS", 0.2)
+    replica = (await routing.bind_replicas([replica_dsn], min_size=1, max_size=2))[0]
+    user = await User.create(email="replicatest@example.com", displayname="primary")
+    role = await Role.create(displayname="primary")
+    await User.create(bind=replica, pk=user.pk, email=user.email, displayname="replica")
+    await Role.create(bind=replica, pk=role.pk, displayname="replica")
+    await UserRole.create(bind=replica, user=user.pk, role=role.pk)
+    yield replica_dsn, user, role
+    await routing.close_replicas()
+    await UserRole.delete.where(UserRole.role == role.pk).gino.status()
+    await role.delete()
+    await user.delete()
+    routing._PINNED_KEYS.clear()  # pylint: disable=W0212
+
+
+@pytest.mark.asyncio
+async def test_round_robin(replica_dsn: str) -> None:
+    """Check replicas are used in turn and the pins"""
+    assert routing.read_bind() is db
+    replicas = await routing.bind_replicas([replica_dsn, replica_dsn], min_size=1, max_size=1)
+    try:
+        first = routing.read_bind()
+        assert first in replicas
+        assert routing.read_bind() is not first
+        assert routing.read_bind() is first
+        with routing.use_primary():
+            assert routing.read_bind() is db
+        assert routing.read_bind() in replicas
+
+        async with db.acquire():
+            assert routing.read_bind() in replicas
+        async with db.transaction():
+            assert routing.read_bind() is db
+        async with connection_scope():
+            scoped = routing.read_bind()
+            assert routing.read_bind() is scoped
+            assert routing.read_bind() is scoped
+
+        # Pinning in other context (task) only pins the keys here
+        async def pin_in_task() -> None:
+            routing.pin_primary("somekey", seconds=0.1)
+
+        await asyncio.create_task(pin_in_task())
+        assert routing.read_bind("somekey") is db
+        assert routing.read_bind("otherkey") in replicas
+        await asyncio.sleep(0.2)
+        assert routing.read_bind("somekey") in replicas
+
+        routing.pin_primary(seconds=0.1)
+        assert routing.read_bind("otherkey") is db
+    finally:
+        await routing.close_replicas()
+
+
+@pytest.mark.asyncio
+async def test_reads_routed(with_replica: ReplicaTestType) -> None:
+    """Read-only methods read from the replica, writes pin to primary"""
+    _, user, role = with_replica
+    assert [item.displayname for item in await Role.list_user_roles(user)] == ["replica"]
+    assert [item.displayname for item in await role.list_role_users()] == ["replica"]
+    assert (await get_by_uuid(User, str(user.pk))).displayname == "replica"
+
+    assert await role.assign_to(user)
+    assert [item.displayname for item in await Role.list_user_roles(user)] == ["primary"]
+    assert [item.displayname for item in await role.list_role_users()] == ["primary"]
+
+    await asyncio.sleep(0.3)
+    assert [item.displayname for item in await Role.list_user_roles(user)] == ["replica"]
@@ -0,0 +1,235 @@
+"""Test the hash sharding of users over several databases"""
+from typing import Any, AsyncGenerator, List, Tuple
+from pathlib import Path
+import asyncio
+import copy
+import logging
+import uuid
+
+import gino
+import pytest
+import pytest_asyncio
+import sqlalchemy
+from asyncpg.exceptions import UniqueViolationError
+from sqlalchemy.engine.url import make_url
+
+from arkia11nmodels.models import db, Role, Token, User
+from arkia11nmodels.models import sharding
+from arkia11nmodels.models.role import UserRole, RoleParent, RoleClosure
+from arkia11nmodels.models.loader import get_loader
+from arkia11nmodels.models.base import use_bind
+from arkia11nmodels.models.scope import connection_scope
+from arkia11nmodels.aclsnapshot import ACLSnapshot, export_snapshot
+from .test_routing import execute_raw
+
+LOGGER = logging.getLogger(__name__)
+SHARD_SUFFIXES = ("_shard1", "_shard2")
+ShardTestType = Tuple[List[User], Role]
+
+# pylint: disable=W0621
+
+
+@pytest_asyncio.fixture(scope="module")
+async def shard_dsns(dockerdb: str) -> AsyncGenerator[List[str], None]:
+    """Two more databases with the same schema"""
+    ret = []
+    names = [f"{make_url(dockerdb).database}{suffix}" for suffix in SHARD_SUFFIXES]  # unique per xdist worker
+    for name in names:
+        url = copy.copy(make_url(dockerdb))
+        url.database = name
+        await execute_raw(f"DROP DATABASE IF EXISTS {name}")
+        await execute_raw(f"CREATE DATABASE {name}")
+        engine = await gino.create_engine(url)
+        await engine.status(sqlalchemy.schema.CreateSchema("a11n"))
+        await db.gino.create_all(bind=engine)
+        await engine.close()
+        ret.append(str(url))
+    yield ret
+    for name in names:
+        await execute_raw(f"DROP DATABASE IF EXISTS {name}")
+
+
+@pytest_asyncio.fixture
+async def sharded(shard_dsns: List[str]) -> AsyncGenerator[ShardTestType, None]:
+    """Bind the shards, create users until every shard has two and a role with ACL"""
+    await sharding.bind_shards(shard_dsns, min_size=1, max_size=4)
+    users: List[User] = []
+    while len({sharding.shard_index(user.pk) for user in users}) < len(sharding.SHARDS) or len(users) < 6:
+        users.append(await User.create(email=f"shardtest{len(users)}@example.com", displayname=f"shard{len(users)}"))
+    role = await Role.create(displayname="shardtest", acl=[{"privilege": "fi.pvarki.shardtest", "action": True}])
+    yield users, role
+
+    async def cleanup() -> None:
+        await Token.delete.gino.status()
+        await UserRole.delete.gino.status()
+        await RoleClosure.delete.gino.status()
+        await RoleParent.delete.gino.status()
+        await Role.delete.where(Role.displayname.like("shardtest%")).gino.status()
+        await User.delete.where(User.email.like("shardtest%")).gino.status()
+
+    await sharding.each_shard(cleanup)
+    await sharding.close_shards()
+
+
+async def shard_of(klass: type, pk: Any) -> List[int]:
+    """Indexes of the shards where the row is"""
+    query = sqlalchemy.select([sqlalchemy.func.count()]).where(klass.pk == pk)  # type: ignore[attr-defined]
+    found = await sharding.each_shard(lambda: db.scalar(query))
+    return [idx for idx, count in enumerate(found) if count]
+
+
+def test_unsharded() -> None:
+    """Without shards everything goes to db"""
+    assert not sharding.is_sharded()
+    pk = uuid.uuid4()
+    assert sharding.shard_index(pk) == 0
+    assert sharding.shard_bind(pk) is db
+    with sharding.use_shard(pk) as bind:
+        assert bind is db
+
+
+@pytest.mark.asyncio
+async def test_placement(sharded: ShardTestType) -> None:
+    """Users and their rows are on the users shard, roles on every shard"""
+    users, role = sharded
+    assert await shard_of(Role, role.pk) == [0, 1, 2]
+    await role.update(displayname="shardtest updated").apply()
+    for shard in sharding.SHARDS:
+        assert (await Role.get(role.pk, bind=shard)).displayname == "shardtest updated"
+    for user in users:
+        idx = sharding.shard_index(user.pk)
+        assert await shard_of(User, user.pk) == [idx]
+        assert await role.assign_to(user)
+        assert not await role.assign_to(user)
+        token = Token.for_user(user)
+        token.sent_to = user.email
+        await token.create()
+        assert sharding.shard_index(token.pk) == idx
+        assert await shard_of(Token, token.pk) == [idx]
+        if idx:
+            assert await UserRole.get_link(role.pk, user.pk) is None  # not in db, only in the users shard
+        with sharding.use_shard(user.pk):
+            link = await UserRole.get_link(role.pk, user.pk)
+        assert link is not None and await shard_of(UserRole, link.pk) == [idx]
+
+        fetched = await Token.get_by_pk(token.pk)
+        assert fetched is not None and fetched.is_valid()
+        await fetched.mark_used({"ip": "127.0.0.1"})
+        assert not (await Token.get(token.pk)).is_valid()
+        found = await User.get_by_email(user.email)
+        assert found is not None and found.pk == user.pk
+        assert [found.pk for found in await Role.list_user_roles(user)] == [role.pk]
+        acl = await Role.resolve_user_acl(user)
+        assert acl.check_many([("fi.pvarki.shardtest", None)]) == [True]
+
+    other = next(user for user in users if sharding.shard_index(user.pk) != sharding.shard_index(users[0].pk))
+    token = Token.for_user(other)
+    token.sent_to = other.email
+    token.pk = str(sharding.colocated_pk(users[0].pk))
+    with pytest.raises(ValueError):
+        await token.create()
+
+
+@pytest.mark.asyncio
+async def test_fan_out(sharded: ShardTestType) -> None:
+    """Listings read every shard"""
+    users, role = sharded
+    for user in users:
+        await role.assign_to(user)
+    assert {user.pk for user in await role.list_role_users()} == {user.pk for user in users}
+    assert len(await role.list_role_user_records()) == len(users)
+
+    pages = []
+    page = await User.list_with_roles(limit=4)
+    while page:
+        pages.append(page)
+        page = await User.list_with_roles(limit=4, after=page[-1][0].page_key())
+    everything = [entry for page in pages for entry in page]
+    listed = [entry for entry in everything if entry[0].email.startswith("shardtest")]
+    assert [entry[0].pk for entry in listed] == [user.pk for user in sorted(users, key=User.page_key)]
+    assert all(roles and roles[0].pk == role.pk for _, roles in listed)
+    before = await User.list_with_roles(limit=2, before=everything[4][0].page_key())
+    assert [entry[0].pk for entry in before] == [entry[0].pk for entry in everything[2:4]]
+
+    loaded = await get_loader(User).load_many([user.pk for user in users] + [uuid.uuid4()])
+    assert [user.pk for user in loaded[:-1] if user] == [user.pk for user in users]
+    assert loaded[-1] is None
+
+    tokens = await Token.issue_many(users)
+    assert {token.user for token in tokens} == {user.pk for user in users}
+    for token in tokens:
+        assert await shard_of(Token, token.pk) == [sharding.shard_index(token.user)]
+
+
+@pytest.mark.asyncio
+async def test_connection_scope(sharded: ShardTestType) -> None:
+    """Within a connection scope the shards are not run concurrently over the held connection"""
+    users, _ = sharded
+    running: List[int] = []
+
+    async def track() -> int:
+        running.append(len(running) + 1)
+        await asyncio.sleep(0.01)
+        concurrent = running[-1]
+        running.pop()
+        return concurrent
+
+    assert max(await sharding.each_shard(track)) > 1
+    async with connection_scope():
+        assert await sharding.each_shard(track) == [1, 1, 1]
+        assert len(await sharding.each_shard(User.query.where(User.email.like("shardtest%")).gino.all)) == 3
+        loaded = await get_loader(User).load_many([user.pk for user in users])
+        assert [user.pk for user in loaded if user] == [user.pk for user in users]
+        tokens = await Token.issue_many(users)
+    assert {token.user for token in tokens} == {user.pk for user in users}
+
+
+@pytest.mark.asyncio
+async def test_hierarchy_and_snapshot(sharded: ShardTestType, tmp_path: Path) -> None:
+    """Role hierarchy is replicated, snapshot has users of every shard"""
+    users, role = sharded
+    parent = await Role.create(
+        displayname="shardtest parent", acl=[{"privilege": "fi.pvarki.shardparent", "action": True}]
+    )
+    assert await role.add_parent(parent)
+    assert not await role.add_parent(parent)
+    for shard in sharding.SHARDS:
+        with use_bind(shard):
+            assert [found.pk for found in await role.list_parents()] == [parent.pk]
+    for user in users:
+        await role.assign_to(user)
+        acl = await Role.merge_user_acl(user)
+        assert acl.check_many([("fi.pvarki.shardparent", None)]) == [True]
+
+    path = str(tmp_path / "acl.snapshot")
+    await export_snapshot(path)
+    with ACLSnapshot(path) as snapshot:
+        for user in users:
+            assert snapshot.resolve_user_acl(user.pk) == await Role.merge_user_acl(user)
+    assert await role.remove_parent(parent)
+    for shard in sharding.SHARDS:
+        with use_bind(shard):
+            assert await role.list_parents() == []
+
+
+@pytest.mark.asyncio
+async def test_unique_addresses(sharded: ShardTestType) -> None:
+    """Email and sms are unique over all shards"""
+    users, _ = sharded
+    first = users[0]
+    other = next(user for user in users if sharding.shard_index(user.pk) != sharding.shard_index(first.pk))
+    with pytest.raises(UniqueViolationError):
+        await User.create(pk=sharding.colocated_pk(other.pk), email=first.email)
+    await first.update(sms="+358401234567").apply()
+    with pytest.raises(UniqueViolationError):
+        await other.update(sms="+358401234567").apply()
+    assert (await User.get(other.pk)).sms is None
+
+    # concurrent creates of the same address on different shards, one wins
+    results = await asyncio.gather(
+        *(User.create(pk=sharding.colocated_pk(user.pk), email="shardtest-new@example.com") for user in (first, other)),
+        return_exceptions=True,
+    )
+    assert sorted(type(result).__name__ for result in results) == ["UniqueViolationError", "User"]
+    found = await User.get_by_email("shardtest-new@example.com")
+    assert found is not None
@@ -0,0 +1,165 @@
+"""Test the tenant schemas"""
+from typing import Any, List, Optional
+import asyncio
+import copy
+import sys
+
+import gino
+import pytest
+from libadvian.binpackers import ensure_str
+from sqlalchemy.engine.url import make_url
+
+from arkia11nmodels import dbconfig
+from arkia11nmodels.models import db, User, tenants
+from arkia11nmodels.models.tenants import current_schema, tenant_scope, validate_schema, version_table
+from .test_console import run_cli
+from .test_routing import execute_raw
+
+MIGRATE_SCHEMAS = ("tenanttest1", "tenanttest2", "tenanttest3", "tenanttest4")
+# The tables are schema qualified at import so the search_path mode needs its own process
+TENANTS_SCRIPT = """
+import asyncio
+from arkia11nmodels import dbconfig
+from arkia11nmodels.clickhelpers import get_by_uuid
+from arkia11nmodels.dbdevhelpers import create_all, drop_all
+from arkia11nmodels.models import db, User
+from arkia11nmodels.models.loader import loader_scope
+from arkia11nmodels.models.tenants import connect_kwargs, current_schema, tenant_scope
+
+TENANTS = ("tenanttest_a", "tenanttest_b", "tenanttest_c")
+PKS = {}
+
+
+async def request(schema):
+    async with tenant_scope(schema):
+        assert current_schema() == schema
+        user = await User.get_by_email("tenanttest@example.com")
+        assert user.displayname == schema, (user.displayname, schema)
+        user = await get_by_uuid(User, str(PKS[schema]))  # through the loader
+        assert user.displayname == schema, (user.displayname, schema)
+        for other in TENANTS:
+            if other != schema:
+                try:
+                    await get_by_uuid(User, str(PKS[other]))
+                except ValueError:
+                    continue
+                raise AssertionError(f"{other} user found in {schema}")
+
+
+async def main():
+    await db.set_bind(dbconfig.DSN, min_size=1, max_size=2, **connect_kwargs())
+    for schema in TENANTS:
+        await create_all(schema)
+        async with tenant_scope(schema):
+            PKS[schema] = (await User.create(email="tenanttest@example.com", displayname=schema)).pk
+    try:
+        # more requests than connections, every connection serves several tenants
+        await asyncio.gather(*(request(TENANTS[idx % len(TENANTS)]) for idx in range(30)))
+        with loader_scope():  # the tenants must not share the loaders
+            await asyncio.gather(*(request(TENANTS[idx % len(TENANTS)]) for idx in range(30)))
+        assert await User.get_by_email("tenanttest@example.com") is None  # DB_SCHEMA outside the scopes
+        for _ in range(2):  # every connection of the pool is back on DB_SCHEMA
+            async with db.acquire() as conn:
+                assert await conn.scalar("SHOW search_path") == f"{dbconfig.SCHEMA}, public"
+    finally:
+        for schema in TENANTS:
+            await drop_all(schema)
+    print("ok")
+
+
+asyncio.run(main())
+"""
+
+
+def test_schema_names() -> None:
+    """Only plain lowercase identifiers are accepted"""
+    assert validate_schema("customer_1") == "customer_1"
+    for invalid in ("Customer", "1customer", "pg_catalog", "a11n; DROP TABLE users", "a" * 64, ""):
+        with pytest.raises(ValueError):
+            validate_schema(invalid)
+    assert version_table("a11n") == "alembic_version"
+    assert version_table("customer_1") == "alembic_version_customer_1"
+
+
+@pytest.mark.asyncio
+async def test_default_schema(dockerdb: str) -> None:
+    """With schema qualified tables only DB_SCHEMA is allowed"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    async with tenant_scope(dbconfig.SCHEMA):
+        assert current_schema() == dbconfig.SCHEMA
+        assert await User.get_by_email("nosuchuser@example.com") is None
+    with pytest.raises(ValueError):
+        async with tenant_scope("customer1"):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_restore_fails(dockerdb: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A connection left with the search_path of the tenant is terminated instead of reused"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    calls: List[Optional[str]] = []
+    set_search_path = tenants._set_search_path  # pylint: disable=W0212
+
+    async def failing_restore(conn: Any, schema: Optional[str]) -> None:
+        calls.append(schema)
+        if len(calls) > 1:
+            raise asyncio.CancelledError()
+        await set_search_path(conn, schema)
+
+    monkeypatch.setattr(tenants, "_set_search_path", failing_restore)
+    with pytest.raises(asyncio.CancelledError):
+        async with tenant_scope(dbconfig.SCHEMA) as conn:
+            pid = await conn.scalar("SELECT pg_backend_pid()")
+    assert calls == [dbconfig.SCHEMA, None]
+    monkeypatch.undo()
+    await asyncio.sleep(0.1)
+    assert not await db.scalar(f"SELECT count(*) FROM pg_stat_activity WHERE pid = {pid}")
+    assert await User.get_by_email("nosuchuser@example.com") is None  # the pool replaced the connection
+
+
+@pytest.mark.asyncio
+async def test_search_path_tenants(dockerdb: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tenants in their own schemas sharing a small pool"""
+    monkeypatch.setenv("DB_DSN", dockerdb)
+    monkeypatch.setenv("DB_SCHEMA_FROM_SEARCH_PATH", "true")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", TENANTS_SCRIPT, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    out, err = await asyncio.wait_for(process.communicate(), 60)
+    assert process.returncode == 0, ensure_str(err)
+    assert ensure_str(out).strip() == "ok"
+
+
+@pytest.mark.asyncio
+async def test_migrate_schemas(dockerdb: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Alembic migrations for several schemas in parallel"""
+    url = copy.copy(make_url(dockerdb))
+    url.database = name = f"{url.database}_tenants"  # unique per xdist worker like dockerdb
+    await execute_raw(f"DROP DATABASE IF EXISTS {name}")
+    await execute_raw(f"CREATE DATABASE {name}")
+    monkeypatch.setenv("DB_DATABASE", name)
+    try:
+        # up to the revision before pg_trgm, the test database may not have the extension
+        code, out, err = await run_cli("-j", "3", "tenant", "migrate", "--revision", "5c1e0f3a9b27", *MIGRATE_SCHEMAS)
+        assert code == 0, err
+        assert out.strip() == '{"tenanttest1": 0, "tenanttest2": 0, "tenanttest3": 0, "tenanttest4": 0}'
+        engine = await gino.create_engine(url)
+        tables: List[str] = [
+            f"{row[0]}.{row[1]}"
+            for row in await engine.all(
+                "SELECT table_schema, table_name FROM information_schema.tables"
+                " WHERE table_schema LIKE 'tenanttest%' ORDER BY 1, 2"
+            )
+        ]
+        for schema in MIGRATE_SCHEMAS:
+            assert await engine.scalar(f"SELECT version_num FROM {version_table(schema)}") == "5c1e0f3a9b27"
+        # the initial revision (schema a11n) was stamped, not run
+        assert not await engine.scalar("SELECT count(*) FROM information_schema.schemata WHERE schema_name = 'a11n'")
+        await engine.close()
+        assert tables == [
+            f"{schema}.{table}" for schema in MIGRATE_SCHEMAS for table in ("roles", "tokens", "userroles", "users")
+        ]
+        code, _, err = await run_cli("tenant", "migrate", "Invalid")
+        assert code == 2 and "Invalid schema name" in err
+    finally:
+        await execute_raw(f"DROP DATABASE IF EXISTS {name}")
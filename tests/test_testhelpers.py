@@ -0,0 +1,51 @@
+"""Test the database fixtures"""
+from typing import Any, List
+import uuid
+
+import pytest
+from sqlalchemy.engine.url import make_url
+
+from arkia11nmodels.models import db, User
+from arkia11nmodels.testhelpers import schema_fingerprint, worker_database
+
+ROLLED_BACK: List[uuid.UUID] = []
+
+
+def test_worker_database(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Every xdist worker gets its own database"""
+    monkeypatch.delenv("PYTEST_XDIST_WORKER", raising=False)
+    assert worker_database("modelstest") == "modelstest_main"
+    monkeypatch.setenv("PYTEST_XDIST_WORKER", "gw3")
+    assert worker_database("modelstest") == "modelstest_gw3"
+    assert schema_fingerprint() == schema_fingerprint()
+
+
+@pytest.mark.asyncio
+async def test_cloned(dockerdb: str) -> None:
+    """The session database is a clone of the template"""
+    database = make_url(dockerdb).database
+    assert database == worker_database("modelstest")
+    description = "SELECT shobj_description(oid, 'pg_database') FROM pg_database WHERE datname = 'modelstest_template'"
+    assert await db.scalar(description) == schema_fingerprint()
+
+
+@pytest.mark.asyncio
+async def test_rollback(rollbackdb: Any) -> None:
+    """Changes are visible within the test"""
+    user = await User.create(email="rollbacktest@example.com")
+    ROLLED_BACK.append(user.pk)
+    assert (await User.get(user.pk)).email == "rollbacktest@example.com"
+    async with db.transaction():
+        await user.update(displayname="savepoint").apply()
+    found = await User.get_by_email("rollbacktest@example.com")
+    assert found is not None and found.displayname == "savepoint"
+    assert rollbackdb.raw_connection.is_in_transaction()
+
+
+@pytest.mark.asyncio
+async def test_rolled_back(dockerdb: str) -> None:
+    """And gone after it"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    for pk in ROLLED_BACK:
+        assert await User.get(pk) is None
+    assert await User.get_by_email("rollbacktest@example.com") is None
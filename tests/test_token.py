@@ -140,3 +140,25 @@ async def test_token_expires_datetime(with_user: User) -> None:
 
     await asyncio.sleep(2.0)
     assert not token.is_valid()
+
+
+@pytest.mark.asyncio
+async def test_mark_used_audit_meta(with_user: User) -> None:
+    """Audit data is merged in the database, concurrent updates via stale instances are not lost"""
+    token = Token.for_user(with_user)
+    token.sent_to = with_user.email
+    await token.create()
+    try:
+        stale = await Token.get(token.pk)
+        await token.merge_jsonb("audit_meta", {"requested_from": "192.0.2.1"})
+        await asyncio.gather(
+            stale.mark_used({"used_from": "192.0.2.2"}),
+            (await Token.get(token.pk)).merge_jsonb("audit_meta", {"delivered": True}),
+        )
+        assert stale.used
+        fetched = await Token.get(token.pk)
+        assert fetched.audit_meta == {"requested_from": "192.0.2.1", "used_from": "192.0.2.2", "delivered": True}
+        assert stale.audit_meta["used_from"] == "192.0.2.2"
+        assert not fetched.is_valid()
+    finally:
+        await token.delete()
@@ -1,8 +1,11 @@
 """Test the user model"""
+from typing import AsyncGenerator, List
+import asyncio
 import json
 import logging
 
 import pytest
+import pytest_asyncio
 import pendulum
 from asyncpg.exceptions import UniqueViolationError
 from libadvian.binpackers import b64_to_uuid, uuid_to_b64
@@ -11,6 +14,7 @@ from pydantic import ValidationError
 from arkia11nmodels.models import User
 from arkia11nmodels.schemas.user import UserCreate, DBUser
 from arkia11nmodels.clickhelpers import get_by_uuid
+from arkia11nmodels.dbdevhelpers import enable_trgm
 
 LOGGER = logging.getLogger(__name__)
 
@@ -143,3 +147,76 @@ async def test_user_email_unique(dockerdb: str) -> None:
         await user2.create()
 
     await user1.delete()
+
+
+@pytest.mark.asyncio
+async def test_get_by_email_deleted(dockerdb: str) -> None:
+    """Soft-deleted users are not found by email"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    user = User(email="softdeleted@example.com")
+    await user.create()
+    found = await User.get_by_email("softdeleted@example.com")
+    assert found is not None and found.pk == user.pk
+    await user.soft_delete()
+    assert await User.get_by_email("softdeleted@example.com") is None
+    await user.delete()
+
+
+@pytest_asyncio.fixture
+async def search_users(dockerdb: str) -> AsyncGenerator[List[User], None]:
+    """Users to search for, skips if pg_trgm is not available"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    if not await enable_trgm():
+        pytest.skip("pg_trgm extension is not available")
+    users = []
+    for email, displayname in (
+        ("matti.meikalainen@example.com", "Matti Meikäläinen"),
+        ("maija.meikalainen@example.com", "Maija Meikäläinen"),
+        ("teppo.testaaja@example.com", "Teppo 100%_Testaaja"),
+    ):
+        user = User(email=email, displayname=displayname)
+        await user.create()
+        users.append(user)
+    yield users
+    for user in users:
+        await user.delete()
+
+
+@pytest.mark.asyncio
+async def test_search(search_users: List[User]) -> None:
+    """Test searching by part of email or displayname"""
+    matti, maija, teppo = search_users
+    found = await User.search("meikal")
+    assert {user.pk for user in found} == {matti.pk, maija.pk}
+    # closest match first, typo tolerant
+    found = await User.search("Mati Meikäläinen")
+    assert found[0].pk == matti.pk
+    assert [user.pk for user in await User.search("teppo.testaaja")] == [teppo.pk]
+    assert len(await User.search("meikal", limit=1)) == 1
+    # LIKE wildcards are literal
+    assert [user.pk for user in await User.search("100%_")] == [teppo.pk]
+    assert not await User.search("%_%")
+
+    await maija.soft_delete()
+    assert [user.pk for user in await User.search("maija")] == []
+
+
+@pytest.mark.asyncio
+async def test_update_profile(dockerdb: str) -> None:
+    """Partial profile updates"""
+    _ = dockerdb  # consume the fixture to keep linter happy
+    user = User(email="profiletest@example.com", profile={"keep": 1, "drop": 2})
+    await user.create()
+    try:
+        stale = await User.get(user.pk)
+        await asyncio.gather(
+            user.update_profile({"callsign": "Kettu"}),
+            stale.update_profile({"unit": "1.JP"}, remove=["drop"]),
+        )
+        fetched = await User.get(user.pk)
+        assert fetched.profile == {"keep": 1, "callsign": "Kettu", "unit": "1.JP"}
+        await fetched.update_profile(remove=["keep", "nosuchkey"])
+        assert fetched.profile == {"callsign": "Kettu", "unit": "1.JP"}
+        assert (await User.get(user.pk)).profile == fetched.profile
+    finally:
+        await user.delete()